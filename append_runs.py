@@ -0,0 +1,94 @@
+"""
+Append new run* directories to a preprocessed rope dataset in place.
+
+Only the runs missing from <root>/manifest.json are preprocessed. Their
+images are appended to images.npy, their pairs and negatives to the index,
+and the manifest records every ingested run with a hash of its contents.
+Rerunning after an interruption picks up where the previous attempt stopped.
+
+Usage: python append_runs.py <root> [--verify] [--n_workers N] [--chunk_size N]
+"""
+
+import argparse
+import glob
+import os
+from os.path import join, basename, exists
+import numpy as np
+
+from dataset import PairIndex, write_index
+from compute_vine_dset import build_index, extend_index, hash_run, \
+    read_manifest, write_manifest, manifest_entries
+from collect_images import collect_images, append_images
+
+
+def sync_manifest(root, index):
+    """
+    Add the runs of the index that the manifest does not list yet, such as
+    those of an index built before manifests existed.
+    """
+    manifest = read_manifest(root)
+    listed = set(entry['run'] for entry in manifest)
+    runs = [str(run) for run in index.runs]
+    missing = [i for i, run in enumerate(runs) if basename(run) not in listed]
+    if missing:
+        print('Recording %d indexed runs in the manifest.' % len(missing))
+        counts = np.bincount(index.frame_run, minlength=len(runs))
+        manifest += [dict(run=basename(runs[i]), hash=hash_run(runs[i]), n_images=int(counts[i]))
+                     for i in missing]
+        write_manifest(root, manifest)
+    return manifest
+
+
+def verify(root, manifest):
+    changed = [entry['run'] for entry in manifest
+               if hash_run(join(root, entry['run'])) != entry['hash']]
+    if changed:
+        raise Exception('Ingested runs changed on disk: %s. Rebuild the dataset with '
+                        'compute_vine_dset.py and collect_images.py.' % ', '.join(changed))
+    print('All %d ingested runs match the manifest.' % len(manifest))
+
+
+def main():
+    index = PairIndex(args.root)
+    manifest = sync_manifest(args.root, index)
+    if args.verify:
+        verify(args.root, manifest)
+
+    listed = set(entry['run'] for entry in manifest)
+    new_runs = [run for run in sorted(glob.glob(join(args.root, 'run*')))
+                if basename(run) not in listed]
+    if not new_runs:
+        print('No new runs in %s.' % args.root)
+        return
+    print('Appending %d new runs.' % len(new_runs))
+
+    new = build_index(new_runs)
+    entries = manifest_entries(new_runs, new)
+    n_old, n_new = len(index.image_paths), len(new['image_paths'])
+
+    store_path = join(args.root, 'images.npy')
+    staging_path = join(args.root, 'images.append.npy')
+    n_store = len(np.load(store_path, mmap_mode='r'))
+    if n_store == n_old:
+        collect_images([str(path) for path in new['image_paths']], staging_path,
+                       n_workers=args.n_workers, chunk_size=args.chunk_size)
+        append_images(store_path, np.load(staging_path, mmap_mode='r'))
+    elif n_store != n_old + n_new:
+        raise Exception('%s holds %d images, expected %d or %d' % (store_path, n_store, n_old, n_old + n_new))
+    if exists(staging_path):
+        os.remove(staging_path)
+
+    write_index(args.root, extend_index(index, new))
+    write_manifest(args.root, manifest + entries)
+    print('Dataset now holds %d runs and %d images.' % (len(manifest) + len(entries), n_old + n_new))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('root', type=str)
+    parser.add_argument('--verify', action='store_true',
+                        help='check the content hashes of the ingested runs first')
+    parser.add_argument('--n_workers', type=int, default=None)
+    parser.add_argument('--chunk_size', type=int, default=1024)
+    args = parser.parse_args()
+    main()
@@ -0,0 +1,92 @@
+import argparse
+import time
+import numpy as np
+
+import torch
+
+from dataset import ImagePairs, NCEDataset, NCEVineDataset, batch_loader, normalize_images
+
+
+def make_dataset(uint8):
+    if args.dataset == 'pairs':
+        return ImagePairs(root=args.root, uint8=uint8)
+    elif args.dataset == 'nce':
+        return NCEDataset(root=args.root, n_neg=args.n_neg, uint8=uint8)
+    elif args.dataset == 'vine':
+        return NCEVineDataset(root=args.root, n_neg=args.n_neg, uint8=uint8)
+    raise Exception('Invalid dataset {}'.format(args.dataset))
+
+
+def inf_iterator(data_loader):
+    while True:
+        for batch in data_loader:
+            yield batch
+
+
+def batch_bytes(batch):
+    return sum(b.numel() * b.element_size() for b in batch if torch.is_tensor(b))
+
+
+def check_identical():
+    """
+    Normalizing a uint8 batch must give exactly the float batch.
+    """
+    dset_float, dset_uint8 = make_dataset(False), make_dataset(True)
+    indices = np.random.randint(0, len(dset_float), size=args.batch_size)
+    np.random.seed(args.seed)
+    batch_float = dset_float.__getitems__(indices)
+    np.random.seed(args.seed)
+    batch_uint8 = dset_uint8.__getitems__(indices)
+    for x, y in zip(batch_float, batch_uint8):
+        assert torch.equal(x, normalize_images(y)), 'uint8 mode differs from the float path'
+    print('uint8 batches normalize to the float batches exactly.')
+
+
+def run(uint8):
+    loader = batch_loader(make_dataset(uint8), args.batch_size, shuffle=True,
+                          drop_last=True, num_workers=args.num_workers)
+    n_bytes, load_time, norm_time = 0, 0., 0.
+    itr = inf_iterator(loader)
+    for _ in range(args.n_batches):
+        start = time.time()
+        batch = next(itr)
+        load_time += time.time() - start
+        n_bytes += batch_bytes(batch)
+
+        start = time.time()
+        batch = [normalize_images(b) for b in batch]
+        norm_time += time.time() - start
+    return n_bytes / args.n_batches, load_time, norm_time
+
+
+def main():
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    torch.set_num_threads(args.num_threads)
+    check_identical()
+
+    results = dict()
+    for mode in ['float', 'uint8']:
+        results[mode] = run(mode == 'uint8')
+        bytes_per_batch, load_time, norm_time = results[mode]
+        print('{:>5}: {:8.2f} MB/batch transferred, {:7.2f} batches/s loading, '
+              '{:7.2f} ms/batch normalizing'.format(mode, bytes_per_batch / 2 ** 20,
+                                                     args.n_batches / load_time,
+                                                     1000 * norm_time / args.n_batches))
+    print('Memory traffic reduction: {:.2f}x'.format(results['float'][0] / results['uint8'][0]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--root', type=str, default='data/rope/train_data')
+    parser.add_argument('--dataset', type=str, default='vine')
+    parser.add_argument('--n_neg', type=int, default=48)
+    parser.add_argument('--batch_size', type=int, default=128)
+    parser.add_argument('--n_batches', type=int, default=50)
+    parser.add_argument('--num_workers', type=int, default=4)
+    parser.add_argument('--num_threads', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    assert args.dataset in ['pairs', 'nce', 'vine']
+    main()
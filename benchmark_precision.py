@@ -0,0 +1,82 @@
+"""
+Benchmark mixed precision in the Causal InfoGAN trainers. Trains main.py on
+the rope dataset once per precision, from the same seed, and compares the
+step time and the per-epoch losses of each run with float32.
+
+Arguments this script does not know are passed on to main.py, e.g.
+    python benchmark_precision.py --n_epochs 5 -data_dir data/rope/full_data \
+        -planning_data_dir data/rope/seq_data -learn_var
+and --wgan benchmarks the WGAN-GP trainer instead.
+"""
+
+import argparse
+import csv
+import os
+import subprocess
+import sys
+from os.path import join, exists
+
+import numpy as np
+import torch
+
+LOSSES = ['Dloss', 'Gloss', 'Qloss', 'Tloss']
+
+
+def read_progress(path):
+    with open(path) as f:
+        rows = list(csv.DictReader(f))
+    return {k: np.array([float(row[k]) for row in rows]) for k in rows[0]}
+
+
+def run(precision, main_args):
+    prefix = 'precision_{}{}'.format(precision, '_wgan' if args.wgan else '')
+    progress = join(args.savepath, prefix, 'progress.csv')
+    if exists(progress):
+        os.remove(progress)
+    cmd = [sys.executable, 'main.py', '-savepath', args.savepath, '-prefix', prefix,
+           '-n_epochs', str(args.n_epochs), '-plan_length', '0', '-seed', str(args.seed)]
+    if precision != 'fp32':
+        cmd.append('-' + precision)
+    if args.wgan:
+        cmd.append('-wgan')
+    print(' '.join(cmd + main_args))
+    subprocess.check_call(cmd + main_args)
+    return read_progress(progress)
+
+
+def main(main_args):
+    precisions = args.precisions
+    if precisions is None:
+        precisions = ['fp32', 'bf16'] + (['fp16'] if torch.cuda.is_available() else [])
+    assert precisions[0] == 'fp32', 'float32 is the reference run'
+    results = {precision: run(precision, main_args) for precision in precisions}
+
+    reference = results['fp32']
+    # The first epoch includes warm-up (cudnn autotuning, page faults).
+    ref_ms = np.median(reference['step_ms'][1:] if args.n_epochs > 1 else reference['step_ms'])
+    print('\n{:>5} {:>9} {:>8}  {}'.format('', 'ms/step', 'speedup',
+                                          '  '.join('{:>20}'.format(k + ' last (max dev)') for k in LOSSES)))
+    for precision, progress in results.items():
+        ms = np.median(progress['step_ms'][1:] if args.n_epochs > 1 else progress['step_ms'])
+        # Deviation from float32 over all epochs, relative to the spread of
+        # the float32 curve, so that 1 means as far off as float32 moves.
+        devs = []
+        for k in LOSSES:
+            spread = max(np.ptp(reference[k]), 1e-6)
+            devs.append('{:11.3f} ({:6.2f})'.format(progress[k][-1],
+                                                   np.abs(progress[k] - reference[k]).max() / spread))
+        print('{:>5} {:9.2f} {:7.2f}x  {}'.format(precision, ms, ref_ms / ms, '  '.join(devs)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--precisions', type=str, nargs='+', default=None,
+                        help='fp32 first, then any of bf16 and fp16; fp16 only on CUDA by default')
+    parser.add_argument('--n_epochs', type=int, default=5)
+    parser.add_argument('--wgan', action='store_true')
+    parser.add_argument('--savepath', type=str, default=join('out', 'benchmark_precision'))
+    parser.add_argument('--seed', type=int, default=0)
+    args, main_args = parser.parse_known_args()
+
+    assert all(p in ['fp32', 'bf16', 'fp16'] for p in args.precisions or [])
+    main(main_args)
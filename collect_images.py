@@ -1,47 +1,158 @@
-import sys
-from os.path import join
+"""
+Preprocess the rope images listed in <root>/index into <root>/images.npy.
+
+Images are transformed in parallel worker processes and written in order,
+one chunk at a time. Progress is recorded next to the output after every
+chunk, so rerunning the same command after a crash resumes where it stopped.
+
+Usage: python collect_images.py <root> [--n_workers N] [--chunk_size N]
+"""
+
+import argparse
+import io
+import os
+import time
+from os.path import join, exists
+from multiprocessing import Pool
 from tqdm import tqdm
-from scipy.ndimage.morphology import grey_dilation
-import h5py
 import numpy as np
-import pickle
 
 import torch
 from torchvision import transforms
 from torchvision.datasets.folder import default_loader as loader
 
-root = sys.argv[1]
-
-with open(join(root, 'pos_neg_pairs.pkl'), 'rb') as f:
-    data = pickle.load(f)
-all_images = data['all_images']
-
-def filter_background(x):
-    x[:, (x < 0.3).any(dim=0)] = 0.0
-    return x
-
-def dilate(x):
-    x = x.squeeze(0).numpy()
-    x = grey_dilation(x, size=3)
-    x = x[None, :, :]
-    return torch.from_numpy(x)
+from dataset import PairIndex
+from rope_transforms import tensor_transform
 
-transform = transforms.Compose([
+load_transform = transforms.Compose([
     transforms.Resize(64),
     transforms.CenterCrop(64),
     transforms.ToTensor(),
-    filter_background,
-    lambda x: x.mean(dim=0)[None, :, :],
-    dilate,
-    transforms.Normalize((0.5,), (0.5,)),
 ])
+transform = tensor_transform()
+
+
+def process_chunk(paths):
+    # Images are decoded one by one, then transformed as one batch.
+    imgs = transform(torch.stack([load_transform(loader(path)) for path in paths], dim=0))
+    imgs = imgs.numpy() * 0.5 + 0.5
+    imgs *= 255
+    return imgs.astype(np.uint8)
+
+
+def init_worker():
+    # Parallelism comes from the processes, not from intra-op threads.
+    torch.set_num_threads(1)
+
+
+def read_progress(progress_path):
+    with open(progress_path) as f:
+        return int(f.read())
+
+
+def write_progress(progress_path, n_done):
+    with open(progress_path + '.tmp', 'w') as f:
+        f.write(str(n_done))
+    os.rename(progress_path + '.tmp', progress_path)
+
+
+def collect_images(paths, out_path, n_workers=None, chunk_size=1024):
+    """
+    Preprocess the images at paths into a uint8 array saved at out_path,
+    resuming a previous interrupted run of the same call if there is one.
+    """
+    progress_path = out_path + '.progress'
+    shape = (len(paths), 1, 64, 64)
+    if exists(out_path) and not exists(progress_path):
+        print('%s is already complete.' % out_path)
+        return
+    if exists(progress_path):
+        images = np.lib.format.open_memmap(out_path, mode='r+')
+        assert images.shape == shape, 'Cannot resume %s: it holds %s images, expected %s' \
+                                      % (out_path, images.shape, shape)
+        n_done = read_progress(progress_path)
+        print('Resuming %s from image %d / %d.' % (out_path, n_done, len(paths)))
+    else:
+        images = np.lib.format.open_memmap(out_path, mode='w+', dtype=np.uint8, shape=shape)
+        n_done = 0
+        write_progress(progress_path, n_done)
+
+    chunks = [paths[i:i + chunk_size] for i in range(n_done, len(paths), chunk_size)]
+    start_time, n_start = time.time(), n_done
+    pool = Pool(n_workers, initializer=init_worker)
+    pbar = tqdm(total=len(paths), initial=n_done)
+    try:
+        # imap yields chunks in order while later chunks are still being processed.
+        for chunk in pool.imap(process_chunk, chunks):
+            images[n_done:n_done + len(chunk)] = chunk
+            images.flush()
+            n_done += len(chunk)
+            write_progress(progress_path, n_done)
+
+            pbar.set_description('%.1f images/s' % ((n_done - n_start) / (time.time() - start_time)))
+            pbar.update(len(chunk))
+    finally:
+        pbar.close()
+        pool.close()
+        pool.join()
+    del images
+    os.remove(progress_path)
+    print('Wrote %d images to %s at %.1f images/s.' % (len(paths), out_path,
+                                                    (n_done - n_start) / (time.time() - start_time)))
+
+
+def append_images(path, images, chunk_size=4096):
+    """
+    Append images to the .npy array at path in place. The rows are written
+    past the end of the existing data before the header is updated with the
+    new shape, so an interrupted append leaves the old array intact. Files
+    whose header has no room for the new shape are rewritten instead.
+    """
+    fmt = np.lib.format
+    with open(path, 'r+b') as f:
+        version = fmt.read_magic(f)
+        if version == (1, 0):
+            read_header, write_header = fmt.read_array_header_1_0, fmt.write_array_header_1_0
+        else:
+            read_header, write_header = fmt.read_array_header_2_0, fmt.write_array_header_2_0
+        shape, fortran_order, dtype = read_header(f)
+        offset = f.tell()
+        assert not fortran_order and dtype == images.dtype and shape[1:] == images.shape[1:]
+
+        new_shape = (shape[0] + len(images),) + shape[1:]
+        header = io.BytesIO()
+        write_header(header, dict(descr=fmt.dtype_to_descr(dtype), fortran_order=False, shape=new_shape))
+        if len(header.getvalue()) == offset:
+            f.seek(offset + int(np.prod(shape)) * dtype.itemsize)
+            f.truncate()
+            for i in range(0, len(images), chunk_size):
+                f.write(np.ascontiguousarray(images[i:i + chunk_size]).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+            f.seek(0)
+            f.write(header.getvalue())
+            return
+
+    old = np.load(path, mmap_mode='r')
+    out = np.lib.format.open_memmap(path + '.tmp', mode='w+', dtype=dtype, shape=new_shape)
+    for start, source in [(0, old), (len(old), images)]:
+        for i in range(0, len(source), chunk_size):
+            chunk = source[i:i + chunk_size]
+            out[start + i:start + i + len(chunk)] = chunk
+    out.flush()
+    del old, out
+    os.rename(path + '.tmp', path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('root', type=str)
+    parser.add_argument('--n_workers', type=int, default=None,
+                        help='number of worker processes, all cores by default')
+    parser.add_argument('--chunk_size', type=int, default=1024,
+                        help='images per worker task and per write')
+    args = parser.parse_args()
 
-dset = h5py.File(join(root, 'images.hdf5'), 'x')
-dset.create_dataset('images', (len(all_images), 1, 64, 64), 'uint8')
-stored = []
-for i, img in enumerate(tqdm(all_images)):
-    img = transform(loader(img))
-    img = img.numpy() * 0.5 + 0.5
-    img *= 255
-    img = img.astype(np.uint8)
-    dset['images'][i] = img
+    paths = [str(path) for path in PairIndex(args.root).image_paths]
+    collect_images(paths, join(args.root, 'images.npy'),
+                   n_workers=args.n_workers, chunk_size=args.chunk_size)
@@ -1,19 +1,27 @@
-import pickle
 import glob
-import sys
+import hashlib
+import json
 import os
-from os.path import join
+import sys
+from os.path import join, basename, exists
 import numpy as np
 import itertools
 from tqdm import tqdm
 
+from dataset import write_index, ACTION_MEAN, ACTION_STD
+
+
+def parse_t_k(image):
+    img_split = image.split('_')
+    t = int(img_split[-2])
+    k = int(img_split[-1].split('.')[0])
+    return t, k
+
 
 def org_images(images):
     t_k = dict()
     for image in images:
-        img_split = image.split('_')
-        t = int(img_split[-2])
-        k = int(img_split[-1].split('.')[0])
+        t, k = parse_t_k(image)
         if t not in t_k:
             t_k[t] = dict()
         assert k not in t_k[t]
@@ -21,40 +29,127 @@ def org_images(images):
     return t_k
 
 
-root = sys.argv[1]
-runs = glob.glob(join(root, 'run*'))
-runs = sorted(runs)
-
-neg_samples_same_t = dict()
-neg_samples_same_traj = dict()
-pos_pairs = []
-all_images = []
-for run in tqdm(runs):
-    action_file = join(run, 'actions.npy')
-    np.load(action_file) # just to make sure the path is right
-
-    neg_samples_same_t[run] = dict()
-    neg_samples_same_traj[run] = dict()
-
-    images = glob.glob(join(run, '*.png'))
-    images = sorted(images)
-    all_images.extend(images)
-    images = org_images(images)
-    for t in itertools.count():
-        if t + 1 not in images:
-            break
-        for k in images[t+1]:
-            pos_pairs.append((images[t][0], images[t+1][k], action_file))
-
-        neg_samples_same_t[run][t] = [images[t+1][k] for k in images[t+1]]
-        neg_samples_same_traj[run][t] = []
-        for t_tmp in images:
-            if t_tmp == t or t_tmp == t+1:
-                continue
-            for k_tmp in images[t_tmp]:
-                neg_samples_same_traj[run][t].append(images[t_tmp][k_tmp])
-
-data = dict(pos_pairs=pos_pairs, neg_samples_t=neg_samples_same_t,
-            neg_samples_traj=neg_samples_same_traj, all_images=all_images)
-with open(join(root, 'pos_neg_pairs.pkl'), 'wb') as f:
-    pickle.dump(data, f)
+def frame_ranges(frame_run, frame_t, run, t_first, t_last):
+    """
+    Return frame_order (image rows grouped by run, then t) and the [start, end)
+    range inside it of the images of run[i] with t_first[i] <= t <= t_last[i].
+    """
+    frame_order = np.lexsort((np.arange(len(frame_t)), frame_t, frame_run))
+    stride = int(frame_t.max()) + 2
+    keys = frame_run[frame_order].astype(np.int64) * stride + frame_t[frame_order]
+    run = run.astype(np.int64) * stride
+    return frame_order, np.stack((np.searchsorted(keys, run + t_first, 'left'),
+                                  np.searchsorted(keys, run + t_last, 'right')), axis=1)
+
+
+def build_index(runs):
+    """
+    Build the integer pair/negative index of the vine runs as a dict of arrays.
+    Image rows follow the order of images.npy: runs sorted, then image files
+    sorted within each run.
+    """
+    image_paths, frame_run, frame_t, frame_k = [], [], [], []
+    pos_pairs, pos_action_idx, pos_actions = [], [], []
+    for r, run in enumerate(tqdm(runs)):
+        actions = np.load(join(run, 'actions.npy'))
+
+        images = sorted(glob.glob(join(run, '*.png')))
+        row = {img: len(image_paths) + i for i, img in enumerate(images)}
+        image_paths.extend(images)
+        for img in images:
+            t, k = parse_t_k(img)
+            frame_run.append(r)
+            frame_t.append(t)
+            frame_k.append(k)
+
+        images = org_images(images)
+        for t in itertools.count():
+            if t + 1 not in images:
+                break
+            for k in images[t + 1]:
+                pos_pairs.append((row[images[t][0]], row[images[t + 1][k]]))
+                pos_action_idx.append((r, t, k))
+                pos_actions.append(actions[t, k])
+
+    frame_run = np.array(frame_run, dtype=np.int32)
+    frame_t = np.array(frame_t, dtype=np.int32)
+    pos_action_idx = np.array(pos_action_idx, dtype=np.int32).reshape(-1, 3)
+    run, t = pos_action_idx[:, 0], pos_action_idx[:, 1]
+    # Negatives at the same time step are the images at t + 1 of the same run.
+    frame_order, pos_neg_t = frame_ranges(frame_run, frame_t, run, t + 1, t + 1)
+    # Negatives from the same trajectory are the images of the run outside of
+    # t and t + 1, stored as the run's range and the window to skip within it.
+    _, pos_neg_run = frame_ranges(frame_run, frame_t, run, 0, frame_t.max())
+    _, pos_neg_window = frame_ranges(frame_run, frame_t, run, t, t + 1)
+
+    return dict(runs=np.array(runs),
+                image_paths=np.array(image_paths),
+                frame_run=frame_run,
+                frame_t=frame_t,
+                frame_k=np.array(frame_k, dtype=np.int32),
+                frame_order=frame_order.astype(np.int64),
+                pos_pairs=np.array(pos_pairs, dtype=np.int64).reshape(-1, 2),
+                pos_action_idx=pos_action_idx,
+                pos_actions=((np.array(pos_actions).reshape(-1, len(ACTION_MEAN)) - ACTION_MEAN)
+                             / ACTION_STD).astype(np.float32),
+                pos_neg_t=pos_neg_t.astype(np.int64),
+                pos_neg_run=pos_neg_run.astype(np.int64),
+                pos_neg_window=pos_neg_window.astype(np.int64))
+
+
+def extend_index(index, new):
+    """
+    Append the index of new runs, as returned by build_index, to an existing
+    PairIndex. The new image rows follow the existing ones.
+    """
+    n_runs, n_images = len(index.runs), len(index.image_paths)
+    new['frame_run'] += n_runs
+    new['pos_action_idx'][:, 0] += n_runs
+    for name in ['frame_order', 'pos_pairs', 'pos_neg_t', 'pos_neg_run', 'pos_neg_window']:
+        new[name] += n_images
+    return {name: np.concatenate((getattr(index, name), new[name])) for name in new}
+
+
+def hash_run(run):
+    """
+    Hash of the file names and contents of a run directory.
+    """
+    h = hashlib.sha1()
+    for path in sorted(glob.glob(join(run, '*'))):
+        h.update(basename(path).encode())
+        with open(path, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def read_manifest(root):
+    """
+    Return the list of runs ingested into the dataset at root, each as a dict
+    with its directory name, content hash and number of images.
+    """
+    path = join(root, 'manifest.json')
+    if not exists(path):
+        return []
+    with open(path) as f:
+        return json.load(f)['runs']
+
+
+def write_manifest(root, runs):
+    path = join(root, 'manifest.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(dict(runs=runs), f, indent=1)
+    os.rename(path + '.tmp', path)
+
+
+def manifest_entries(runs, index):
+    n_images = np.bincount(index['frame_run'], minlength=len(runs))
+    return [dict(run=basename(run), hash=hash_run(run), n_images=int(n))
+            for run, n in zip(runs, n_images)]
+
+
+if __name__ == '__main__':
+    root = sys.argv[1]
+    runs = sorted(glob.glob(join(root, 'run*')))
+    index = build_index(runs)
+    write_index(root, index)
+    write_manifest(root, manifest_entries(runs, index))
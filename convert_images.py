@@ -0,0 +1,30 @@
+"""
+One-time conversion of images.hdf5 into the memory-mapped images.npy read by
+dataset.ImageStore.
+
+Usage: python convert_images.py <root>
+"""
+
+import os
+import sys
+from os.path import join
+from tqdm import tqdm
+import h5py
+import numpy as np
+
+chunk_size = 4096
+
+root = sys.argv[1]
+out_path = join(root, 'images.npy')
+tmp_path = out_path + '.tmp'
+
+with h5py.File(join(root, 'images.hdf5'), 'r') as f:
+    src = f['images']
+    dst = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=src.shape)
+    for start in tqdm(range(0, src.shape[0], chunk_size)):
+        end = min(start + chunk_size, src.shape[0])
+        dst[start:end] = src[start:end]
+    dst.flush()
+    del dst
+os.rename(tmp_path, out_path)
+print('Wrote %s' % out_path)
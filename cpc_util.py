@@ -3,7 +3,6 @@ import numpy as np
 import glob
 from os.path import join, exists
 import os
-from scipy.ndimage.morphology import grey_dilation
 
 import torch
 from torchvision import transforms
@@ -11,17 +10,20 @@ from torchvision.utils import save_image
 from torchvision.datasets.folder import default_loader
 
 from model import FCN_mse
+from runtime import get_runtime
+from rope_transforms import FilterBackground, Grayscale, Dilate, Normalize
 
 fcn = None
 
-def load_fcn_mse(device=torch.device('cuda')):
+def load_fcn_mse(device=None):
     global fcn
+    device = device or get_runtime().device
     fcn = FCN_mse(2).to(device)
-    fcn.load_state_dict(torch.load('/home/wilson/causal-infogan/data/FCN_mse'))
+    fcn.load_state_dict(torch.load('/home/wilson/causal-infogan/data/FCN_mse', map_location=device))
     fcn.eval()
 
-def apply_fcn_mse(img, device=torch.device('cuda')):
-    o = fcn(img.to(device)).detach()
+def apply_fcn_mse(img, device=None):
+    o = fcn(img.to(device or get_runtime().device)).detach()
     return torch.clamp(2 * (o - 0.5), -1 + 1e-3, 1 - 1e-3)
 
 
@@ -209,17 +211,6 @@ def save_run_dynamics(decoder, encoder, trans,
 
 
 def get_transform(thanard_dset):
-    def filter_background(x):
-        x[:, (x < 0.3).any(dim=0)] = 0.0
-        return x
-
-    def dilate(x):
-        x = x.squeeze(0).numpy()
-        x = grey_dilation(x, size=3)
-        x = x[None, :, :]
-        return torch.from_numpy(x)
-
-
     if thanard_dset:
         transform = transforms.Compose([
             transforms.Resize(64),
@@ -231,10 +222,10 @@ def get_transform(thanard_dset):
             transforms.Resize(64),
             transforms.CenterCrop(64),
             transforms.ToTensor(),
-            filter_background,
-            lambda x: x.mean(dim=0)[None, :, :],
-            dilate,
-            transforms.Normalize((0.5,), (0.5,)),
+            FilterBackground(),
+            Grayscale(),
+            Dilate(3),
+            Normalize(),
         ])
     return transform
 
@@ -244,3 +235,37 @@ def metric_average(val, name):
     tensor = val.clone()
     avg_tensor = hvd.allreduce(tensor, name=name)
     return avg_tensor.item()
+
+
+def save_checkpoint(path, modules, optimizer, scaler, epoch, sampler_state):
+    """
+    Save what a run needs to continue at the exact batch where it stopped:
+    the parameters of modules (a dict from name to module or None), the
+    optimizer and loss scaler states, the epoch and the state of the
+    training sampler. The negatives of a batch are drawn from a generator
+    seeded by the batch (see dataset.batch_rng), so they need no state of
+    their own. The previous checkpoint is only replaced once the new one is
+    written.
+    """
+    state = dict(modules={name: m.state_dict() for name, m in modules.items() if m is not None},
+                 optimizer=optimizer.state_dict(),
+                 scaler=scaler.state_dict(),
+                 epoch=epoch,
+                 sampler=sampler_state)
+    torch.save(state, path + '.tmp')
+    os.rename(path + '.tmp', path)
+
+
+def load_checkpoint(path, modules, optimizer, scaler):
+    """
+    Load a checkpoint of save_checkpoint into modules, optimizer and scaler. Returns
+    its epoch and sampler state.
+    """
+    state = torch.load(path, map_location='cpu')
+    for name, m in modules.items():
+        if m is not None:
+            m.load_state_dict(state['modules'][name])
+    optimizer.load_state_dict(state['optimizer'])
+    if 'scaler' in state:
+        scaler.load_state_dict(state['scaler'])
+    return state['epoch'], state['sampler']
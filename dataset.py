@@ -7,12 +7,34 @@ import os
 import os.path
 import gzip
 import errno
+import fcntl
+import shutil
+import hashlib
+import copy
+import json
+import threading
+import queue
+import time
+import zlib
 from tqdm import tqdm
 from os.path import join, dirname, basename
 
+from torchvision.datasets import ImageFolder
 from torchvision.datasets.folder import is_image_file, default_loader, \
     IMG_EXTENSIONS, DatasetFolder
 from torchvision.datasets.utils import download_url
+from torchvision import transforms
+
+import rope_transforms
+
+
+# Normalization of the vine actions (pick x, pick y, move dx, move dy).
+ACTION_MEAN = np.array([0.5, 0.5, 0., 0.])
+ACTION_STD = np.array([0.5, 0.5, np.sqrt(2), np.sqrt(2)])
+
+# Every uint8 pixel value mapped to [-1, 1] with the same float32 ops as the
+# original per-image conversion, so a table lookup is bit-identical to it.
+PIXEL_TABLE = (np.arange(256, dtype='float32') / 255 - 0.5) / 0.5
 
 
 def makedir_exist_ok(dirpath):
@@ -28,6 +50,306 @@ def makedir_exist_ok(dirpath):
             raise
 
 
+def to_float_tensor(images):
+    """
+    Convert a uint8 image array of any shape to a FloatTensor in [-1, 1].
+    """
+    return torch.from_numpy(PIXEL_TABLE[images])
+
+
+def to_tensor(images, uint8=False):
+    """
+    Convert a uint8 image array to a FloatTensor in [-1, 1], or to a uint8
+    tensor of the raw pixels when uint8 is set. Also accepts uint8 tensors.
+    """
+    if torch.is_tensor(images):
+        return images if uint8 else normalize_images(images)
+    if uint8:
+        return torch.from_numpy(np.array(images, dtype=np.uint8))
+    return to_float_tensor(images)
+
+
+# Per device: True if the fused arithmetic reproduces PIXEL_TABLE exactly,
+# otherwise the table itself on that device.
+_normalize_checked = dict()
+
+
+def normalize_images(images):
+    """
+    Normalize a uint8 image tensor to float32 in [-1, 1] on its own device,
+    bit-identical to the dataset-side conversion. Float tensors are returned
+    unchanged, so training loops can call this in either mode.
+    """
+    if images.dtype != torch.uint8:
+        return images
+    device = images.device
+    if device not in _normalize_checked:
+        table = torch.from_numpy(PIXEL_TABLE).to(device)
+        levels = torch.arange(256, device=device).float().div_(255).sub_(0.5).div_(0.5)
+        _normalize_checked[device] = True if torch.equal(levels, table) else table
+    table = _normalize_checked[device]
+    if table is True:
+        return images.float().div_(255).sub_(0.5).div_(0.5)
+    return table[images.long()]
+
+
+def sample_ranges(start, end, n, rng=np.random):
+    """
+    Draw n integers uniformly from every [start[i], end[i]) range.
+    Returns an array of size len(start) x n.
+    """
+    start, end = np.asarray(start), np.asarray(end)
+    size = (end - start)[:, None]
+    offsets = (rng.random_sample((len(start), n)) * size).astype(np.int64)
+    return start[:, None] + np.minimum(offsets, size - 1)
+
+
+def sample_ranges_excluding(start, end, skip_start, skip_end, n, rng=np.random):
+    """
+    Draw n integers uniformly from every [start[i], end[i]) range, leaving
+    out the window [skip_start[i], skip_end[i]) inside it.
+    Returns an array of size len(start) x n.
+    """
+    skip_start, skip_end = np.asarray(skip_start), np.asarray(skip_end)
+    width = (skip_end - skip_start)[:, None]
+    samples = sample_ranges(start, np.asarray(end) - width[:, 0], n, rng)
+    return samples + width * (samples >= skip_start[:, None])
+
+
+def batch_rng(seed, indices):
+    """
+    Generator for the random draws (negatives, k) of the batch at indices,
+    seeded from seed and the indices themselves. A batch gets the same draws
+    whichever worker builds it, and again when it is replayed after a
+    resume, so the draws need no state of their own in a checkpoint.
+    """
+    key = zlib.crc32(np.ascontiguousarray(indices, dtype=np.int64).tobytes())
+    return np.random.RandomState([seed, key])
+
+
+def batch_loader(dataset, batch_size, shuffle=False, drop_last=False, sampler=None,
+                 resident=False, **kwargs):
+    """
+    DataLoader that fetches whole batches through ``dataset.__getitems__``.
+    The batch sampler hands each worker a list of indices, so a batch is
+    gathered and normalized in one vectorized call instead of item by item.
+    With resident set, a ResidentLoader is returned instead.
+    """
+    if sampler is None:
+        sampler = data.RandomSampler(dataset) if shuffle else data.SequentialSampler(dataset)
+    batch_sampler = data.BatchSampler(sampler, batch_size, drop_last)
+    if resident:
+        return ResidentLoader(dataset, batch_sampler, pin_memory=kwargs.get('pin_memory', False))
+    return data.DataLoader(dataset, sampler=batch_sampler, batch_size=None, **kwargs)
+
+
+class ResidentLoader(object):
+    """
+    Batch iterator over a dataset whose images are held in memory as one
+    tensor (see ResidentStore). Batches are gathered with index tensors in
+    the main process: no workers, no pickled indices and no collation, which
+    costs less than the model step when the whole dataset fits in memory.
+    Exposes dataset and sampler like the DataLoader of batch_loader.
+    """
+
+    def __init__(self, dataset, batch_sampler, pin_memory=False):
+        self.dataset = copy.copy(dataset)
+        self.dataset.images = ResidentStore(dataset.images, pin_memory=pin_memory,
+                                            rows=getattr(dataset, 'rows', None))
+        self.sampler = batch_sampler
+
+    def __iter__(self):
+        for indices in self.sampler:
+            yield self.dataset.__getitems__(indices)
+
+    def __len__(self):
+        return len(self.sampler)
+
+
+def map_batch(fn, batch):
+    """
+    Apply fn to every tensor of a batch of nested lists and tuples.
+    """
+    if torch.is_tensor(batch):
+        return fn(batch)
+    if isinstance(batch, (list, tuple)):
+        return type(batch)(map_batch(fn, b) for b in batch)
+    return batch
+
+
+class DevicePrefetcher(object):
+    """
+    Iterate over a loader with every tensor of each batch (images, negatives,
+    actions) already on device. A background thread takes batches from the
+    loader up to depth batches ahead of the consumer, by default two, so one
+    batch is staged while the current step uses the other. On a CUDA device
+    the thread pins each batch and starts its copy on a side stream, so the
+    transfer overlaps the current step; the consumer's stream only waits for
+    that copy when the batch is handed out. On a CPU device the batches are
+    fetched ahead as they are, and pinned when pin_memory is set so they are
+    ready for a later copy to a GPU.
+
+    Each pass records n_batches, the time the consumer spent blocked waiting
+    for a batch (wait_time) and the total time of the pass (elapsed); report()
+    formats them. Exposes dataset and sampler like the wrapped loader.
+    """
+
+    def __init__(self, loader, device, depth=2, pin_memory=None):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.depth = depth
+        self.cuda = self.device.type == 'cuda'
+        if pin_memory is None:
+            pin_memory = self.cuda
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.stream = torch.cuda.Stream(self.device) if self.cuda else None
+        self.n_batches, self.wait_time, self.elapsed = 0, 0., 0.
+
+    @property
+    def dataset(self):
+        return self.loader.dataset
+
+    @property
+    def sampler(self):
+        return self.loader.sampler
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _pin(self, x):
+        return x if x.is_pinned() else x.pin_memory()
+
+    def _stage(self, batch):
+        if self.pin_memory:
+            batch = map_batch(self._pin, batch)
+        if not self.cuda:
+            return batch, None
+        with torch.cuda.stream(self.stream):
+            batch = map_batch(lambda x: x.to(self.device, non_blocking=True), batch)
+            copied = torch.cuda.Event()
+            copied.record(self.stream)
+        return batch, copied
+
+    def _release(self, batch, copied):
+        # The batch was allocated on the side stream: make the current stream
+        # wait for the copy, and keep the memory alive until its work is done.
+        stream = torch.cuda.current_stream(self.device)
+        stream.wait_event(copied)
+        map_batch(lambda x: x.record_stream(stream), batch)
+
+    def __iter__(self):
+        self.n_batches, self.wait_time, self.elapsed = 0, 0., 0.
+        start = time.time()
+        batches = iter(ReadAhead(self._stage, self.loader, self.depth))
+        try:
+            while True:
+                wait_start = time.time()
+                try:
+                    batch, copied = next(batches)
+                except StopIteration:
+                    self.elapsed = time.time() - start
+                    return
+                if copied is not None:
+                    self._release(batch, copied)
+                self.wait_time += time.time() - wait_start
+                self.n_batches += 1
+                self.elapsed = time.time() - start
+                yield batch
+        finally:
+            batches.close()
+
+    def report(self):
+        return 'waited {:.2f} ms/batch for data, {:.1f}% of {:.1f}s'.format(
+            1000 * self.wait_time / max(self.n_batches, 1),
+            100 * self.wait_time / max(self.elapsed, 1e-9), self.elapsed)
+
+
+def rank_shard(index, rank, world_size):
+    """
+    Split the pairs of a PairIndex between world_size ranks at run boundaries,
+    into shards of about equal size. Returns the [start, end) pairs and the
+    [start, end) image rows of the shard of rank. Both are contiguous since
+    pairs and images are stored run by run, and all negatives of a pair
+    within its run stay inside the shard.
+    """
+    if world_size == 1:
+        return (0, len(index.pos_pairs)), (0, len(index.frame_run))
+    pair_run = np.asarray(index.pos_action_idx[:, 0])
+    n = len(pair_run)
+    bounds = np.concatenate(([0], np.flatnonzero(np.diff(pair_run)) + 1, [n]))
+    targets = n * np.arange(world_size + 1) // world_size
+    cuts = bounds[np.abs(bounds[None, :] - targets[:, None]).argmin(axis=1)]
+    start, end = cuts[rank], cuts[rank + 1]
+    if end <= start:
+        raise ValueError('%d runs are too few to give each of %d ranks its own'
+                         % (len(bounds) - 1, world_size))
+    frame_run = index.frame_run
+    return (int(start), int(end)), (int(np.searchsorted(frame_run, pair_run[start], 'left')),
+                                    int(np.searchsorted(frame_run, pair_run[end - 1], 'right')))
+
+
+class ShardSampler(data.Sampler):
+    """
+    Random order of the n items of a rank's shard, reshuffled every epoch
+    from (seed, epoch) so that it is the same across restarts. Padded by
+    repeating items, or cut, to num_samples, so that every rank takes the
+    same number of steps even if the shards differ in size. Call set_epoch
+    every epoch.
+
+    The order only depends on (seed, epoch), so state_dict() is all a
+    checkpoint needs to continue an epoch at the exact item where it
+    stopped: load_state_dict() makes the next pass start there.
+    """
+
+    def __init__(self, n, num_samples=None, seed=0):
+        self.n = n
+        self.num_samples = n if num_samples is None else num_samples
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch, start=0):
+        self.epoch = epoch
+        self.start = start
+
+    def state_dict(self, n_done=0):
+        """
+        State to resume from once the first n_done items of this pass are used.
+        """
+        return dict(seed=self.seed, epoch=self.epoch, start=self.start + n_done)
+
+    def load_state_dict(self, state):
+        self.seed = state['seed']
+        self.set_epoch(state['epoch'], state['start'])
+
+    def __iter__(self):
+        rng = np.random.RandomState([self.seed, self.epoch])
+        order = rng.permutation(self.n)
+        order = np.tile(order, -(-self.num_samples // self.n))[self.start:self.num_samples]
+        return iter(order.tolist())
+
+    def __len__(self):
+        return self.num_samples - self.start
+
+
+def rank_sampler(dataset, seed=0):
+    """
+    ShardSampler over a dataset built with rank and world_size, with the same
+    number of samples on every rank.
+    """
+    return ShardSampler(len(dataset), -(-len(dataset.index.pos_pairs) // dataset.world_size), seed)
+
+
+def rank_subset(dataset, rank, world_size, seed=0):
+    """
+    The contiguous 1 / world_size slice of any map-style dataset that belongs
+    to rank, such as an ImageFolder listed run by run, and its ShardSampler.
+    """
+    n = len(dataset)
+    subset = data.Subset(dataset, range(n * rank // world_size, n * (rank + 1) // world_size))
+    return subset, ShardSampler(len(subset), -(-n // world_size), seed)
+
+
 class MergedDataset(data.Dataset):
     """
     Merged multiple datasets into one. Sample together.
@@ -75,6 +397,60 @@ def make_dataset(dir, class_to_idx):
     return images, np.concatenate(actions, axis=0)
 
 
+def _pixel_steps(threshold):
+    """
+    For every uint8 difference d, whether two pixels d apart always differ by
+    more than threshold once normalized. None if the answer depends on the
+    pixel values themselves and not only on d.
+    """
+    levels = np.arange(256)
+    dist = np.abs(levels[:, None] - levels[None, :])
+    exceeds = np.abs(PIXEL_TABLE[:, None] - PIXEL_TABLE[None, :]) > threshold
+    steps = np.zeros(256, dtype=bool)
+    for d in range(256):
+        steps[d] = exceeds[dist == d].all()
+        if steps[d] != exceeds[dist == d].any():
+            return None
+    return steps
+
+
+def make_pairs(images, resets, ks, threshold=0.5, chunk_size=1024):
+    """
+    Mine the positive pairs for several k at once. Frame i is paired with
+    frame i + k if there is no reset in resets[i:i + k] and some pixel changes
+    by more than threshold (in normalized [-1, 1] units) between the two.
+
+    images is the preloaded image array (uint8 as stored, or already
+    normalized floats), resets a 0/1 array over the same frames. Returns a
+    dict from k to the int64 array of first frames i.
+    """
+    ks = sorted(set(ks))
+    n = len(images)
+    prefix = np.concatenate(([0], np.cumsum(np.asarray(resets) != 0)))
+    steps = _pixel_steps(threshold) if images.dtype == np.uint8 else None
+
+    firsts = {k: [] for k in ks}
+    for start in range(0, n, chunk_size):
+        end = min(start + chunk_size, n)
+        # One read covers the chunk and the frames up to max(ks) after it.
+        chunk = np.asarray(images[start:min(end + ks[-1], n)])
+        if images.dtype == np.uint8 and steps is None:
+            chunk = PIXEL_TABLE[chunk]
+        elif images.dtype == np.uint8:
+            chunk = chunk.astype(np.int16)
+        for k in ks:
+            i = np.arange(start, min(end, n - k))
+            i = i[prefix[i + k] - prefix[i] == 0]
+            if k == 0 or len(i) == 0:
+                continue
+            diff = np.abs(chunk[i + k - start] - chunk[i - start])
+            diff = diff.reshape(len(i), -1).max(axis=1)
+            moved = steps[diff] if steps is not None else diff > threshold
+            firsts[k].append(i[moved])
+    return {k: np.concatenate(firsts[k] + [np.zeros(0, dtype=np.int64)]).astype(np.int64)
+            for k in ks}
+
+
 def make_pair(imgs, resets, k, get_img, root):
     """
     Return a list of image pairs. The pair is picked if they are k steps apart,
@@ -82,6 +458,9 @@ def make_pair(imgs, resets, k, get_img, root):
     Cases:
         If k = -1, we just randomly pick two images.
         If k >= 0, we try to load img pairs that are k frames apart.
+    get_img is either the preloaded image array in the order of imgs, or a
+    function from an image path to its tensor, called once per image.
+    ImagePairs needs no such cache: it draws pairs at any k at sample time.
     """
     if k < 0:
         return list(zip(imgs, np.random.permutation(imgs)))
@@ -91,56 +470,460 @@ def make_pair(imgs, resets, k, get_img, root):
         with open(filename, 'rb') as f:
             return pkl.load(f)
 
+    if callable(get_img):
+        images = np.stack([get_img(img[0]).numpy() for img in tqdm(imgs)], axis=0)
+    else:
+        images = get_img
     image_pairs = []
-    pbar = tqdm(total=len(imgs))
-    for i, img in enumerate(imgs):
-        if np.sum(resets[i:i + k]) == 0 and (get_img(imgs[i + k][0]) - get_img(img[0])).abs().max() > 0.5:
-            next_img = imgs[i + k]
-            image_pairs.append(((img[0], np.array(1.0, dtype='float32')),
-                                (next_img[0], np.array(1.0, dtype='float32'))))
-        pbar.update(1)
-    pbar.close()
+    for i in make_pairs(images, resets, [k])[k]:
+        image_pairs.append(((imgs[i][0], np.array(1.0, dtype='float32')),
+                            (imgs[i + k][0], np.array(1.0, dtype='float32'))))
 
     with open(filename, 'wb') as f:
         pkl.dump(image_pairs, f)
     return image_pairs
 
 
-def make_negative_pairs(imgs, resets, root):
+def episode_bounds(resets):
+    """
+    Return the [start, end) frame range of every episode. An episode ends
+    with a frame whose reset flag is set.
+    """
+    ends = np.flatnonzero(np.asarray(resets)) + 1
+    return np.concatenate(([0], ends[:-1])).astype(np.int64), ends.astype(np.int64)
+
+
+def parse_horizons(n_frames_apart):
+    """
+    Return the horizons ks and their probabilities from n_frames_apart: an
+    int k, a list of ks drawn uniformly, a dict from k to its weight, or a
+    list of strings 'k' or 'k:weight' as given on the command line.
+    """
+    if np.isscalar(n_frames_apart):
+        n_frames_apart = [n_frames_apart]
+    weights = dict()
+    items = n_frames_apart.items() if isinstance(n_frames_apart, dict) \
+        else [str(k).partition(':')[::2] for k in n_frames_apart]
+    for k, w in items:
+        weights[int(k)] = weights.get(int(k), 0.) + float(w or 1)
+    ks = np.array(sorted(weights), dtype=np.int64)
+    probs = np.array([weights[k] for k in ks])
+    if len(ks) == 0 or ks[0] < 1 or probs.min() < 0 or probs.sum() <= 0:
+        raise ValueError('Invalid distribution over k: %s' % (n_frames_apart,))
+    return ks, probs / probs.sum()
+
+
+def episode_steps(pair_run, pair_t):
+    """
+    Group the positive pairs, ordered by run then t, into steps (the pairs of
+    one run and t, which share their first frame) and the steps into episodes
+    (runs). Returns the step of every pair, the first pair and number of
+    pairs of every step, and the [start, end) steps of the episode of every step.
+    """
+    new_step = np.concatenate(([True], (np.diff(pair_run) != 0) | (np.diff(pair_t) != 0)))
+    pair_step = np.cumsum(new_step) - 1
+    step_start = np.flatnonzero(new_step)
+    step_size = np.diff(np.append(step_start, len(pair_run)))
+    new_episode = np.concatenate(([True], np.diff(pair_run[step_start]) != 0))
+    episode_start = np.flatnonzero(new_episode)
+    episode_end = np.append(episode_start[1:], len(step_start))
+    step_episode = np.cumsum(new_episode) - 1
+    return pair_step, step_start, step_size, episode_start[step_episode], episode_end[step_episode]
+
+
+def sample_negatives(resets, anchors=None):
+    """
+    For every anchor frame (all frames by default) draw a frame from a
+    different, uniformly chosen episode, all anchors at once. Frames after
+    the last reset belong to no episode and may draw from any of them.
+    Cheap enough to call again for fresh negatives every epoch.
+    """
+    starts, ends = episode_bounds(resets)
+    if anchors is None:
+        anchors = np.arange(len(resets))
+    anchors = np.asarray(anchors)
+    own = np.searchsorted(ends, anchors, 'right')
+    in_episode = own < len(ends)
+    if in_episode.any() and len(ends) < 2:
+        raise ValueError('Negatives from a different episode need at least two episodes')
+
+    # Draw among the other episodes, then skip over the anchor's own one.
+    episodes = (np.random.random_sample(len(anchors))
+                * np.where(in_episode, len(ends) - 1, len(ends))).astype(np.int64)
+    episodes += in_episode & (episodes >= own)
+    return sample_ranges(starts[episodes], ends[episodes], 1)[:, 0]
+
+
+def make_negative_pairs(imgs, resets, root, resample=False):
     """
     Return a list of negative image pairs. For each pair, the second image is picked
-    from a different episode
+    from a different episode. The draw is cached in rope_neg_pairs.pkl unless
+    resample is set, in which case fresh negatives are drawn on every call.
     """
     filename = os.path.join(root, 'rope_neg_pairs.pkl')
-    if os.path.exists(filename):
+    if not resample and os.path.exists(filename):
         with open(filename, 'rb') as f:
             return pkl.load(f)
 
-    idxs = np.argwhere(resets).reshape(-1)
-    idxs = np.concatenate(([-1], idxs), axis=0)
-    episodes = []
-    for i in range(len(idxs) - 1):
-        episodes.append((idxs[i] + 1, idxs[i + 1] + 1)) # (inclusive, exclusive)
-
     neg_image_pairs = []
-    pbar = tqdm(total=len(imgs))
-    for i, img in enumerate(imgs):
-        ep_idx = np.random.randint(0, len(episodes))
-        while episodes[ep_idx][0] <= i < episodes[ep_idx][1]:
-            ep_idx = np.random.randint(0, len(episodes))
-
-        next_img = np.random.randint(episodes[ep_idx][0], episodes[ep_idx][1])
-        next_img = imgs[next_img]
+    for img, neg in zip(imgs, sample_negatives(resets[:len(imgs)])):
         neg_image_pairs.append(((img[0], np.array(0.0, dtype='float32')),
-                                (next_img[0], np.array(0.0, dtype='float32'))))
-        pbar.update(1)
-    pbar.close()
+                                (imgs[neg][0], np.array(0.0, dtype='float32'))))
 
-    with open(filename, 'wb') as f:
-        pkl.dump(neg_image_pairs, f)
+    if not resample:
+        with open(filename, 'wb') as f:
+            pkl.dump(neg_image_pairs, f)
     return neg_image_pairs
 
 
+def unpack_table(palette, bits):
+    """
+    Table of the 8 // bits palette values packed into each of the 256 byte
+    values, first pixel in the highest bits.
+    """
+    shifts = np.arange(8 - bits, -1, -bits)
+    codes = (np.arange(256)[:, None] >> shifts) & (2 ** bits - 1)
+    return np.asarray(palette, dtype=np.uint8)[codes]
+
+
+class PackedImages(object):
+    """
+    Images quantized to a palette of 2 ** bits gray levels and bit-packed by
+    pack_images.py. Rows are memory-mapped from ``<path>.npy`` and decoded on
+    access with a single lookup of every packed byte into unpack_table, so
+    they read like the uint8 array they replace.
+    """
+
+    def __init__(self, path):
+        with open(path + '.json') as f:
+            meta = json.load(f)
+        self.bits = meta['bits']
+        self.max_error = meta['max_error']
+        self.packed = np.load(path + '.npy', mmap_mode='r')
+        self.shape = (len(self.packed),) + tuple(meta['image_shape'])
+        self.table = unpack_table(meta['palette'], self.bits)
+
+    def __getitem__(self, index):
+        packed = self.packed[index]
+        return self.table[packed].reshape(packed.shape[:-1] + self.shape[1:])
+
+    def __len__(self):
+        return len(self.packed)
+
+
+SHARED_DIR = '/dev/shm'
+
+
+def shared_path(root):
+    """
+    Directory of the shared-memory copy of the dataset at root.
+    """
+    key = hashlib.sha1(os.path.realpath(root).encode()).hexdigest()[:16]
+    return join(SHARED_DIR, 'rope-' + key)
+
+
+def _dataset_files(root):
+    """
+    The image store and index files of the dataset at root, relative to
+    root, with their (size, mtime) to tell whether a copy is up to date.
+    """
+    names = [name for name in ['images.npy', 'images_packed.npy', 'images_packed.json']
+             if os.path.exists(join(root, name))]
+    if os.path.isdir(join(root, 'index')):
+        names += [join('index', name) for name in sorted(os.listdir(join(root, 'index')))]
+    files = dict()
+    for name in names:
+        st = os.stat(join(root, name))
+        files[name] = [st.st_size, st.st_mtime_ns]
+    return files
+
+
+def _shared_files(path):
+    try:
+        with open(join(path, 'source.json')) as f:
+            return json.load(f)['files']
+    except (IOError, ValueError):
+        return None
+
+
+def shared_root(root):
+    """
+    The up-to-date shared-memory copy of root made by share_dataset, or
+    root itself if there is none.
+    """
+    path = shared_path(root)
+    files = _shared_files(path)
+    if files is None:
+        return root
+    if files != _dataset_files(root):
+        print('The shared copy of %s at %s is out of date, reading %s. '
+              'Rerun share_dataset.py.' % (root, path, root))
+        return root
+    return path
+
+
+def share_dataset(root):
+    """
+    Copy the image store and index of the dataset at root into shared memory
+    (a tmpfs directory under SHARED_DIR) once, and return the copy's path.
+    Every ImageStore and PairIndex of root then memory-maps the copy, so the
+    processes of a sweep on one host attach to the same physical pages
+    instead of each reading the dataset, and a new member costs neither RAM
+    nor loading time. Concurrent callers wait for the first one to finish
+    the copy. A copy that is out of date is replaced; processes still
+    attached to it keep their pages until they exit.
+    """
+    files = _dataset_files(root)
+    if 'images.npy' not in files and 'images_packed.npy' not in files:
+        raise IOError('%s has no images.npy to share. Run collect_images.py or '
+                      'convert_images.py first.' % root)
+    path = shared_path(root)
+    with open(path + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if _shared_files(path) == files:
+            return path
+        tmp_path = '%s.tmp%d' % (path, os.getpid())
+        try:
+            makedir_exist_ok(join(tmp_path, 'index'))
+            for name in tqdm(files, desc='Sharing %s' % root):
+                shutil.copyfile(join(root, name), join(tmp_path, name))
+            with open(join(tmp_path, 'source.json'), 'w') as f:
+                json.dump(dict(root=os.path.realpath(root), files=files), f)
+            release_dataset(root)
+            os.rename(tmp_path, path)
+        finally:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+    return path
+
+
+def release_dataset(root):
+    """
+    Remove the shared-memory copy of root. Attached processes are unaffected.
+    """
+    shutil.rmtree(shared_path(root), ignore_errors=True)
+
+
+_max_packed_error = 0
+
+
+def allow_packed_error(max_error):
+    """
+    Let the ImageStores made from now on read lossy bit-packed stores whose
+    pixels are at most max_error gray levels off. Lossless ones always are.
+    """
+    global _max_packed_error
+    _max_packed_error = max_error
+
+
+class ImageStore(object):
+    """
+    Read-only view of the preprocessed uint8 images of a rope dataset.
+
+    The array is memory-mapped from ``images.npy`` so that every dataset and
+    every DataLoader worker reads the same pages of the OS page cache instead
+    of holding a private copy. Opening is lazy and independent of the number
+    of images. Convert an existing ``images.hdf5`` once with
+    ``python convert_images.py <root>``.
+
+    If ``python pack_images.py <root>`` has written a bit-packed copy of the
+    images, it is used instead and decoded on access (see PackedImages). A
+    lossy copy is only used if its error is within max_packed_error, by
+    default the one set with allow_packed_error (0, lossless only).
+
+    If ``python share_dataset.py <root>`` has copied the dataset into shared
+    memory, the copy is mapped instead (see share_dataset); shared is then set.
+    """
+
+    def __init__(self, root, max_packed_error=None):
+        self.root = root
+        self.shared = False
+        self.max_packed_error = _max_packed_error if max_packed_error is None else max_packed_error
+        self._images = None
+
+    @property
+    def images(self):
+        if self._images is None:
+            self._images = self._open()
+        return self._images
+
+    def _open(self):
+        root = shared_root(self.root)
+        self.shared = root != self.root
+        self.path = join(root, 'images.npy')
+        self.packed_path = join(root, 'images_packed')
+        if os.path.exists(self.packed_path + '.json'):
+            packed = PackedImages(self.packed_path)
+            if packed.max_error > self.max_packed_error:
+                if not os.path.exists(self.path):
+                    raise IOError('%s is lossy (max error %d gray levels) and there is no %s. '
+                                  'Allow it with --packed_max_error %d.'
+                                  % (self.packed_path, packed.max_error, self.path, packed.max_error))
+                print('%s is lossy (max error %d gray levels), using %s. '
+                      'Allow it with --packed_max_error.' % (self.packed_path, packed.max_error, self.path))
+            elif not os.path.exists(self.path) or len(packed) == len(np.load(self.path, mmap_mode='r')):
+                print('Reading %s: %d bits per pixel, max error %d gray levels.'
+                      % (self.packed_path, packed.bits, packed.max_error))
+                return packed
+            else:
+                print('%s is out of date, using %s. Rerun pack_images.py.' % (self.packed_path, self.path))
+        if os.path.exists(self.path):
+            return np.load(self.path, mmap_mode='r')
+        h5_path = join(self.root, 'images.hdf5')
+        print('%s not found, loading %s into memory. '
+              'Run convert_images.py to share it between processes.' % (self.path, h5_path))
+        with h5py.File(h5_path, 'r') as f:
+            return f['images'][:]
+
+    @property
+    def shape(self):
+        return self.images.shape
+
+    def __getstate__(self):
+        # Workers re-open the memory map rather than receive a pickled copy.
+        state = self.__dict__.copy()
+        state['_images'] = None
+        return state
+
+    def gather(self, rows):
+        """
+        Fancy-index an array of rows of any shape. Each distinct row is read
+        once and in file order, which keeps memory-mapped reads sequential.
+        """
+        rows = np.asarray(rows)
+        unique, inverse = np.unique(rows.ravel(), return_inverse=True)
+        return self.images[unique][inverse].reshape(rows.shape + self.shape[1:])
+
+    def __getitem__(self, index):
+        return self.images[index]
+
+    def __len__(self):
+        return len(self.images)
+
+
+class ResidentStore(object):
+    """
+    The images of an ImageStore loaded into one uint8 tensor, pinned for fast
+    copies to the GPU if pin_memory is set and CUDA is available. Bit-packed
+    stores stay packed in memory and are decoded per batch with their table.
+    Only the [start, end) image rows are loaded if rows is given.
+    Has the interface of ImageStore, but returns uint8 tensors. Rows are the
+    global rows of the store either way, and len() is that of the whole
+    store; reading a row outside [start, end) raises an IndexError.
+
+    A store in shared memory (see share_dataset) is already resident: it is
+    mapped copy-on-write instead of copied, and not pinned, so that the
+    processes of a sweep keep sharing its pages.
+    """
+
+    def __init__(self, store, pin_memory=False, rows=None):
+        images = store.images
+        self.shape = images.shape
+        self.start, self.end = rows if rows is not None else (0, len(images))
+        end = self.end
+        if isinstance(images, PackedImages):
+            array = images.packed
+            self.table = torch.from_numpy(images.table)
+        else:
+            array = images
+            self.table = None
+        if store.shared:
+            self.tensor = torch.from_numpy(np.load(array.filename, mmap_mode='c')[self.start:end])
+        else:
+            self.tensor = torch.from_numpy(np.array(array[self.start:end]))
+            if pin_memory and torch.cuda.is_available():
+                self.tensor = self.tensor.pin_memory()
+
+    def gather(self, rows):
+        rows = np.asarray(rows, dtype=np.int64)
+        if rows.size and (rows.min() < self.start or rows.max() >= self.end):
+            raise IndexError('Rows %d to %d requested, but only rows %d to %d are resident'
+                             % (rows.min(), rows.max(), self.start, self.end - 1))
+        rows = torch.from_numpy(np.asarray(rows - self.start))
+        images = self.tensor.index_select(0, rows.reshape(-1))
+        if self.table is not None:
+            images = self.table[images.long()]
+        return images.reshape(tuple(rows.shape) + tuple(self.shape[1:]))
+
+    def __getitem__(self, index):
+        return self.gather(np.arange(len(self))[index])
+
+    def __len__(self):
+        return self.shape[0]
+
+
+def is_index_dir(name):
+    """
+    Whether a directory under a dataset root is the pair index of write_index.
+    """
+    return name == 'index' or name.startswith('index.')
+
+
+def write_index(root, arrays):
+    """
+    Write a dict of index arrays to ``<root>/index/<name>.npy``, replacing any
+    previous index only once all arrays are on disk.
+    """
+    path = join(root, 'index')
+    tmp_path = path + '.tmp'
+    makedir_exist_ok(tmp_path)
+    for name, array in arrays.items():
+        np.save(join(tmp_path, name + '.npy'), array)
+    if os.path.exists(path):
+        old_path = path + '.old'
+        os.rename(path, old_path)
+        os.rename(tmp_path, path)
+        for fname in os.listdir(old_path):
+            os.remove(join(old_path, fname))
+        os.rmdir(old_path)
+    else:
+        os.rename(tmp_path, path)
+
+
+class PairIndex(object):
+    """
+    Integer pair/negative index of a rope dataset, written by compute_vine_dset.py.
+
+    Each array lives in its own ``index/<name>.npy`` file and is memory-mapped
+    the first time it is accessed as an attribute, so opening an index costs
+    the same no matter how many pairs it holds.
+
+    Attributes:
+        runs (array): Run directories, indexed by run id.
+        image_paths (array): Image path of every row of the image store.
+        frame_run, frame_t, frame_k (array): Run id, time step and vine branch of every image row.
+        frame_order (array): Image rows grouped by run, then time step.
+        pos_pairs (array): N x 2 image rows of (obs, obs_next).
+        pos_action_idx (array): N x 3 (run id, t, k) locating each pair's action.
+        pos_actions (array): N x 4 float32 actions of the pairs, normalized with ACTION_MEAN and ACTION_STD.
+        pos_neg_t (array): N x 2 [start, end) range of frame_order holding the same-time negatives.
+        pos_neg_run (array): N x 2 [start, end) range of frame_order holding the run of each pair.
+        pos_neg_window (array): N x 2 [start, end) range inside pos_neg_run excluded from the
+            same-trajectory negatives (the time steps of the pair itself).
+    """
+
+    def __init__(self, root):
+        self.path = join(shared_root(root), 'index')
+        if not os.path.isdir(self.path):
+            raise IOError('%s not found. Run python compute_vine_dset.py %s first.' % (self.path, root))
+        self._arrays = dict()
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if name not in self._arrays:
+            path = join(self.path, name + '.npy')
+            if not os.path.exists(path):
+                raise AttributeError('%s has no array %s' % (self.path, name))
+            self._arrays[name] = np.load(path, mmap_mode='r')
+        return self._arrays[name]
+
+    def __getstate__(self):
+        return dict(path=self.path, _arrays=dict())
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+
 class ImagePairs(data.Dataset):
     """
     A copy of ImageFolder from torchvision. Output image pairs that are k steps apart.
@@ -152,31 +935,75 @@ class ImagePairs(data.Dataset):
         target_transform (callable, optional): A function/transform that takes in the
             target and transforms it.
         loader (callable, optional): A function to load an image given its path.
-        n_frames_apart (int): The number of frames between the image pairs. Fixed for now.
+        n_frames_apart (int, list or dict): The number of frames between the image pairs,
+            or a distribution over it to draw from for every pair (see parse_horizons).
+            Pairs more than one step apart are drawn at sample time from the
+            episode arrays of episode_steps, with no precomputation per k.
+        uint8 (bool): Return raw uint8 images and leave normalization to
+            ``normalize_images`` after the transfer to the device.
+        rank, world_size (int): Only use the shard of the pairs and images of this rank
+            (see rank_shard). Sample it with rank_sampler.
+        seed (int): Seed of the draws of k of every batch (see batch_rng).
 
      Attributes:
         classes (list): List of the class names.
         class_to_idx (dict): Dict with items (class_name, class_index).
-        img_pairs (list): List of pairs of (image path, class_index) tuples
+        index (PairIndex): Integer index of the positive pairs.
     """
 
     url = 'https://drive.google.com/uc?export=download&confirm=ypZ7&id=10xovkLQ09BDvhtpD_nqXWFX-rlNzMVl9'
 
     def __init__(self, root, transform=None, target_transform=None,
-                 loader=default_loader, n_frames_apart=1, download=False):
+                 loader=default_loader, n_frames_apart=1, download=False, uint8=False,
+                 rank=0, world_size=1, seed=0):
         self.root = root
-        with open(join(root, 'pos_neg_pairs.pkl'), 'rb') as f:
-            data = pkl.load(f)
-        self.img_pairs = data['pos_pairs']
-        self.image_paths = data['all_images']
-        self.images = h5py.File(join(root, 'images.hdf5'), 'r')['images'][:]
-        self.img2idx = {self.image_paths[i]: i for i in range(len(self.image_paths))}
-
-    def _get_image(self, path):
-        img = self.images[self.img2idx[path]]
-        img = img.astype('float32') / 255
-        img = (img - 0.5) / 0.5
-        return torch.FloatTensor(img)
+        self.uint8 = uint8
+        self.seed = seed
+        self.index = PairIndex(root)
+        self.images = ImageStore(root)
+        self.world_size = world_size
+        (self.pair_start, self.pair_end), self.rows = rank_shard(self.index, rank, world_size)
+        self.ks, self.k_probs = parse_horizons(n_frames_apart)
+        if not np.array_equal(self.ks, [1]):
+            pair_idx = np.asarray(self.index.pos_action_idx[self.pair_start:self.pair_end])
+            self.pair_step, self.step_start, self.step_size, self.step_first, self.step_end = \
+                episode_steps(pair_idx[:, 0], pair_idx[:, 1])
+            length = (self.step_end - self.step_first)[self.pair_step]
+            short = ['%d pairs for k=%d' % ((length < k).sum(), k) for k in self.ks if (length < k).any()]
+            if short:
+                print('%s: episodes too short for some k, %s. These pairs draw k among the ks '
+                      'that fit their episode, or give its longest pair if none does.' % (root, ', '.join(short)))
+
+    def _get_image(self, row):
+        return to_tensor(self.images[row], self.uint8)
+
+    def pair_rows(self, indices):
+        """
+        Image rows of the pairs at indices. With k = 1 these are the positive
+        pairs. Otherwise pair p stands for its step s and branch: k is drawn
+        for it and s is mapped linearly onto the last steps that have k - 1
+        steps of their episode before them, so that the pairs of an episode
+        stay uniform over its valid pairs. The pair then runs from the first
+        frame of the first of the k steps to the same branch of the last one.
+        k is only drawn among the ks that fit the episode of the pair, with
+        their weights renormalized; episodes shorter than every k give their
+        longest pairs. __init__ reports how many pairs that affects.
+        """
+        indices = np.asarray(indices)
+        pos_pairs = self.index.pos_pairs
+        if not hasattr(self, 'pair_step'):
+            return pos_pairs[indices + self.pair_start]
+        rng = batch_rng(self.seed, indices)
+        step = self.pair_step[indices]
+        first, end = self.step_first[step], self.step_end[step]
+        cdf = np.cumsum(self.k_probs * (self.ks <= (end - first)[:, None]), axis=1)
+        u = rng.random_sample(len(indices)) * cdf[:, -1]
+        k = np.where(cdf[:, -1] > 0, self.ks[np.argmax(cdf > u[:, None], axis=1)], end - first)
+        last = first + k - 1 + (step - first) * (end - first - k + 1) // (end - first)
+        branch = (indices - self.step_start[step]) % self.step_size[last]
+        start_rows = pos_pairs[self.step_start[last - k + 1] + self.pair_start, 0]
+        end_rows = pos_pairs[self.step_start[last] + branch + self.pair_start, 1]
+        return np.stack((start_rows, end_rows), axis=1)
 
     def __getitem__(self, index):
         """
@@ -186,156 +1013,518 @@ class ImagePairs(data.Dataset):
         Returns:
             tuple: (image, target) where target is class_index of the target class.
         """
-        img1, img2, _ = self.img_pairs[index]
-        return self._get_image(img1), self._get_image(img2)
+        if not np.isscalar(index):
+            return self.__getitems__(index)
+        row1, row2 = self.pair_rows([index])[0]
+        return self._get_image(row1), self._get_image(row2)
+
+    def __getitems__(self, indices):
+        imgs = to_tensor(self.images.gather(self.pair_rows(indices)), self.uint8)
+        return imgs[:, 0], imgs[:, 1]
 
     def __len__(self):
-        return len(self.img_pairs)
+        return self.pair_end - self.pair_start
 
 
 class NCEVineDataset(data.Dataset):
-    def __init__(self, root, n_neg, transform=None, loader=default_loader):
+    def __init__(self, root, n_neg, transform=None, loader=default_loader, uint8=False,
+                 rank=0, world_size=1, seed=0):
         self.root = root
-        with open(join(root, 'pos_neg_pairs.pkl'), 'rb') as f:
-            data = pkl.load(f)
-        self.nst = data['neg_samples_t']
-        self.nstraj = data['neg_samples_traj']
-        self.pos_pairs = data['pos_pairs']
-        self.image_paths = data['all_images']
-
-        self.images = h5py.File(join(root, 'images.hdf5'), 'r')['images'][:]
-        self.img2idx = {self.image_paths[i]: i for i in range(len(self.image_paths))}
+        self.uint8 = uint8
+        self.seed = seed
+        self.index = PairIndex(root)
+        self.images = ImageStore(root)
+        self.world_size = world_size
+        (self.pair_start, self.pair_end), self.rows = rank_shard(self.index, rank, world_size)
 
         self.transform = transform
         self.loader = loader
         self.n_neg = n_neg
         assert n_neg % 3 == 0
 
-        self.mean = np.array([0.5, 0.5, 0., 0.])
-        self.std = np.array([0.5, 0.5, np.sqrt(2), np.sqrt(2)])
-
-    def _get_image(self, path, preloaded=True):
-        img = self.images[self.img2idx[path]]
-        img = img.astype('float32') / 255
-        img = (img - 0.5) / 0.5
-        return torch.FloatTensor(img)
+        self.mean = ACTION_MEAN
+        self.std = ACTION_STD
 
     def __len__(self):
-        return len(self.pos_pairs)
+        return self.pair_end - self.pair_start
 
     def __getitem__(self, index):
-        obs_file, obs_next_file, action_file = self.pos_pairs[index]
-        obs, obs_next = self._get_image(obs_file), self._get_image(obs_next_file)
-        actions = np.load(action_file)
-
-        fsplit = obs_next_file.split('_')
-        t = int(fsplit[-2])
-        k = int(fsplit[-1].split('.')[0])
-        action = actions[t-1, k]
-        action = (action - self.mean) / self.std
-
+        if not np.isscalar(index):
+            return self.__getitems__(index)
+        # A batch of one, so that the negatives of an index are the same
+        # whichever way it is fetched (see batch_rng).
+        return tuple(x[0] for x in self.__getitems__([index]))
+
+    def __getitems__(self, indices):
+        rng = batch_rng(self.seed, indices)
+        indices = np.asarray(indices) + self.pair_start
+        rows = self.index.pos_pairs[indices]
+        actions = torch.from_numpy(self.index.pos_actions[indices])
         if self.n_neg > 0:
-            run = os.path.dirname(obs_file)
             n_per = self.n_neg // 3
-            nst = self.nst[run][t-1]
-            nstraj = self.nstraj[run][t-1]
+            neg_t = self.index.pos_neg_t[indices]
+            neg_run = self.index.pos_neg_run[indices]
+            neg_window = self.index.pos_neg_window[indices]
 
-            t_idxs = np.random.randint(0, len(nst), size=(n_per,))
-            traj_idxs = np.random.randint(0, len(nstraj), size=(n_per,))
-            other_idxs = np.random.randint(0, len(self.image_paths), size=(n_per,))
+            t_rows = self.index.frame_order[sample_ranges(neg_t[:, 0], neg_t[:, 1], n_per, rng)]
+            traj_rows = self.index.frame_order[sample_ranges_excluding(neg_run[:, 0], neg_run[:, 1],
+                                                                       neg_window[:, 0], neg_window[:, 1],
+                                                                       n_per, rng)]
+            other_rows = rng.randint(self.rows[0], self.rows[1], size=(len(indices), n_per))
+            rows = np.concatenate((rows, t_rows, traj_rows, other_rows), axis=1)
 
-            t_images = [nst[idx] for idx in t_idxs]
-            traj_images = [nstraj[idx] for idx in traj_idxs]
-            other_images = [self.image_paths[idx] for idx in other_idxs]
-            all_images = t_images + traj_images + other_images
-
-            neg_images = torch.stack([self._get_image(img) for img in all_images], dim=0)
-        else:
-            neg_images = 0
-
-        return obs, obs_next, torch.FloatTensor(action), neg_images
+        imgs = to_tensor(self.images.gather(rows), self.uint8)
+        neg_images = imgs[:, 2:] if self.n_neg > 0 else torch.zeros(len(indices), dtype=torch.long)
+        return imgs[:, 0], imgs[:, 1], actions, neg_images
 
 
 class NCEDataset(data.Dataset):
-    def __init__(self, root, n_neg, transform=None, loader=default_loader):
+    def __init__(self, root, n_neg, transform=None, loader=default_loader, uint8=False,
+                 rank=0, world_size=1, seed=0):
         self.root = root
-        with open(join(root, 'pos_neg_pairs.pkl'), 'rb') as f:
-            data = pkl.load(f)
-        self.nst = data['neg_samples_t']
-        self.nstraj = data['neg_samples_traj']
-        self.pos_pairs = data['pos_pairs']
-        self.image_paths = data['all_images']
-
-        self.images = h5py.File(join(root, 'images.hdf5'), 'r')['images'][:]
-        self.img2idx = {self.image_paths[i]: i for i in range(len(self.image_paths))}
+        self.uint8 = uint8
+        self.seed = seed
+        self.index = PairIndex(root)
+        self.images = ImageStore(root)
+        self.world_size = world_size
+        (self.pair_start, self.pair_end), self.rows = rank_shard(self.index, rank, world_size)
 
         self.transform = transform
         self.loader = loader
         self.n_neg = n_neg
 
-        self.mean = np.array([0.5, 0.5, 0., 0.])
-        self.std = np.array([0.5, 0.5, np.sqrt(2), np.sqrt(2)])
-
-    def _get_image(self, path, preloaded=True):
-        img = self.images[self.img2idx[path]]
-        img = img.astype('float32') / 255
-        img = (img - 0.5) / 0.5
-        return torch.FloatTensor(img)
+        self.mean = ACTION_MEAN
+        self.std = ACTION_STD
 
     def __len__(self):
-        return len(self.pos_pairs)
+        return self.pair_end - self.pair_start
 
     def __getitem__(self, index):
-        obs_file, obs_next_file, action_file = self.pos_pairs[index]
-        obs, obs_next = self._get_image(obs_file), self._get_image(obs_next_file)
-        actions = np.load(action_file)
+        if not np.isscalar(index):
+            return self.__getitems__(index)
+        # A batch of one, so that the negatives of an index are the same
+        # whichever way it is fetched (see batch_rng).
+        return tuple(x[0] for x in self.__getitems__([index]))
 
-        fsplit = obs_next_file.split('_')
-        t = int(fsplit[-2])
-        k = int(fsplit[-1].split('.')[0])
-        action = actions[t-1, k]
-        action = (action - self.mean) / self.std
+    def __getitems__(self, indices):
+        rng = batch_rng(self.seed, indices)
+        indices = np.asarray(indices) + self.pair_start
+        other_rows = rng.randint(self.rows[0], self.rows[1], size=(len(indices), self.n_neg))
+        rows = np.concatenate((self.index.pos_pairs[indices], other_rows), axis=1)
 
-        other_idxs = np.random.randint(0, len(self.image_paths), size=(self.n_neg,))
-        other_images = [self.image_paths[idx] for idx in other_idxs]
+        imgs = to_tensor(self.images.gather(rows), self.uint8)
+        return imgs[:, 0], imgs[:, 1], torch.from_numpy(self.index.pos_actions[indices]), imgs[:, 2:]
 
-        neg_images = torch.stack([self._get_image(img) for img in other_images], dim=0)
 
-        return obs, obs_next, torch.FloatTensor(action), neg_images
+class ReadAhead(object):
+    """
+    Iterate over fn(item) for the items, computed by a background thread up
+    to depth results ahead of the consumer.
+    """
+
+    def __init__(self, fn, items, depth=2):
+        self.fn = fn
+        self.items = items
+        self.depth = depth
+
+    def _produce(self, results, stop):
+        try:
+            for item in self.items:
+                result = (True, self.fn(item))
+                while not stop.is_set():
+                    try:
+                        results.put(result, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if stop.is_set():
+                    return
+        except Exception as e:
+            results.put((False, e))
+            return
+        results.put((False, None))
+
+    def __iter__(self):
+        results, stop = queue.Queue(maxsize=self.depth), threading.Event()
+        thread = threading.Thread(target=self._produce, args=(results, stop))
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                ok, result = results.get()
+                if not ok:
+                    if result is not None:
+                        raise result
+                    return
+                yield result
+        finally:
+            stop.set()
+
+
+class StreamingVineDataset(data.IterableDataset):
+    """
+    Streaming variant of ImagePairs / NCEVineDataset for captures that do not
+    fit in memory. Memory use is set by the arguments, not by the dataset size.
+
+    The pairs are split into shards of shard_size consecutive pairs. A shard
+    is loaded with one sequential read of the image rows of the runs its pairs
+    belong to, so its same-time and same-trajectory negatives are drawn from
+    the shard exactly as NCEVineDataset draws them. The remaining third of
+    the negatives comes from a rolling reservoir of reservoir_size images
+    sampled uniformly from the shards read so far. Shards are visited in
+    random order and read by a background thread up to read_ahead shards
+    ahead. Batches are drawn from a shuffle buffer holding about buffer_size
+    pairs of the most recent shards.
+
+    Yields whole batches (obs, obs_next, action, neg) like __getitems__ of
+    NCEVineDataset, so use it with a DataLoader with batch_size=None.
+    DataLoader workers each stream their own subset of the shards.
+    """
+
+    def __init__(self, root, n_neg=0, batch_size=128, drop_last=True, shard_size=4096,
+                 buffer_size=16384, reservoir_size=8192, read_ahead=2, uint8=False):
+        assert n_neg % 3 == 0
+        self.root = root
+        self.uint8 = uint8
+        self.index = PairIndex(root)
+        self.images = ImageStore(root)
+        self.n_neg = n_neg
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        self.shard_size = shard_size
+        self.n_buffer_shards = max(1, -(-buffer_size // shard_size))
+        self.reservoir_size = reservoir_size
+        self.read_ahead = read_ahead
+
+        self.mean = ACTION_MEAN
+        self.std = ACTION_STD
+
+    def __len__(self):
+        # Number of pairs, like the other datasets.
+        return len(self.index.pos_pairs)
+
+    def _read_shard(self, start):
+        end = min(start + self.shard_size, len(self))
+        shard = dict(pairs=np.array(self.index.pos_pairs[start:end]),
+                     actions=np.array(self.index.pos_actions[start:end]))
+        row_lo, row_hi = shard['pairs'].min(), shard['pairs'].max() + 1
+        if self.n_neg > 0:
+            for name in ['pos_neg_t', 'pos_neg_run', 'pos_neg_window']:
+                shard[name] = np.array(getattr(self.index, name)[start:end])
+            # Runs are contiguous in frame_order and in the image rows.
+            order_lo, order_hi = shard['pos_neg_run'][:, 0].min(), shard['pos_neg_run'][:, 1].max()
+            shard['order'] = np.array(self.index.frame_order[order_lo:order_hi])
+            shard['order_lo'] = order_lo
+            row_lo = min(row_lo, shard['order'].min())
+            row_hi = max(row_hi, shard['order'].max() + 1)
+        shard['block'] = np.array(self.images[row_lo:row_hi])
+        shard['row_lo'] = row_lo
+        return shard
+
+    def _update_reservoir(self, block):
+        """
+        Reservoir sampling of the images of a new shard, vectorized over the
+        block: image j of the stream replaces a random slot with probability
+        reservoir_size / (j + 1).
+        """
+        n_seen = self.n_seen + np.arange(len(block))
+        slots = (np.random.random_sample(len(block)) * (n_seen + 1)).astype(np.int64)
+        keep = slots < self.reservoir_size
+        if self.reservoir is None:
+            self.reservoir = np.zeros((self.reservoir_size,) + block.shape[1:], dtype=block.dtype)
+        fill = n_seen < self.reservoir_size
+        slots[fill] = n_seen[fill]
+        self.reservoir[slots[keep | fill]] = block[keep | fill]
+        self.n_seen += len(block)
+
+    def _get_batch(self, shard, idx):
+        rows = shard['pairs'][idx]
+        imgs = shard['block'][rows - shard['row_lo']]
+        actions = shard['actions'][idx]
+        if self.n_neg == 0:
+            return imgs, actions, None
+        n_per = self.n_neg // 3
+        neg_t, neg_run, neg_window = shard['pos_neg_t'][idx], shard['pos_neg_run'][idx], shard['pos_neg_window'][idx]
+        t_pos = sample_ranges(neg_t[:, 0], neg_t[:, 1], n_per)
+        traj_pos = sample_ranges_excluding(neg_run[:, 0], neg_run[:, 1], neg_window[:, 0], neg_window[:, 1], n_per)
+        neg_rows = shard['order'][np.concatenate((t_pos, traj_pos), axis=1) - shard['order_lo']]
+        other = np.random.randint(0, min(self.n_seen, self.reservoir_size), size=(len(idx), n_per))
+        negs = np.concatenate((shard['block'][neg_rows - shard['row_lo']], self.reservoir[other]), axis=1)
+        return imgs, actions, negs
+
+    def _make_batch(self, entries, shards):
+        imgs, actions, negs = [], [], []
+        for shard_id in np.unique(entries[:, 0]):
+            batch = self._get_batch(shards[shard_id], entries[entries[:, 0] == shard_id, 1])
+            imgs.append(batch[0])
+            actions.append(batch[1])
+            negs.append(batch[2])
+        imgs = to_tensor(np.concatenate(imgs), self.uint8)
+        actions = torch.from_numpy(np.concatenate(actions))
+        if self.n_neg > 0:
+            negs = to_tensor(np.concatenate(negs), self.uint8)
+        else:
+            negs = torch.zeros(len(entries), dtype=torch.long)
+        return imgs[:, 0], imgs[:, 1], actions, negs
+
+    def __iter__(self):
+        starts = np.arange(0, len(self), self.shard_size)
+        worker = data.get_worker_info()
+        if worker is None:
+            np.random.shuffle(starts)
+        else:
+            # All workers shuffle with their common base seed, then split.
+            starts = np.random.RandomState((worker.seed - worker.id) % 2 ** 32).permutation(starts)
+            starts = starts[worker.id::worker.num_workers]
+        self.reservoir, self.n_seen = None, 0
+
+        shards, remaining, next_id = dict(), dict(), 0
+        pool = np.zeros((0, 2), dtype=np.int64)
+        reader = iter(ReadAhead(self._read_shard, starts, depth=self.read_ahead))
+        exhausted = False
+        while True:
+            # Refill the shuffle buffer whenever a shard has been used up.
+            while not exhausted and (len(shards) < self.n_buffer_shards or len(pool) < self.batch_size):
+                shard = next(reader, None)
+                if shard is None:
+                    exhausted = True
+                    break
+                shards[next_id], remaining[next_id] = shard, len(shard['pairs'])
+                self._update_reservoir(shard['block'])
+                entries = np.stack((np.full(len(shard['pairs']), next_id), np.arange(len(shard['pairs']))), axis=1)
+                pool = np.concatenate((pool, entries))
+                pool = pool[np.random.permutation(len(pool))]
+                next_id += 1
+
+            if len(pool) == 0 or (len(pool) < self.batch_size and self.drop_last):
+                return
+            entries, pool = pool[-self.batch_size:], pool[:-self.batch_size]
+            yield self._make_batch(entries, shards)
+
+            for shard_id, count in zip(*np.unique(entries[:, 0], return_counts=True)):
+                remaining[shard_id] -= count
+                if remaining[shard_id] == 0:
+                    del shards[shard_id], remaining[shard_id]
 
 
 class ImageDataset(data.Dataset):
     def __init__(self, root, transform=None, loader=default_loader,
-                 include_state=False):
+                 include_state=False, uint8=False):
         self.root = root
-        with open(join(root, 'pos_neg_pairs.pkl'), 'rb') as f:
-            data = pkl.load(f)
-        self.image_paths = data['all_images']
+        self.uint8 = uint8
+        self.index = PairIndex(root)
+        self.image_paths = self.index.image_paths
         self.include_state = include_state
 
-        self.images = h5py.File(join(root, 'images.hdf5'), 'r')['images'][:]
-        self.img2idx = {self.image_paths[i]: i for i in range(len(self.image_paths))}
+        self.images = ImageStore(root)
+        self._img2idx = None
 
         self.transform = transform
         self.loader = loader
 
     def _get_image(self, index):
-        img = self.images[index]
-        img = img.astype('float32') / 255
-        img = (img - 0.5) / 0.5
-        return torch.FloatTensor(img)
+        return to_tensor(self.images[index], self.uint8)
 
     def __len__(self):
         return len(self.image_paths)
 
     def __getitem__(self, index):
+        if not np.isscalar(index):
+            return self.__getitems__(index)
         if self.include_state:
-            img_path = self.image_paths[index]
+            img_path = str(self.image_paths[index])
             folder = os.path.dirname(img_path)
             states = np.load(join(folder, 'env_states.npy'))
-            t = int(img_path.split('_')[-2])
-            return self._get_image(index), self.transform(self.loader(self.image_paths[index])), torch.FloatTensor(states[t])
+            t = self.index.frame_t[index]
+            return self._get_image(index), self.transform(self.loader(img_path)), torch.FloatTensor(states[t])
         return self._get_image(index)
 
+    def __getitems__(self, indices):
+        if self.include_state:
+            return data.dataloader.default_collate([self[i] for i in indices])
+        return to_tensor(self.images.gather(indices), self.uint8)
+
+    @property
+    def img2idx(self):
+        # Only built on demand: path lookups are not needed for training.
+        if self._img2idx is None:
+            self._img2idx = {str(path): i for i, path in enumerate(self.image_paths)}
+        return self._img2idx
+
     def get_item_by_path(self, path):
         return self[self.img2idx[path]]
+
+
+def file_hash(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+# Transforms whose repr holds every parameter of what they compute, so that
+# it can key a cache. Others, such as transforms.Lambda (whose repr is just
+# 'Lambda()'), disable the cache.
+CACHEABLE_TRANSFORMS = (transforms.Resize, transforms.CenterCrop, transforms.ToTensor,
+                        transforms.Grayscale, transforms.Normalize,
+                        rope_transforms.FilterBackground, rope_transforms.Grayscale,
+                        rope_transforms.Dilate, rope_transforms.Normalize)
+
+
+def cacheable_transform(transform):
+    """
+    Whether transform is one of CACHEABLE_TRANSFORMS, or a Compose of them.
+    """
+    if isinstance(transform, transforms.Compose):
+        return all(cacheable_transform(t) for t in transform.transforms)
+    return type(transform) in CACHEABLE_TRANSFORMS
+
+
+class CachedImageFolder(ImageFolder):
+    """
+    ImageFolder that keeps the transformed images in a memory-mapped cache,
+    so that every image is decoded and transformed once instead of on every
+    access, across epochs, workers and runs.
+
+    Cache entries are keyed on the content hash of the image file and live
+    in ``<cache_dir>/<transform signature>/``, where the signature is a hash
+    of repr(transform). Changing the transform therefore starts a new cache,
+    and identical images under different paths or roots share an entry.
+    File hashes are remembered by (size, mtime) in ``<cache_dir>/files.json``
+    so that unchanged files are not read again to open the dataset.
+
+    Entries are filled on first access by whichever process reads them,
+    without a lock: a worker writes the tensor of an entry before marking it
+    valid, and _grow copies the valid flags before the tensors, so an entry
+    is never marked valid without its tensor. Writes that race with _grow may
+    be lost, and are then redone on a later access. Only compositions of
+    CACHEABLE_TRANSFORMS are cached; other transforms (such as lambdas)
+    disable the cache with a warning.
+
+    Args:
+        root (string): Root directory path, as for ImageFolder.
+        transform (callable): Deterministic transform returning a tensor.
+        cache_dir (string, optional): Cache directory, by default ``.image_cache`` next to
+            root (not inside it, where ImageFolder would take it for a class), so that
+            sibling roots such as train_data and test_data share it.
+    """
+
+    def __init__(self, root, transform=None, target_transform=None, loader=default_loader,
+                 cache_dir=None):
+        super(CachedImageFolder, self).__init__(root, transform=transform,
+                                                target_transform=target_transform, loader=loader)
+        self.cache_dir = cache_dir or join(dirname(os.path.abspath(root)), '.image_cache')
+        signature = repr(transform)
+        self.enabled = cacheable_transform(transform) and len(self.samples) > 0
+        if not self.enabled:
+            if len(self.samples) > 0:
+                print('Transform %s uses transforms outside CACHEABLE_TRANSFORMS, not caching %s' % (signature, root))
+            return
+        self.path = join(self.cache_dir, hashlib.sha1(signature.encode()).hexdigest()[:16])
+        makedir_exist_ok(self.path)
+        with open(join(self.path, 'signature.txt'), 'w') as f:
+            f.write(signature)
+        with open(join(self.cache_dir, 'lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self.rows = self._assign_rows([self._hash(path) for path, _ in self.samples])
+        self._tensors, self._valid = None, None
+
+    def find_classes(self, directory):
+        # The pair index of compute_vine_dset.py (and its .tmp/.old copies
+        # while it is rewritten) lives in <root>/index; it is not a class.
+        classes = sorted(entry.name for entry in os.scandir(directory)
+                         if entry.is_dir() and not is_index_dir(entry.name))
+        if not classes:
+            raise FileNotFoundError("Couldn't find any class folder in %s." % directory)
+        return classes, {name: i for i, name in enumerate(classes)}
+
+    # torchvision < 0.10 calls the private name.
+    _find_classes = find_classes
+
+    def _hash(self, path):
+        stat = os.stat(path)
+        key = os.path.abspath(path)
+        entry = self._file_hashes.get(key)
+        if entry is None or entry[:2] != [stat.st_size, stat.st_mtime_ns]:
+            entry = [stat.st_size, stat.st_mtime_ns, file_hash(path)]
+            self._file_hashes[key] = entry
+        return entry[2]
+
+    @property
+    def _file_hashes(self):
+        if '_hashes' not in self.__dict__:
+            path = join(self.cache_dir, 'files.json')
+            self._hashes = json.load(open(path)) if os.path.exists(path) else dict()
+        return self._hashes
+
+    def _assign_rows(self, hashes):
+        """
+        Return the cache row of every sample, adding rows for new content.
+        """
+        with open(join(self.cache_dir, 'files.json.tmp'), 'w') as f:
+            json.dump(self._file_hashes, f)
+        os.rename(join(self.cache_dir, 'files.json.tmp'), join(self.cache_dir, 'files.json'))
+
+        paths = [join(self.path, name + '.npy') for name in ['hashes', 'tensors', 'valid']]
+        if all(os.path.exists(path) for path in paths):
+            known = list(np.load(paths[0]))
+            n_tensors, n_valid = [len(np.load(path, mmap_mode='r')) for path in paths[1:]]
+            if not n_tensors == n_valid == len(known):
+                known = []
+        else:
+            known = []
+        row_of = {h: i for i, h in enumerate(known)}
+        new = sorted(set(hashes) - set(row_of))
+        if new:
+            self._grow(known, new, paths)
+            row_of.update({h: len(known) + i for i, h in enumerate(new)})
+        return np.array([row_of[h] for h in hashes], dtype=np.int64)
+
+    def _grow(self, known, new, paths):
+        n_old = len(known)
+        sample = np.asarray(self.transform(self.loader(self.samples[0][0])))
+        tensors = np.lib.format.open_memmap(paths[1] + '.tmp', mode='w+', dtype=sample.dtype,
+                                            shape=(n_old + len(new),) + sample.shape)
+        valid = np.lib.format.open_memmap(paths[2] + '.tmp', mode='w+', dtype=np.uint8,
+                                          shape=(n_old + len(new),))
+        if n_old:
+            old_tensors, old_valid = np.load(paths[1], mmap_mode='r'), np.load(paths[2], mmap_mode='r')
+            # Workers fill entries meanwhile, tensor first. Copying the flags
+            # first means every entry copied as valid has its tensor copied too.
+            valid[:n_old] = old_valid
+            for i in range(0, n_old, 4096):
+                tensors[i:min(i + 4096, n_old)] = old_tensors[i:i + 4096]
+        tensors.flush()
+        valid.flush()
+        del tensors, valid
+        np.save(paths[0] + '.tmp.npy', np.array(known + new))
+        os.rename(paths[1] + '.tmp', paths[1])
+        os.rename(paths[2] + '.tmp', paths[2])
+        os.rename(paths[0] + '.tmp.npy', paths[0])
+
+    def __getstate__(self):
+        # Workers re-open the memory maps rather than receive pickled copies.
+        state = self.__dict__.copy()
+        state['_tensors'], state['_valid'] = None, None
+        state.pop('_hashes', None)
+        return state
+
+    def __getitem__(self, index):
+        if not self.enabled:
+            return super(CachedImageFolder, self).__getitem__(index)
+        if self._tensors is None:
+            self._tensors = np.load(join(self.path, 'tensors.npy'), mmap_mode='r+')
+            self._valid = np.load(join(self.path, 'valid.npy'), mmap_mode='r+')
+        path, target = self.samples[index]
+        row = self.rows[index]
+        if self._valid[row]:
+            sample = torch.from_numpy(np.array(self._tensors[row]))
+        else:
+            sample = self.transform(self.loader(path))
+            # The tensor before the flag, see _grow.
+            self._tensors[row] = np.asarray(sample)
+            self._valid[row] = 1
+        if self.target_transform is not None:
+            target = self.target_transform(target)
+        return sample, target
@@ -1,5 +1,4 @@
 from os.path import join
-from scipy.ndimage.morphology import grey_dilation
 
 import torch
 import torch.utils.data as data
@@ -7,24 +6,26 @@ import torch.utils.data as data
 from torchvision import transforms
 from torchvision.datasets import ImageFolder
 
-from dataset import NCEDataset
+from dataset import NCEDataset, batch_loader
 from model import FCN_mse
+from runtime import get_runtime
 
 batch_size = 128
 name = 'z16_n15_mlptrans_novine'
 root = 'data/rope/'
 n_neg = 15
-encoder = torch.load(join('out', name, 'encoder.pt'), map_location='cuda')
-trans = torch.load(join('out', name, 'trans.pt'), map_location='cuda')
+runtime = get_runtime()
+encoder = runtime.load(join('out', name, 'encoder.pt'))
+trans = runtime.load(join('out', name, 'trans.pt'))
 
 train_dset = NCEDataset(root=join(root, 'train_data'), n_neg=n_neg)
-train_loader = data.DataLoader(train_dset, batch_size=batch_size, shuffle=True)
+train_loader = batch_loader(train_dset, batch_size, shuffle=True)
 
 encoder.train()
 trans.train()
 with torch.no_grad():
     batch = next(iter(train_loader))
-    obs, obs_pos, actions, obs_neg = [b.cuda() for b in batch]
+    obs, obs_pos, actions, obs_neg = [runtime.tensor(b) for b in batch]
     bs = obs.shape[0]
 
     #z, z_pos = encoder(obs), encoder(obs_pos)  # b x z_dim
@@ -59,7 +60,7 @@ with torch.no_grad():
     z_neg = z_neg.view(bs, n_neg, -1).permute(0, 2, 1).contiguous() # b x z_dim x n
     neg_log_density = torch.bmm(z_next, z_neg).squeeze(1)  # b x n
 
-    loss = torch.cat((torch.zeros(bs, 1).cuda(), neg_log_density - pos_log_density), dim=1)  # b x n+1
+    loss = torch.cat((torch.zeros(bs, 1, device=runtime.device), neg_log_density - pos_log_density), dim=1)  # b x n+1
     loss = torch.logsumexp(loss, dim=1).mean()
 
     print('loss', loss.item())
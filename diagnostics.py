@@ -0,0 +1,190 @@
+"""
+Diagnostics of the training loops: statistics that are only logged, never
+trained on. Each metric is declared once with a function that computes it
+from the tensors of a step, and runs only on the steps that log it, so the
+other steps pay nothing for it.
+
+Which metrics run, and how often, is set per metric with specs like
+    ['losses', 'posterior:500', 'transition:0']
+where a bare name uses the default interval and an interval of 0 turns the
+metric off. Metrics not named keep the default interval.
+
+Metrics stay tensors on the device: nothing in the training step waits for
+them. A MetricsWriter copies them to the host without blocking and reads,
+stores and prints them on a background thread; flush() it before reading
+the numbers, e.g. at the end of an epoch.
+"""
+
+import math
+import queue
+import threading
+from collections import OrderedDict
+
+import torch
+
+
+def parse_diagnostics(specs, default_interval):
+    """
+    Map 'name' and 'name:interval' specs to {name: interval}.
+    """
+    intervals = OrderedDict()
+    for spec in specs or []:
+        name, _, interval = spec.partition(':')
+        intervals[name] = int(interval) if interval else default_interval
+    return intervals
+
+
+class Diagnostics(object):
+    """
+    Args:
+        specs (list): 'name' or 'name:interval' entries, see parse_diagnostics.
+        interval (int): Steps between two logs of a metric by default.
+    """
+
+    def __init__(self, specs=None, interval=100):
+        self.interval = interval
+        self.intervals = parse_diagnostics(specs, interval)
+        self.metrics = OrderedDict()
+
+    def declare(self, name, fn):
+        """
+        Declare a metric. fn(step, metrics) writes its entries into metrics, as
+        device tensors computed from the tensors in the step dict, and returns
+        the names of the ones to print.
+        """
+        self.metrics[name] = fn
+
+    def check(self):
+        unknown = set(self.intervals) - set(self.metrics)
+        assert not unknown, 'Unknown diagnostics %s, declared: %s' % (sorted(unknown), list(self.metrics))
+
+    def get_interval(self, name):
+        return self.intervals.get(name, self.interval)
+
+    def due(self, itr):
+        """
+        The metrics to compute at iteration itr.
+        """
+        due = []
+        for name in self.metrics:
+            interval = self.get_interval(name)
+            if interval > 0 and itr % interval == 0:
+                due.append(name)
+        return due
+
+    def log(self, itr, metrics, step):
+        """
+        Compute the metrics due at itr into metrics, from step, a dict of
+        the tensors of the step. Returns the names of the entries to print.
+        """
+        printed = []
+        for name in self.due(itr):
+            printed.extend(self.metrics[name](step, metrics) or [])
+        return printed
+
+
+def percentiles(torch_var, qs):
+    """
+    np.percentile (linear interpolation) of all the entries of torch_var, as
+    tensors on its device. The positions are known from the shape, so unlike
+    torch.quantile this never waits for the device.
+    """
+    x = torch_var.detach().float().flatten().sort()[0]
+    n = x.numel()
+    out = []
+    for q in qs:
+        pos = (n - 1) * q / 100.
+        lo = int(math.floor(pos))
+        hi = min(lo + 1, n - 1)
+        out.append(x[lo] + (x[hi] - x[lo]) * (pos - lo))
+    return out
+
+
+def write_stats(metrics, torch_var, name, idx=None):
+    """
+    utils.write_stats_from_var on the device: writes the 0/25/50/75/100th
+    percentiles of torch_var (or of its column idx) into metrics as tensors,
+    for a MetricsWriter to read.
+    """
+    if idx is not None:
+        assert type(idx) == int
+        assert len(torch_var.size()) == 2
+        torch_var, name = torch_var[:, idx], '%d_%s' % (idx, name)
+    qs = [0, 25, 50, 75, 100]
+    for q, value in zip(qs, percentiles(torch_var, qs)):
+        metrics['%s_%d' % (name, q)] = value
+
+
+def grad_norm(parameters):
+    """
+    L2 norm of the gradients of parameters, as a device tensor.
+    """
+    norms = [p.grad.detach().norm(2) for p in parameters if p.grad is not None]
+    return torch.stack(norms).norm(2)
+
+
+class MetricsWriter(object):
+    """
+    Reads device metrics on a background thread, so that logging never
+    blocks the training step.
+
+    Args:
+        log_dict (OrderedDict): Where the numbers are stored, by name.
+    """
+
+    def __init__(self, log_dict=None):
+        self.log_dict = OrderedDict() if log_dict is None else log_dict
+        self.queue = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def put(self, metrics, callback=None):
+        """
+        Hand over metrics, an OrderedDict of scalar device tensors. They are
+        copied to the host without a sync; the writer thread then stores them
+        in log_dict and calls callback with an OrderedDict of the numbers.
+        """
+        names = list(metrics)
+        values = torch.stack([v.detach().float().reshape(()) for v in metrics.values()])
+        event = None
+        if values.is_cuda:
+            host = torch.empty(values.shape, pin_memory=True)
+            host.copy_(values, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record()
+            values = host
+        self.queue.put((names, values, event, callback))
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                names, values, event, callback = item
+                if event is not None:
+                    event.synchronize()
+                # Plain floats, so log_dict holds no tensors.
+                values = OrderedDict(zip(names, [float(v) for v in values.tolist()]))
+                self.log_dict.update(values)
+                if callback is not None:
+                    callback(values)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        """
+        Wait until every metric handed over is in log_dict.
+        """
+        self.queue.join()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def close(self):
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
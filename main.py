@@ -1,6 +1,9 @@
 import sys
 import argparse
 from trainer import Trainer
+import trainer_wgan
+from dataset import share_dataset, allow_packed_error
+import runtime
 from model import *
 parser = argparse.ArgumentParser()
 
@@ -68,11 +71,40 @@ parser.add_argument("-qtype", type=int, default=1,
                     help="which architecture of posterior to use")
 parser.add_argument("-tsize", type=int, default=[64, 64], nargs="+",
                     help="hidden size of Transition NN.")
-parser.add_argument("-k", type=int, default=1,
-                    help="the number of timesteps apart for training")
+parser.add_argument("-k", type=str, default=["1"], nargs="+",
+                    help="the number of timesteps apart for training, or a distribution "
+                         "over it drawn per pair: several ks drawn uniformly, or k:weight "
+                         "entries, e.g. -k 1:0.5 2:0.25 4:0.25")
 parser.add_argument("-color", action="store_true")
+parser.add_argument("-log_interval", type=int, default=100,
+                    help="iterations between two logs of the diagnostics, a multiple of 5 with -wgan.")
+parser.add_argument("-diagnostics", type=str, default=None, nargs="+",
+                    help="per-diagnostic log intervals as name or name:interval, 0 to turn one off, "
+                         "e.g. -diagnostics posterior:500 transition:0. The diagnostics are losses, "
+                         "posterior and transition; unnamed ones use -log_interval.")
+parser.add_argument("-wgan", action="store_true",
+                    help="train with the WGAN-GP objective and a LargeD critic instead of the BCE discriminator.")
 parser.add_argument("-learn_mu", action="store_true")
 parser.add_argument("-learn_var", action="store_true")
+parser.add_argument("-uint8", action="store_true",
+                    help="load raw uint8 images and normalize them on the GPU.")
+parser.add_argument("-resident", action="store_true",
+                    help="hold the images in memory and gather batches in the main process "
+                         "instead of DataLoader workers.")
+parser.add_argument("-share", action="store_true",
+                    help="map the dataset from a shared-memory copy, made by the first "
+                         "run that needs it, so that concurrent runs share one copy.")
+parser.add_argument("-packed_max_error", type=int, default=0,
+                    help="read a lossy images_packed.npy of pack_images.py if its error is "
+                         "within this many gray levels.")
+
+parser.add_argument("-ckpt_interval", type=int, default=0,
+                    help="also checkpoint every this many iterations, not only after every epoch.")
+parser.add_argument("-resume", action="store_true",
+                    help="continue from the checkpoint in the output folder at the iteration where it stopped.")
+
+# Device
+runtime.add_arguments(parser, dash='-')
 
 # Planning
 parser.add_argument("-planning_epoch", type=int, default=[0], nargs="+",
@@ -104,6 +136,10 @@ if args.prefix is None:
         str_list.append("mu")
     if args.learn_var:
         str_list.append("var")
+    if args.wgan:
+        str_list.append("wgan")
+    if args.bf16 or args.fp16:
+        str_list.append("bf16" if args.bf16 else "fp16")
     args.prefix = "-".join(str_list)
     print("Experiment name : ", args.prefix)
 kwargs['python_cmd'] = " ".join(sys.argv)
@@ -114,11 +150,15 @@ if kwargs['gray'] or kwargs['fcnpath']:
 else:
     kwargs['channel_dim'] = channel_dim = 3
 
+allow_packed_error(args.packed_max_error)
+if args.share:
+    share_dataset(args.data_dir)
+rt = runtime.from_args(args)
+
 # Set initial seed
 seed = kwargs['seed']
 np.random.seed(seed)
-torch.manual_seed(seed)
-torch.cuda.manual_seed(seed)
+rt.manual_seed(seed)
 torch.backends.cudnn.deterministic = True
 
 # Make output folders
@@ -138,7 +178,7 @@ c_dim = kwargs['cont_code_dim']
 z_dim = kwargs['random_noise_dim']
 
 g = G(c_dim, z_dim, kwargs['gtype'], channel_dim)
-d = D(kwargs['dtype'], channel_dim)
+d = (LargeD if kwargs['wgan'] else D)(kwargs['dtype'], channel_dim)
 q = GaussianPosterior(c_dim, kwargs['qtype'], channel_dim)
 t = GaussianTransition(c_dim,
                        hidden=kwargs['tsize'],
@@ -148,8 +188,8 @@ p = UniformDistribution(kwargs['cont_code_dim'])
 var_list = [g, d, q, t, p]
 kwargs['classifier'] = get_causal_classifier(kwargs['classifier_path'], default=d)
 if kwargs['fcnpath']:
-    fcn_model = FCN_mse(n_class=2).cuda()
-    fcn_model.load_state_dict(torch.load(os.path.join(kwargs['fcnpath'])))
+    fcn_model = rt.module(FCN_mse(n_class=2))
+    fcn_model.load_state_dict(rt.load(os.path.join(kwargs['fcnpath'])))
     fcn_model.eval()
     kwargs['fcn'] = fcn_model
 
@@ -158,15 +198,15 @@ loadpath = kwargs['loadpath']
 loadepoch = kwargs['loadepoch']
 for i in var_list:
     print(i)
-    i.cuda()
+    rt.module(i)
     #i.apply(weights_init)
     if loadpath:
         if i not in [p]:
             try:
-                i.load_state_dict(torch.load(os.path.join(loadpath,
-                                                          'var',
-                                                          '%s_%d' % (i.__class__.__name__,
-                                                                     loadepoch))))
+                i.load_state_dict(rt.load(os.path.join(loadpath,
+                                                       'var',
+                                                       '%s_%d' % (i.__class__.__name__,
+                                                                  loadepoch))))
                 print("Loaded var %s from iter %d." % (i.__class__.__name__,
                                                        loadepoch))
             except FileNotFoundError as e:
@@ -174,5 +214,5 @@ for i in var_list:
                 pass
 
 # Training the variables
-trainer = Trainer(*var_list, **kwargs)
+trainer = (trainer_wgan.Trainer if kwargs['wgan'] else Trainer)(*var_list, **kwargs)
 trainer.train()
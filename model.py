@@ -6,6 +6,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torch.autograd as autograd
 from utils import from_numpy_to_var
+from runtime import get_runtime
 
 
 class FCN_mse(nn.Module):
@@ -160,13 +161,17 @@ class GaussianPosterior(nn.Module):
         y = self.lReLU(self.bn(self.conv(x)))
         mu = var = None
         if self.con_c_dim > 0:
-            mu = self.conv_mu(y).squeeze()
-            var = self.conv_var(y).squeeze().exp()
+            # The Gaussian parameters stay in float32 under autocast: the
+            # log-likelihoods divide by var, which a reduced-precision exp
+            # rounds to zero or infinity.
+            mu = self.conv_mu(y).squeeze().float()
+            var = self.conv_var(y).squeeze().float().exp()
         return mu, var
 
     def forward_soft(self, x):
         mu, var = self.forward(x)
-        return mu + var.sqrt() * from_numpy_to_var(np.random.randn(*list(var.size())))
+        eps = torch.randn(var.size(), device=var.device, generator=get_runtime().generator('posterior'))
+        return mu + var.sqrt() * eps
 
     def forward_hard(self, x):
         mu, _ = self.forward(x)
@@ -294,7 +299,8 @@ class GaussianTransition(nn.Module):
     def get_mu_and_var(self, s):
         out = None
         if self.output_dim > 0:
-            out = self.main(s)
+            # float32 under autocast, as in GaussianPosterior.forward.
+            out = self.main(s).float()
         mu = s + F.tanh(out[:, :self.s_dim]) * 0.1 if self.learn_mu else s
         var = out[:, -self.s_dim:].exp() if self.learn_var else torch.ones_like(s)*self.default_var
         return mu, var
@@ -302,7 +308,8 @@ class GaussianTransition(nn.Module):
     def forward(self, s, a=None):
         bs = list(s.size())[0]
         mu, var = self.get_mu_and_var(s)
-        return mu + var.sqrt() * from_numpy_to_var(np.random.randn(bs, self.s_dim))
+        eps = torch.randn(bs, self.s_dim, device=var.device, generator=get_runtime().generator('transition'))
+        return mu + var.sqrt() * eps
         # return s + from_numpy_to_var(np.random.randn(bs, self.s_dim)*np.sqrt(self.var))
 
     def get_var(self, s):
@@ -323,13 +330,13 @@ class UniformDistribution(nn.Module):
         self.s_dim = s_dim
 
     def sample(self, batch_size):
-        s = np.random.uniform(*self.unif_range, size=(batch_size, self.s_dim))
-        return from_numpy_to_var(s)
+        runtime = get_runtime()
+        s = torch.empty(batch_size, self.s_dim, device=runtime.device)
+        return s.uniform_(*self.unif_range, generator=runtime.generator('prior'))
 
     def log_prob(self, s):
         bs = list(s.size())[0]
-        log_prob = from_numpy_to_var(-np.ones(bs) * np.log(self.unif_range[1] - self.unif_range[0]))
-        return log_prob
+        return s.new_full((bs,), -np.log(self.unif_range[1] - self.unif_range[0]), dtype=torch.float)
 
 
 class Flatten(nn.Module):
@@ -387,8 +394,9 @@ def get_causal_classifier(path, default):
     """
     if not os.path.exists(path):
         return default
-    classifier = Classifier().cuda()
-    classifier.load_state_dict(torch.load(path))
+    runtime = get_runtime()
+    classifier = runtime.module(Classifier())
+    classifier.load_state_dict(runtime.load(path))
     return classifier
 
 
@@ -412,7 +420,7 @@ class WGAN(nn.Module):
         return self.D(x)
 
     def sample_eps(self, n):
-        return torch.rand(n).cuda()
+        return torch.rand(n, device=next(self.parameters()).device)
 
     def grad_penalty(self, x_hat):
         Dx_hat = self.discriminate(x_hat)
@@ -455,12 +463,12 @@ class GAN(nn.Module):
         Dx_tilde = self.discriminate(x_tilde)
         Dx = self.discriminate(x)
         pred = torch.cat((Dx_tilde, Dx), dim=0)
-        labels = torch.cat((torch.zeros(Dx_tilde.shape[0]), torch.ones(Dx.shape[0])), dim=0).cuda()
+        labels = torch.cat((torch.zeros_like(Dx_tilde), torch.ones_like(Dx)), dim=0)
         return F.binary_cross_entropy(pred, labels)
 
     def generator_loss(self, gz):
         D_gz = self.discriminate(gz)
-        labels = torch.ones(D_gz.shape[0]).cuda()
+        labels = torch.ones_like(D_gz)
         return F.binary_cross_entropy(D_gz, labels)
 
 class SingleD(nn.Module):
@@ -518,7 +526,7 @@ class SingleG(nn.Module):
         return self.model(z)
 
     def sample(self, n, cond=None):
-        z = torch.randn(n, self.z_dim).cuda()
+        z = torch.randn(n, self.z_dim, device=next(self.parameters()).device)
         if cond is not None:
             z = torch.cat((z, cond), dim=-1)
         z = z.unsqueeze(-1).unsqueeze(-1)
@@ -625,7 +633,7 @@ class Generator(nn.Module):
         return z
 
     def sample(self, n, cond=None):
-        z = torch.randn(n, self.noise_dim).cuda()
+        z = torch.randn(n, self.noise_dim, device=next(self.parameters()).device)
         if cond is not None:
             z = torch.cat((z, cond), dim=1)
         out = self(z)
@@ -677,12 +685,12 @@ class BigGAN(nn.Module):
         Dx_tilde = self.discriminate(x_tilde, cond=cond)
         Dx = self.discriminate(x, cond=cond)
         pred = torch.cat((Dx_tilde, Dx), dim=0)
-        labels = torch.cat((torch.zeros(Dx_tilde.shape[0]), torch.ones(Dx.shape[0])), dim=0).cuda()
+        labels = torch.cat((torch.zeros_like(Dx_tilde), torch.ones_like(Dx)), dim=0)
         return F.binary_cross_entropy(pred, labels)
 
     def generator_loss(self, gz, cond=None):
         D_gz = self.discriminate(gz, cond=cond)
-        labels = torch.ones(D_gz.shape[0]).cuda()
+        labels = torch.ones_like(D_gz)
         return F.binary_cross_entropy(D_gz, labels)
 
 class BigWGAN(nn.Module):
@@ -705,7 +713,7 @@ class BigWGAN(nn.Module):
         return self.disc(x)
 
     def sample_eps(self, n):
-        return torch.rand(n).cuda()
+        return torch.rand(n, device=next(self.parameters()).device)
 
     def grad_penalty(self, x_hat):
         Dx_hat = self.discriminate(x_hat)
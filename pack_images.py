@@ -0,0 +1,123 @@
+"""
+Quantize <root>/images.npy to a palette of 2 ** bits gray levels and bit-pack
+it into <root>/images_packed.npy, which ImageStore then uses instead.
+
+The preprocessed rope images are nearly binary, so 1 or 2 bits per pixel
+usually hold them within a few gray levels, at 1/8 or 1/4 of the memory.
+The palette minimizes the largest error of any pixel. The smallest number
+of bits that stays within --max_error (uint8 gray levels, 0 for lossless)
+is used unless --bits is given, which must also stay within --max_error.
+Training only reads a lossy store with --packed_max_error at least its error.
+
+Usage: python pack_images.py <root> [--bits B] [--max_error E]
+"""
+
+import argparse
+import json
+import os
+from os.path import join, exists
+import numpy as np
+from tqdm import tqdm
+
+
+def histogram(images, chunk_size):
+    counts = np.zeros(256, dtype=np.int64)
+    for i in tqdm(range(0, len(images), chunk_size)):
+        counts += np.bincount(np.asarray(images[i:i + chunk_size]).ravel(), minlength=256)
+    return counts
+
+
+def cover(values, n_levels, radius):
+    """
+    Greedily cover the sorted values with at most n_levels palette entries,
+    none further than radius from the values it stands for. None if impossible.
+    """
+    palette, i = [], 0
+    while i < len(values):
+        j = np.searchsorted(values, values[i] + 2 * radius, 'right')
+        palette.append((int(values[i]) + int(values[j - 1])) // 2)
+        if len(palette) > n_levels:
+            return None
+        i = j
+    return palette
+
+
+def choose_palette(counts, bits):
+    """
+    Return the palette of 2 ** bits levels with the smallest maximum error
+    over the pixel values present in counts, the code of every uint8 value,
+    and that maximum error.
+    """
+    values = np.flatnonzero(counts)
+    lo, hi = 0, 255
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if cover(values, 2 ** bits, mid) is None:
+            lo = mid + 1
+        else:
+            hi = mid
+    palette = np.array(cover(values, 2 ** bits, lo), dtype=np.int64)
+    codes = np.abs(np.arange(256)[:, None] - palette[None, :]).argmin(axis=1)
+    max_error = int(np.abs(palette[codes[values]] - values).max())
+    palette = np.concatenate((palette, np.zeros(2 ** bits - len(palette), dtype=np.int64)))
+    return palette.astype(np.uint8), codes.astype(np.uint8), max_error
+
+
+def pack(images, codes, bits):
+    """
+    Map uint8 images of shape N x ... to their palette codes and pack them
+    into N x (pixels * bits / 8) bytes, first pixel in the highest bits.
+    """
+    per_byte = 8 // bits
+    pixels = codes[images.reshape(len(images), -1, per_byte)].astype(np.uint8)
+    shifts = np.arange(8 - bits, -1, -bits).astype(np.uint8)
+    return np.bitwise_or.reduce(pixels << shifts, axis=2)
+
+
+def main():
+    images = np.load(join(args.root, 'images.npy'), mmap_mode='r')
+    n_pixels = int(np.prod(images.shape[1:]))
+    counts = histogram(images, args.chunk_size)
+
+    for bits in [args.bits] if args.bits else [1, 2, 4]:
+        palette, codes, max_error = choose_palette(counts, bits)
+        print('%d bits: max error %d gray levels' % (bits, max_error))
+        if max_error <= args.max_error:
+            break
+    else:
+        if args.bits:
+            raise Exception('The %d-bit palette is off by up to %d gray levels, more than --max_error %d'
+                            % (args.bits, max_error, args.max_error))
+        raise Exception('No palette of at most 4 bits is within %d gray levels, '
+                        'keep using images.npy' % args.max_error)
+    assert n_pixels % (8 // bits) == 0
+
+    path = join(args.root, 'images_packed')
+    if exists(path + '.json'):
+        os.remove(path + '.json')
+    packed = np.lib.format.open_memmap(path + '.tmp.npy', mode='w+', dtype=np.uint8,
+                                       shape=(len(images), n_pixels * bits // 8))
+    for i in tqdm(range(0, len(images), args.chunk_size)):
+        packed[i:i + args.chunk_size] = pack(np.asarray(images[i:i + args.chunk_size]), codes, bits)
+    packed.flush()
+    del packed
+    os.rename(path + '.tmp.npy', path + '.npy')
+
+    # The metadata is written last: ImageStore only uses a complete packed store.
+    with open(path + '.json', 'w') as f:
+        json.dump(dict(bits=bits, palette=palette.tolist(), max_error=max_error,
+                       image_shape=list(images.shape[1:])), f)
+    print('Wrote %s.npy: %d bits per pixel, %.1fx smaller, max error %d gray levels.'
+          % (path, bits, 8. / bits, max_error))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('root', type=str)
+    parser.add_argument('--bits', type=int, default=None, choices=[1, 2, 4],
+                        help='bits per pixel, by default the fewest within --max_error')
+    parser.add_argument('--max_error', type=int, default=0,
+                        help='largest allowed error of a pixel in uint8 gray levels')
+    parser.add_argument('--chunk_size', type=int, default=4096)
+    args = parser.parse_args()
+    main()
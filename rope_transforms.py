@@ -0,0 +1,147 @@
+"""
+Preprocessing of the rope images as torch ops that work both on single
+C x H x W images, as dataset transforms in DataLoader workers, and on
+N x C x H x W batches on any device after batching.
+
+The pipeline is FilterBackground, Grayscale, Dilate and Normalize. It
+reproduces the per-image numpy/scipy version pixel for pixel;
+``python rope_transforms.py [image_dir]`` checks this.
+
+Usage:
+    transform = image_transform()                   # PIL image -> 1 x 64 x 64 in [-1, 1]
+    batch = tensor_transform()(images)              # N x 3 x 64 x 64 in [0, 1] -> N x 1 x 64 x 64
+"""
+
+import argparse
+import glob
+from os.path import join
+
+import torch
+import torch.nn.functional as F
+from torchvision import transforms
+from torchvision.datasets.folder import default_loader
+
+
+class FilterBackground(object):
+    """
+    Set every pixel that is darker than threshold in any channel to 0.
+    """
+
+    def __init__(self, threshold=0.3):
+        self.threshold = threshold
+
+    def __call__(self, x):
+        return x.masked_fill((x < self.threshold).any(dim=-3, keepdim=True), 0.0)
+
+    def __repr__(self):
+        return '{}(threshold={})'.format(self.__class__.__name__, self.threshold)
+
+
+class Grayscale(object):
+    """
+    Average the channels into one.
+    """
+
+    def __call__(self, x):
+        return x.mean(dim=-3, keepdim=True)
+
+    def __repr__(self):
+        return '{}()'.format(self.__class__.__name__)
+
+
+class Dilate(object):
+    """
+    Grey dilation with a size x size square, as a max-pool. For odd sizes
+    this equals scipy.ndimage.grey_dilation with its default reflect mode,
+    since reflected border pixels are already inside the window.
+    """
+
+    def __init__(self, size=3):
+        assert size % 2 == 1
+        self.size = size
+
+    def __call__(self, x):
+        return F.max_pool2d(x, self.size, stride=1, padding=self.size // 2)
+
+    def __repr__(self):
+        return '{}(size={})'.format(self.__class__.__name__, self.size)
+
+
+class Normalize(object):
+    """
+    Map [0, 1] to [-1, 1] like transforms.Normalize((0.5,), (0.5,)).
+    """
+
+    def __call__(self, x):
+        return x.sub(0.5).div(0.5)
+
+    def __repr__(self):
+        return '{}()'.format(self.__class__.__name__)
+
+
+def tensor_transform(gray=True, dilation=3, normalize=True):
+    """
+    The rope pipeline on image tensors in [0, 1], single or batched.
+    """
+    trans = [FilterBackground()]
+    if gray:
+        trans.append(Grayscale())
+    if dilation:
+        trans.append(Dilate(dilation))
+    if normalize:
+        trans.append(Normalize())
+    return transforms.Compose(trans)
+
+
+def image_transform(size=64, **kwargs):
+    """
+    Resize, crop and convert a PIL image, then apply tensor_transform.
+    """
+    return transforms.Compose([transforms.Resize(size),
+                               transforms.CenterCrop(size),
+                               transforms.ToTensor()] + tensor_transform(**kwargs).transforms)
+
+
+def scipy_transform(x, size=3):
+    """
+    The original per-image implementation, for reference.
+    """
+    from scipy.ndimage import grey_dilation
+    x = x.clone()
+    x[:, (x < 0.3).any(dim=0)] = 0.0
+    x = x.mean(dim=0)[None, :, :]
+    x = torch.from_numpy(grey_dilation(x.squeeze(0).numpy(), size=size)[None, :, :])
+    return transforms.Normalize((0.5,), (0.5,))(x)
+
+
+def check_identical(images):
+    """
+    Compare the batched and per-image torch pipelines with the scipy one on
+    N x 3 x H x W images in [0, 1].
+    """
+    for size in [3, 5]:
+        expected = torch.stack([scipy_transform(x, size) for x in images])
+        transform = tensor_transform(dilation=size)
+        batched = transform(images)
+        single = torch.stack([transform(x) for x in images])
+        assert torch.equal(batched, expected), 'batched transform differs from scipy (size %d)' % size
+        assert torch.equal(single, expected), 'per-image transform differs from scipy (size %d)' % size
+    print('%d images identical to the scipy transform.' % len(images))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('image_dir', type=str, nargs='?', default=None,
+                        help='also check the png images in this directory and its subdirectories')
+    parser.add_argument('--n', type=int, default=256)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    images = torch.rand(args.n, 3, 64, 64)
+    # Quantized like ToTensor output, with large dark and bright regions.
+    images = (images * 255).round().div(255) * (torch.rand(args.n, 1, 64, 64) > 0.3).float()
+    check_identical(images)
+    if args.image_dir:
+        paths = sorted(glob.glob(join(args.image_dir, '**', '*.png'), recursive=True))[:args.n]
+        base = transforms.Compose([transforms.Resize(64), transforms.CenterCrop(64), transforms.ToTensor()])
+        check_identical(torch.stack([base(default_loader(path)) for path in paths]))
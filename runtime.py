@@ -0,0 +1,217 @@
+"""
+Where and how the models run: the device, the CPU thread pools, the memory
+format of the conv stacks and mixed precision (bf16 or fp16 autocast).
+
+Entry points add the flags with add_arguments and call from_args once at
+startup. Library code reads the configured runtime with get_runtime() instead
+of calling .cuda(), so every script also runs on CPU-only hosts.
+
+Usage:
+    runtime = from_args(args)
+    model = runtime.module(Model())
+    x = runtime.tensor(x)
+    with runtime.autocast():
+        out = model(x)
+    loss = criterion(out.float(), y)
+    scaler.scale(loss).backward()
+    scaler.step(optimizer)
+    scaler.update()
+
+where scaler = runtime.grad_scaler() only scales under fp16. Noise is drawn on
+the device from per-component streams:
+    eps = torch.randn(n, d, device=runtime.device, generator=runtime.generator('transition'))
+"""
+
+import os
+import zlib
+
+import torch
+
+_runtime = None
+
+
+def cpu_count():
+    """
+    Number of cores this process may run on.
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+class Runtime(object):
+    """
+    Args:
+        device (str): 'cuda', 'cuda:<i>' or 'cpu'. Defaults to CUDA if available.
+        num_threads (int): Intra-op threads on CPU, all available cores by default.
+        num_interop_threads (int): Inter-op threads on CPU, left to torch by default.
+        channels_last (bool): Keep modules and 4D inputs in channels_last memory format,
+            which the CPU conv kernels (and tensor cores) run faster on.
+        bf16 (bool): Run forward passes under bf16 autocast.
+        fp16 (bool): Run forward passes under fp16 autocast, with loss scaling. CUDA only.
+    """
+
+    def __init__(self, device=None, num_threads=None, num_interop_threads=None,
+                 channels_last=False, bf16=False, fp16=False):
+        if device is None:
+            device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self.device = torch.device(device)
+        self.channels_last = channels_last
+        assert not (bf16 and fp16), 'Pick one of bf16 and fp16'
+        assert self.cuda or not fp16, 'fp16 autocast needs a CUDA device, use bf16 on CPU'
+        self.bf16 = bf16
+        self.fp16 = fp16
+        self.seed = 0
+        self._generators = {}
+        if self.cuda:
+            if self.device.index is not None:
+                torch.cuda.set_device(self.device)
+        else:
+            torch.set_num_threads(num_threads or cpu_count())
+            if num_interop_threads:
+                try:
+                    torch.set_num_interop_threads(num_interop_threads)
+                except RuntimeError:
+                    # Only possible before the first inter-op parallel work.
+                    print('Inter-op threads already started, keeping %d.' % torch.get_num_interop_threads())
+
+    @property
+    def cuda(self):
+        return self.device.type == 'cuda'
+
+    def module(self, module):
+        """
+        Move a module to the device, in channels_last format if set.
+        """
+        module = module.to(self.device)
+        if self.channels_last:
+            module = module.to(memory_format=torch.channels_last)
+        return module
+
+    def tensor(self, x, non_blocking=False):
+        """
+        Move a tensor to the device, in channels_last format if set and 4D.
+        """
+        x = x.to(self.device, non_blocking=non_blocking)
+        if self.channels_last and x.dim() == 4:
+            x = x.contiguous(memory_format=torch.channels_last)
+        return x
+
+    @property
+    def amp(self):
+        return self.bf16 or self.fp16
+
+    def autocast(self):
+        """
+        Context of the forward passes: bf16 or fp16 autocast if set, a no-op otherwise.
+        """
+        dtype = torch.float16 if self.fp16 else torch.bfloat16
+        return torch.autocast(self.device.type, dtype=dtype, enabled=self.amp)
+
+    def grad_scaler(self):
+        """
+        Loss scaler for the optimizers. fp16 gradients underflow without one;
+        bf16 has the range of float32, so it is a pass-through otherwise.
+        """
+        if hasattr(torch.amp, 'GradScaler'):
+            return torch.amp.GradScaler('cuda', enabled=self.fp16)
+        return torch.cuda.amp.GradScaler(enabled=self.fp16)
+
+    def manual_seed(self, seed):
+        torch.manual_seed(seed)
+        if self.cuda:
+            torch.cuda.manual_seed(seed)
+        self.seed = seed
+        self._generators = {}
+
+    def generator(self, name):
+        """
+        The torch generator of one component (e.g. 'prior', 'transition'), on
+        the device. Each is seeded from the seed of manual_seed and its name, so
+        a component draws the same noise however much the others draw.
+        """
+        if name not in self._generators:
+            generator = torch.Generator(device=self.device)
+            generator.manual_seed(zlib.crc32('{}/{}'.format(self.seed, name).encode()))
+            self._generators[name] = generator
+        return self._generators[name]
+
+    def generator_states(self):
+        """
+        The states of the generators drawn from so far, to checkpoint.
+        """
+        return {name: generator.get_state() for name, generator in self._generators.items()}
+
+    def load_generator_states(self, states):
+        for name, state in states.items():
+            self.generator(name).set_state(state.cpu())
+
+    def load(self, path):
+        """
+        torch.load onto the device, wherever the file was saved from.
+        """
+        return torch.load(path, map_location=self.device)
+
+    def __repr__(self):
+        threads = '' if self.cuda else ', threads={}/{}'.format(torch.get_num_threads(),
+                                                                  torch.get_num_interop_threads())
+        precision = 'fp16' if self.fp16 else 'bf16' if self.bf16 else 'fp32'
+        return 'Runtime(device={}{}, channels_last={}, precision={})'.format(self.device, threads,
+                                                                             self.channels_last, precision)
+
+
+def get_runtime():
+    """
+    The runtime configured by from_args or set_runtime, or the default one.
+    """
+    global _runtime
+    if _runtime is None:
+        _runtime = Runtime()
+    return _runtime
+
+
+def set_runtime(runtime):
+    global _runtime
+    _runtime = runtime
+    return runtime
+
+
+def add_arguments(parser, dash='--', amp=True):
+    """
+    Add the runtime flags to an argparse parser. main.py uses single dashes.
+    Only entry points whose loops run under autocast and move their inputs
+    with tensor() set amp: the others get the device and thread flags only.
+    """
+    parser.add_argument(dash + 'device', type=str, default=None,
+                        help='cuda, cuda:<i> or cpu; cuda if available by default')
+    parser.add_argument(dash + 'threads', type=int, default=None,
+                        help='intra-op CPU threads, all available cores by default')
+    parser.add_argument(dash + 'interop_threads', type=int, default=None,
+                        help='inter-op CPU threads')
+    if not amp:
+        return
+    parser.add_argument(dash + 'channels_last', action='store_true',
+                        help='run the conv stacks in channels_last memory format')
+    parser.add_argument(dash + 'bf16', action='store_true',
+                        help='run forward passes under bf16 autocast')
+    parser.add_argument(dash + 'fp16', action='store_true',
+                        help='run forward passes under fp16 autocast with loss scaling (CUDA only)')
+
+
+def from_args(args, local_rank=None, local_size=1):
+    """
+    Configure the runtime from the flags of add_arguments. Under horovod, pass
+    the local rank and size: each rank then defaults to its own GPU, or to its
+    share of the cores on CPU-only hosts.
+    """
+    device, num_threads = args.device, args.threads
+    if device is None and local_rank is not None and torch.cuda.is_available():
+        device = 'cuda:{}'.format(local_rank)
+    if num_threads is None and local_size > 1:
+        num_threads = max(1, cpu_count() // local_size)
+    runtime = set_runtime(Runtime(device, num_threads, args.interop_threads,
+                                  getattr(args, 'channels_last', False),
+                                  getattr(args, 'bf16', False), getattr(args, 'fp16', False)))
+    print(runtime)
+    return runtime
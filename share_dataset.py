@@ -0,0 +1,30 @@
+"""
+Copy the image store and index of rope datasets into shared memory, so that
+concurrent training runs on one host (e.g. a sweep over seeds) all map the
+same copy instead of each reading the dataset from disk. Datasets use the
+shared copy automatically while it is up to date with <root>.
+
+The copy lives in /dev/shm until it is released or the host reboots, and
+uses as much RAM as images.npy (or images_packed.npy) and the index.
+
+Usage: python share_dataset.py <root> [<root> ...] [--release]
+"""
+
+import argparse
+
+from dataset import share_dataset, release_dataset, shared_path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('roots', type=str, nargs='+')
+    parser.add_argument('--release', action='store_true',
+                        help='remove the shared copies instead')
+    args = parser.parse_args()
+
+    for root in args.roots:
+        if args.release:
+            release_dataset(root)
+            print('Released %s.' % shared_path(root))
+        else:
+            print('%s is shared at %s.' % (root, share_dataset(root)))
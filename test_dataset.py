@@ -0,0 +1,36 @@
+import os
+
+import numpy as np
+import torchvision.transforms as transforms
+from PIL import Image
+
+from dataset import CachedImageFolder
+
+
+def make_root(tmp_path):
+    root = os.path.join(str(tmp_path), 'data')
+    os.makedirs(os.path.join(root, 'run0'))
+    Image.fromarray(np.full((5, 5, 3), 40, np.uint8)).save(os.path.join(root, 'run0', 'a.png'))
+    return root
+
+
+def test_lambda_transforms_do_not_share_a_cache(tmp_path):
+    # Lambda's repr is 'Lambda()' whatever it computes, so it cannot key the cache.
+    root = make_root(tmp_path)
+    zero = CachedImageFolder(root, transform=transforms.Compose([transforms.ToTensor(),
+                                                                 transforms.Lambda(lambda x: x * 0)]))
+    one = CachedImageFolder(root, transform=transforms.Compose([transforms.ToTensor(),
+                                                                transforms.Lambda(lambda x: x + 1)]))
+    assert not zero.enabled and not one.enabled
+    assert zero[0][0].sum().item() == 0
+    assert one[0][0].sum().item() > 75
+
+
+def test_cached_images_match_the_transform(tmp_path):
+    root = make_root(tmp_path)
+    transform = transforms.Compose([transforms.Resize(4), transforms.ToTensor()])
+    first = CachedImageFolder(root, transform=transform)
+    assert first.enabled
+    expected = transform(first.loader(first.samples[0][0]))
+    assert first[0][0].equal(expected)
+    assert CachedImageFolder(root, transform=transform)[0][0].equal(expected)
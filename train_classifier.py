@@ -10,6 +10,8 @@ from torchvision import transforms
 
 from model import Classifier
 from dataset import ImagePairs
+from rope_transforms import FilterBackground
+import runtime
 
 
 def train(model, optimizer, train_loader, epoch):
@@ -18,8 +20,8 @@ def train(model, optimizer, train_loader, epoch):
     train_losses = []
     pbar = tqdm(total=len(train_loader.dataset))
     for o1, o2 in train_loader:
-        x1, x2 = o1[0].cuda(), o2[0].cuda()
-        y = o1[1].cuda()
+        x1, x2 = rt.tensor(o1[0]), rt.tensor(o2[0])
+        y = o1[1].to(rt.device)
         out = model(x1, x2).view(-1)
         loss = F.binary_cross_entropy_with_logits(out, y)
         optimizer.zero_grad()
@@ -39,8 +41,8 @@ def test(model, test_loader, epoch):
     test_loss = 0
     for o1, o2 in test_loader:
         with torch.no_grad():
-            x1, x2 = o1[0].cuda(), o2[0].cuda()
-            y = o1[1].cuda()
+            x1, x2 = rt.tensor(o1[0]), rt.tensor(o2[0])
+            y = o1[1].to(rt.device)
             out = model(x1, x2).view(-1)
             loss = F.binary_cross_entropy_with_logits(out, y)
             test_loss += loss.item() * x1.shape[0]
@@ -50,21 +52,16 @@ def test(model, test_loader, epoch):
 
 def main():
     np.random.seed(args.seed)
-    torch.manual_seed(args.seed)
-    torch.cuda.manual_seed(args.seed)
+    rt.manual_seed(args.seed)
 
-    model = Classifier().cuda()
+    model = rt.module(Classifier())
     optimizer = optim.Adam(model.parameters(), lr=args.lr)
 
-    def filter_background(x):
-        x[:, (x < 0.3).any(dim=0)] = 0.0
-        return x
-
     transform = transforms.Compose([
         transforms.Resize(64),
         transforms.CenterCrop(64),
         transforms.ToTensor(),
-        # filter_background,
+        # FilterBackground(),
         transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)),
     ])
 
@@ -101,7 +98,9 @@ if __name__ == '__main__':
     parser.add_argument('--train_root', type=str, default='data/train_rope')
     parser.add_argument('--test_root', type=str, default='data/test_rope')
     parser.add_argument('--n_frames_apart', type=int, default=1)
+    runtime.add_arguments(parser, amp=False)
     args = parser.parse_args()
+    rt = runtime.from_args(args)
 
     main()
 
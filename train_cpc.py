@@ -2,7 +2,6 @@ import argparse
 import os
 from os.path import join, exists
 import numpy as np
-from scipy.ndimage.morphology import grey_dilation
 from tqdm import tqdm
 import glob
 
@@ -13,13 +12,14 @@ import torch.optim as optim
 
 from torchvision.utils import save_image
 from torchvision import transforms
-from torchvision.datasets import ImageFolder
 from torchvision.datasets.folder import default_loader
 
-from dataset import ImagePairs
+from rope_transforms import FilterBackground, Grayscale, Dilate, Normalize
+from dataset import ImagePairs, CachedImageFolder, DevicePrefetcher
 from cpc_model import Encoder, Decoder, Transition
 from model import FCN_mse
 from cpc_util import *
+import runtime
 
 
 def infinite_loader(data_loader):
@@ -29,16 +29,6 @@ def infinite_loader(data_loader):
 
 
 def get_dataloaders():
-    def filter_background(x):
-        x[:, (x < 0.3).any(dim=0)] = 0.0
-        return x
-
-    def dilate(x):
-        x = x.squeeze(0).numpy()
-        x = grey_dilation(x, size=3)
-        x = x[None, :, :]
-        return torch.from_numpy(x)
-
     if args.thanard_dset:
         transform = transforms.Compose([
             transforms.Resize(64),
@@ -50,35 +40,39 @@ def get_dataloaders():
             transforms.Resize(64),
             transforms.CenterCrop(64),
             transforms.ToTensor(),
-            filter_background,
-            lambda x: x.mean(dim=0)[None, :, :],
-            dilate,
-            transforms.Normalize((0.5,), (0.5,)),
+            FilterBackground(),
+            Grayscale(),
+            Dilate(3),
+            Normalize(),
         ])
 
     train_dset = ImagePairs(root=join(args.root, 'train_data'), include_actions=args.include_actions,
                             thanard_dset=args.thanard_dset, transform=transform, n_frames_apart=args.k)
-    train_loader = data.DataLoader(train_dset, batch_size=args.batch_size, shuffle=True, num_workers=2, drop_last=True)
+    train_loader = DevicePrefetcher(data.DataLoader(train_dset, batch_size=args.batch_size, shuffle=True,
+                                                    num_workers=2, drop_last=True), rt.device)
 
     test_dset = ImagePairs(root=join(args.root, 'test_data'), include_actions=args.include_actions,
                            thanard_dset=args.thanard_dset, transform=transform, n_frames_apart=args.k)
-    test_loader = data.DataLoader(test_dset, batch_size=args.batch_size, shuffle=True, num_workers=2, drop_last=True)
+    test_loader = DevicePrefetcher(data.DataLoader(test_dset, batch_size=args.batch_size, shuffle=True,
+                                                   num_workers=2, drop_last=True), rt.device)
 
-    neg_train_dset = ImageFolder(join(args.root, 'train_data'), transform=transform)
+    neg_train_dset = CachedImageFolder(join(args.root, 'train_data'), transform=transform)
     neg_train_loader = data.DataLoader(neg_train_dset, batch_size=args.batch_size, shuffle=True,
                                        pin_memory=True, num_workers=2) # for training decoder
-    neg_train_inf = infinite_loader(data.DataLoader(neg_train_dset, batch_size=args.n,
-                                                    shuffle=True, pin_memory=True, num_workers=2, drop_last=True)) # to get negative samples
+    neg_train_inf = infinite_loader(DevicePrefetcher(data.DataLoader(neg_train_dset, batch_size=args.n, shuffle=True,
+                                                                     pin_memory=True, num_workers=2, drop_last=True),
+                                                     rt.device)) # to get negative samples
 
-    neg_test_dset = ImageFolder(join(args.root, 'test_data'), transform=transform)
+    neg_test_dset = CachedImageFolder(join(args.root, 'test_data'), transform=transform)
     neg_test_loader = data.DataLoader(neg_test_dset, batch_size=args.batch_size, shuffle=True,
                                        pin_memory=True, num_workers=2)
-    neg_test_inf = infinite_loader(data.DataLoader(neg_test_dset, batch_size=args.n,
-                                                   shuffle=True, pin_memory=True, num_workers=2, drop_last=True))
+    neg_test_inf = infinite_loader(DevicePrefetcher(data.DataLoader(neg_test_dset, batch_size=args.n, shuffle=True,
+                                                                    pin_memory=True, num_workers=2, drop_last=True),
+                                                    rt.device))
 
 
-    start_dset = ImageFolder(join(args.root, 'seq_data', 'start'), transform=transform)
-    goal_dset = ImageFolder(join(args.root, 'seq_data', 'goal'), transform=transform)
+    start_dset = CachedImageFolder(join(args.root, 'seq_data', 'start'), transform=transform)
+    goal_dset = CachedImageFolder(join(args.root, 'seq_data', 'goal'), transform=transform)
 
     start_images = torch.stack([start_dset[i][0] for i in range(len(start_dset))], dim=0)
     goal_images = torch.stack([goal_dset[i][0] for i in range(len(goal_dset))], dim=0)
@@ -110,7 +104,7 @@ def compute_cpc_loss(obs, obs_pos, obs_neg, encoder, trans, actions=None):
     if args.mode == 'cos':
         neg_log_density /= torch.norm(z_next, dim=2) * torch.norm(z_neg, dim=1)
 
-    loss = torch.cat((torch.zeros(bs, 1).cuda(), neg_log_density - pos_log_density), dim=1)  # b x n+1
+    loss = torch.cat((torch.zeros(bs, 1, device=z_next.device), neg_log_density - pos_log_density), dim=1)  # b x n+1
     loss = torch.logsumexp(loss, dim=1).mean()
     return loss
 
@@ -124,7 +118,6 @@ def train_cpc(encoder, trans, optimizer, train_loader, neg_train_inf, epoch):
     for batch in train_loader:
         if args.include_actions:
             (obs, _, actions), (obs_pos, _, _) = batch
-            actions = actions.cuda()
         else:
             (obs, _), (obs_pos, _) = batch
             actions = None
@@ -133,8 +126,7 @@ def train_cpc(encoder, trans, optimizer, train_loader, neg_train_inf, epoch):
             obs, obs_pos = apply_fcn_mse(obs), apply_fcn_mse(obs_pos)
             obs_neg = apply_fcn_mse(next(neg_train_inf)[0])
         else:
-            obs, obs_pos = obs.cuda(), obs_pos.cuda() # b x 1 x 64 x 64
-            obs_neg = next(neg_train_inf)[0].cuda() # b * n x 1 x 64 x 64
+            obs_neg = next(neg_train_inf)[0] # b * n x 1 x 64 x 64
 
         loss = compute_cpc_loss(obs, obs_pos, obs_neg, encoder, trans, actions=actions)
         optimizer.zero_grad()
@@ -147,6 +139,7 @@ def train_cpc(encoder, trans, optimizer, train_loader, neg_train_inf, epoch):
         pbar.set_description('CPC Epoch {}, Train Loss {:.4f}'.format(epoch, avg_loss))
         pbar.update(obs.shape[0])
     pbar.close()
+    print('CPC Epoch {}, {}'.format(epoch, train_loader.report()))
 
 
 def test_cpc(encoder, trans, test_loader, neg_test_inf, epoch):
@@ -157,7 +150,6 @@ def test_cpc(encoder, trans, test_loader, neg_test_inf, epoch):
     for batch in test_loader:
         if args.include_actions:
             (obs, _, actions), (obs_pos, _, _) = batch
-            actions = actions.cuda()
         else:
             (obs, _), (obs_pos, _) = batch
             actions = None
@@ -166,8 +158,7 @@ def test_cpc(encoder, trans, test_loader, neg_test_inf, epoch):
             obs, obs_pos = apply_fcn_mse(obs), apply_fcn_mse(obs_pos)
             obs_neg = apply_fcn_mse(next(neg_test_inf)[0])
         else:
-            obs, obs_pos = obs.cuda(), obs_pos.cuda()  # b x 1 x 64 x 64
-            obs_neg = next(neg_test_inf)[0].cuda()  # b * n x 1 x 64 x 64
+            obs_neg = next(neg_test_inf)[0]  # b * n x 1 x 64 x 64
 
         loss = compute_cpc_loss(obs, obs_pos, obs_neg, encoder, trans, actions=actions)
         test_loss += loss.item() * obs.shape[0]
@@ -182,7 +173,7 @@ def train_decoder(decoder, optimizer, train_loader, encoder, epoch):
     train_losses = []
     pbar = tqdm(total=len(train_loader.dataset))
     for x, _ in train_loader:
-        x = apply_fcn_mse(x) if args.thanard_dset else x.cuda()
+        x = apply_fcn_mse(x) if args.thanard_dset else rt.tensor(x)
 
         z = encoder(x).detach()
         recon = decoder(z)
@@ -206,7 +197,7 @@ def test_decoder(decoder, test_loader, encoder, epoch):
 
     test_loss = 0
     for x, _ in test_loader:
-        x = apply_fcn_mse(x) if args.thanard_dset else x.cuda()
+        x = apply_fcn_mse(x) if args.thanard_dset else rt.tensor(x)
         z = encoder(x).detach()
         recon = decoder(z)
         loss = F.mse_loss(recon, x)
@@ -217,8 +208,7 @@ def test_decoder(decoder, test_loader, encoder, epoch):
 
 def main():
     np.random.seed(args.seed)
-    torch.manual_seed(args.seed)
-    torch.cuda.manual_seed(args.seed)
+    rt.manual_seed(args.seed)
 
     folder_name = join('out', args.name)
     if not exists(folder_name):
@@ -227,9 +217,9 @@ def main():
     obs_dim = (1, 64, 64)
     action_dim = 5 if args.thanard_dset else 4
 
-    encoder = Encoder(args.z_dim, obs_dim[0]).cuda()
-    trans = Transition(args.z_dim, args.include_actions * action_dim).cuda()
-    decoder = Decoder(args.z_dim, obs_dim[0]).cuda()
+    encoder = rt.module(Encoder(args.z_dim, obs_dim[0]))
+    trans = rt.module(Transition(args.z_dim, args.include_actions * action_dim))
+    decoder = rt.module(Decoder(args.z_dim, obs_dim[0]))
 
     optim_cpc = optim.Adam(list(encoder.parameters()) + list(trans.parameters()),
                            lr=args.lr)
@@ -239,7 +229,7 @@ def main():
     if args.thanard_dset:
         start_images, goal_images = apply_fcn_mse(start_images), apply_fcn_mse(goal_images)
     else:
-        start_images, goal_images = start_images.cuda(), goal_images.cuda()
+        start_images, goal_images = rt.tensor(start_images), rt.tensor(goal_images)
 
     # Save training images
     imgs = next(iter(neg_train_loader))[0][:64]
@@ -304,9 +294,11 @@ if __name__ == '__main__':
     parser.add_argument('--z_dim', type=int, default=8)
     parser.add_argument('--k', type=int, default=1)
 
+    runtime.add_arguments(parser, amp=False)
     parser.add_argument('--seed', type=int, default=0)
     parser.add_argument('--name', type=str, default='cpc')
     args = parser.parse_args()
+    rt = runtime.from_args(args)
 
     assert args.mode in ['dotproduct', 'cos']
 
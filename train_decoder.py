@@ -1,6 +1,5 @@
 from tqdm import tqdm
 import argparse
-from scipy.ndimage.morphology import grey_dilation
 
 import torch
 import torch.nn.functional as F
@@ -11,25 +10,27 @@ from torchvision import transforms, utils, datasets
 
 from cpc_model import Decoder
 from cpc_util import *
+import runtime
+from dataset import CachedImageFolder, DevicePrefetcher, rank_subset
 
 
 def get_dataloaders():
     transform = get_transform(args.thanard_dset)
 
-    train_dset = datasets.ImageFolder(join(args.root, 'train_data'), transform=transform)
+    train_dset = CachedImageFolder(join(args.root, 'train_data'), transform=transform)
     if args.horovod:
-        train_sampler = data.distributed.DistributedSampler(train_dset, num_replicas=hvd.size(),
-                                                            rank=hvd.rank())
+        # Each rank only keeps its own slice of the images.
+        train_dset, train_sampler = rank_subset(train_dset, hvd.rank(), hvd.size())
     else:
         train_sampler = None
     train_loader = data.DataLoader(train_dset, batch_size=args.batch_size,
                                    shuffle=not args.horovod, pin_memory=True,
                                    num_workers=4, sampler=train_sampler)
 
-    test_dset = datasets.ImageFolder(join(args.root, 'test_data'), transform=transform)
+    test_dset = CachedImageFolder(join(args.root, 'test_data'), transform=transform)
     if args.horovod:
-        test_sampler = data.distributed.DistributedSampler(test_dset, num_replicas=hvd.size(),
-                                                           rank=hvd.rank())
+        # Each rank only keeps its own slice of the images.
+        test_dset, test_sampler = rank_subset(test_dset, hvd.rank(), hvd.size())
     else:
         test_sampler = None
     test_loader = data.DataLoader(test_dset, batch_size=args.batch_size,
@@ -61,6 +62,7 @@ def train(model, optimizer, train_loader, encoder, epoch, device):
             pbar.update(x.shape[0])
     if not args.horovod or hvd.rank() == 0:
         pbar.close()
+        print('Epoch {}, {}'.format(epoch, train_loader.report()))
 
 
 def test(model, test_loader, encoder, epoch, device):
@@ -83,24 +85,25 @@ def test(model, test_loader, encoder, epoch, device):
 def main():
     if args.horovod:
         hvd.init()
-        torch.cuda.set_device(hvd.local_rank())
+        rt = runtime.from_args(args, hvd.local_rank(), hvd.local_size())
+    else:
+        rt = runtime.from_args(args)
     np.random.seed(args.seed)
-    torch.manual_seed(args.seed)
-    torch.cuda.manual_seed(args.seed)
+    rt.manual_seed(args.seed)
 
     folder_name = join('out', args.name)
     assert exists(folder_name)
 
-    device = torch.device('cuda:{}'.format(hvd.rank())) if args.horovod else torch.device('cuda')
-    train_loader, test_loader = get_dataloaders()
+    device = rt.device
+    train_loader, test_loader = [DevicePrefetcher(loader, device) for loader in get_dataloaders()]
     load_fcn_mse(device)
 
-    encoder = torch.load(join(folder_name, 'encoder.pt'), map_location=device)
+    encoder = rt.module(rt.load(join(folder_name, 'encoder.pt')))
     encoder.eval()
-    trans = torch.load(join(folder_name, 'trans.pt'), map_location=device)
+    trans = rt.module(rt.load(join(folder_name, 'trans.pt')))
     trans.eval()
 
-    model = Decoder(encoder.z_dim, 1, discrete=args.discrete, n_bit=args.n_bit).to(device)
+    model = rt.module(Decoder(encoder.z_dim, 1, discrete=args.discrete, n_bit=args.n_bit))
     optimizer = optim.Adam(model.parameters(), lr=args.lr)
     if args.horovod:
         optimizer = hvd.DistributedOptimizer(
@@ -123,6 +126,7 @@ def main():
     for epoch in range(args.epochs):
         if args.horovod:
             MPI.COMM_WORLD.Barrier()
+            train_loader.sampler.set_epoch(epoch)
         train(model, optimizer, train_loader, encoder, epoch, device)
         test(model, test_loader, encoder, epoch, device)
 
@@ -156,6 +160,7 @@ if __name__ == '__main__':
     parser.add_argument('--log_interval', type=int, default=1)
 
     parser.add_argument('--horovod', action='store_true')
+    runtime.add_arguments(parser, amp=False)
     parser.add_argument('--seed', type=int, default=0)
     parser.add_argument('--name', type=str, default='recon')
     args = parser.parse_args()
@@ -9,25 +9,26 @@ import torch.utils.data as data
 import torch.optim as optim
 from torchvision.utils import save_image
 
-from dataset import NCEVineDataset
+from dataset import NCEVineDataset, batch_loader, normalize_images
 from cpc_model import InverseModel, ForwardModel
 from cpc_util import *
+import runtime
 
 
 def get_dataloaders():
     transform = get_transform(False)
 
     train_dset = NCEVineDataset(root=join(args.root, 'train_data'), n_neg=0,
-                                transform=transform)
-    train_loader = data.DataLoader(train_dset, batch_size=args.batch_size,
-                                   shuffle=True, num_workers=4,
-                                   pin_memory=True)
+                                transform=transform, uint8=args.uint8)
+    train_loader = batch_loader(train_dset, args.batch_size,
+                                shuffle=True, num_workers=4,
+                                pin_memory=True)
 
     test_dset = NCEVineDataset(root=join(args.root, 'test_data'), n_neg=0,
-                               transform=transform)
-    test_loader = data.DataLoader(test_dset, batch_size=args.batch_size,
-                                  shuffle=True, num_workers=4,
-                                  pin_memory=True)
+                               transform=transform, uint8=args.uint8)
+    test_loader = batch_loader(test_dset, args.batch_size,
+                               shuffle=True, num_workers=4,
+                               pin_memory=True)
 
 
     return train_loader, test_loader
@@ -51,6 +52,7 @@ def train(fwd_model, inv_model, encoder, opt_fwd, opt_inv, train_loader, epoch,
     inv_losses, fwd_losses = [], []
     for batch in train_loader:
         obs, obs_next, actions = [b.to(device) for b in batch[:-1]]
+        obs, obs_next = normalize_images(obs), normalize_images(obs_next)
         loss_inv, loss_fwd = compute_losses(fwd_model, inv_model, encoder,
                                             obs, obs_next, actions)
         opt_inv.zero_grad()
@@ -79,6 +81,7 @@ def test(fwd_model, inv_model, encoder, test_loader, epoch, device):
     for batch in test_loader:
         with torch.no_grad():
             obs, obs_next, actions = [b.to(device) for b in batch[:-1]]
+            obs, obs_next = normalize_images(obs), normalize_images(obs_next)
             loss_inv, loss_fwd = compute_losses(fwd_model, inv_model, encoder,
                                                 obs, obs_next, actions)
             inv_loss += loss_inv.item() * obs.shape[0]
@@ -90,22 +93,22 @@ def test(fwd_model, inv_model, encoder, test_loader, epoch, device):
 
 
 def main():
+    rt = runtime.from_args(args)
     np.random.seed(args.seed)
-    torch.manual_seed(args.seed)
-    torch.cuda.manual_seed(args.seed)
+    rt.manual_seed(args.seed)
 
     folder_name = join('out', args.name)
     assert exists(folder_name)
 
     action_dim = 4
-    device = torch.device('cuda')
+    device = rt.device
     train_loader, test_loader = get_dataloaders()
 
     if args.type == 'nce':
-        encoder = torch.load(join(folder_name, 'encoder.pt'), map_location=device)
+        encoder = rt.module(rt.load(join(folder_name, 'encoder.pt')))
     elif args.type == 'vae':
-        encoder = torch.load(join(folder_name, 'vae.pt'), map_location=device)
-        obs = next(iter(train_loader))[0].to(device)
+        encoder = rt.module(rt.load(join(folder_name, 'vae.pt')))
+        obs = normalize_images(next(iter(train_loader))[0].to(device))
         with torch.no_grad():
             obs_recon = encoder.decode(encoder.encode(obs))
         save_image(obs_recon * 0.5 + 0.5, join(folder_name, 'test_vae.png'))
@@ -113,8 +116,8 @@ def main():
         raise Exception('Invalid type', args.type)
     encoder.eval()
 
-    fwd_model = ForwardModel(encoder.z_dim, action_dim).to(device)
-    inv_model = InverseModel(encoder.z_dim, action_dim).to(device)
+    fwd_model = rt.module(ForwardModel(encoder.z_dim, action_dim))
+    inv_model = rt.module(InverseModel(encoder.z_dim, action_dim))
 
     opt_fwd = optim.Adam(fwd_model.parameters(), lr=args.lr)
     opt_inv = optim.Adam(inv_model.parameters(), lr=args.lr)
@@ -135,6 +138,9 @@ if __name__ == '__main__':
     parser.add_argument('--lr', type=float, default=7e-4)
     parser.add_argument('--epochs', type=int, default=100)
     parser.add_argument('--type', type=str, default='nce')
+    parser.add_argument('--uint8', action='store_true',
+                        help='load raw uint8 images and normalize them on the device')
+    runtime.add_arguments(parser, amp=False)
     parser.add_argument('--seed', type=int, default=0)
     parser.add_argument('--name', type=str, required=True)
     args = parser.parse_args()
@@ -2,7 +2,8 @@ import os
 from os.path import join, exists
 from tqdm import tqdm
 import argparse
-from scipy.ndimage.morphology import grey_dilation
+from collections import OrderedDict
+from functools import partial
 
 import torch
 import torch.optim as optim
@@ -10,9 +11,12 @@ import torch.utils.data as data
 from torch.nn.utils import clip_grad_norm_
 
 from torchvision.utils import save_image
-from torchvision.datasets import ImageFolder
 import torchvision.transforms as transforms
 
+from dataset import CachedImageFolder, DevicePrefetcher
+from rope_transforms import FilterBackground, Grayscale, Dilate, Normalize
+import runtime
+from diagnostics import MetricsWriter, grad_norm
 from model import GAN, FCN_mse, BigGAN
 
 def inf_iterator(data_loader):
@@ -22,12 +26,8 @@ def inf_iterator(data_loader):
             yield batch
         epoch += 1
 
-def norm(parameters):
-    total = 0
-    for p in parameters:
-        param_norm = p.grad.data.norm(2)
-        total += param_norm.item() ** 2
-    return total ** 0.5
+def describe(pbar, values):
+    pbar.set_description('G: {G:.4f}, D: {D:.4f}, g (cur/max) {g:.4f}/{max_g:.4f}, d (cur/max) {d:.4f}/{max_d:.4f}'.format(**values))
 
 def train(model, fcn, data_loader):
     itrs = args.itrs
@@ -50,11 +50,13 @@ def train(model, fcn, data_loader):
     saved = False
     pbar = tqdm(total=itrs)
     model.train()
-    max_g, max_d = float('-inf'), float('-inf')
+    # Losses and norms stay on the device; the writer thread reads them on
+    # the logging iterations.
+    metrics_writer = MetricsWriter()
+    max_g = max_d = torch.tensor(float('-inf'), device=rt.device)
     for itr in range(itrs):
         for _ in range(n_critic):
             x,  _ = next(data_gen)
-            x  = x.cuda()
  #           x = apply_fcn_mse(fcn, x).cpu()
             batch_size = x.size(0)
 
@@ -74,7 +76,7 @@ def train(model, fcn, data_loader):
             disc_loss.backward()
             optimizerD.step()
 
-            d_norm = norm(model.D.parameters())
+            d_norm = grad_norm(model.D.parameters())
 
         for _ in range(n_gen):
             optimizerG.zero_grad()
@@ -82,19 +84,22 @@ def train(model, fcn, data_loader):
             gen_loss = model.generator_loss(gz)
             gen_loss.backward()
             optimizerG.step()
-            g_norm = norm(model.G.parameters())
+            g_norm = grad_norm(model.G.parameters())
 
-        max_g = max(max_g, g_norm)
-        max_d = max(max_d, d_norm)
-        pbar.set_description('G: {:.4f}, D: {:.4f}, g (cur/max) {:.4f}/{:.4f}, d (cur/max) {:.4f}/{:.4f}'.format(gen_loss.item(), disc_loss.item(), g_norm, max_g, d_norm, max_d))
+        max_g = torch.maximum(max_g, g_norm)
+        max_d = torch.maximum(max_d, d_norm)
 
         if itr % log_interval == 0:
+            metrics_writer.put(OrderedDict([('G', gen_loss), ('D', disc_loss), ('g', g_norm), ('max_g', max_g),
+                                            ('d', d_norm), ('max_d', max_d)]), partial(describe, pbar))
+            pbar.write('Itr {}, {}'.format(itr, data_loader.report()))
             model.eval()
             samples = model.sample(64)
             save_image(samples, join(filepath, 'samples_itr{}.png'.format(itr)))
             model.train()
 
         pbar.update(1)
+    metrics_writer.close()
     pbar.close()
 
 def apply_fcn_mse(fcn, img):
@@ -102,39 +107,28 @@ def apply_fcn_mse(fcn, img):
     return torch.clamp(2 * (o - 0.5), -1 + 1e-3, 1 - 1e-3)
 
 def main():
-    torch.manual_seed(args.seed)
-    torch.cuda.manual_seed(args.seed)
+    rt.manual_seed(args.seed)
 
    # fcn = FCN_mse(2).cuda()
    # fcn.load_state_dict(torch.load('/home/wilson/causal-infogan/data/FCN_mse'))
    # fcn.eval()
     fcn = None
 
-    def filter_background(x):
-        x[:, (x < 0.3).any(dim=0)] = 0.0
-        return x
-
-    def dilate(x):
-        x = x.squeeze(0).numpy()
-        x = grey_dilation(x, size=5)
-        x = x[None, :, :]
-        return torch.from_numpy(x)
-
     transform = transforms.Compose([
         transforms.Resize(64),
         transforms.CenterCrop(64),
         transforms.ToTensor(),
-        filter_background,
-        lambda x: x.mean(dim=0)[None, :, :],
-        dilate,
-        transforms.Normalize((0.5,), (0.5,)),
+        FilterBackground(),
+        Grayscale(),
+        Dilate(5),
+        Normalize(),
     ])
 
-    dataset = ImageFolder(args.root, transform=transform)
-    loader = data.DataLoader(dataset, batch_size=args.batch_size, shuffle=True,
-                             pin_memory=True, num_workers=2)
+    dataset = CachedImageFolder(args.root, transform=transform)
+    loader = DevicePrefetcher(data.DataLoader(dataset, batch_size=args.batch_size, shuffle=True,
+                                              pin_memory=True, num_workers=2), rt.device)
 
-    model = GAN(32, 1).cuda()
+    model = rt.module(GAN(32, 1))
     # model = BigGAN((1, 64, 64), z_dim=32).cuda()
     train(model, fcn, loader)
 
@@ -147,5 +141,7 @@ if __name__ == '__main__':
     parser.add_argument('--log_interval', type=int, default=1000)
     parser.add_argument('--seed', type=int, default=0)
     parser.add_argument('--name', type=str, default='gan')
+    runtime.add_arguments(parser, amp=False)
     args = parser.parse_args()
+    rt = runtime.from_args(args)
     main()
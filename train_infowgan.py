@@ -2,16 +2,17 @@ import os
 from os.path import join, exists
 from tqdm import tqdm
 import argparse
-from scipy.ndimage.morphology import grey_dilation
 
 import torch
 import torch.optim as optim
 import torch.utils.data as data
 
 from torchvision.utils import save_image
-from torchvision.datasets import ImageFolder
 import torchvision.transforms as transforms
 
+from dataset import CachedImageFolder, DevicePrefetcher
+from rope_transforms import FilterBackground, Grayscale, Dilate, Normalize
+import runtime
 from model import BigWGAN, GaussianPosterior, UniformDistribution
 
 def inf_iterator(data_loader):
@@ -42,7 +43,6 @@ def train(model, posterior, prior, data_loader):
     for itr in range(itrs):
         for _ in range(n_critic):
             x,  _ = next(data_gen)
-            x  = x.cuda()
             batch_size = x.size(0)
 
             if not saved:
@@ -71,6 +71,7 @@ def train(model, posterior, prior, data_loader):
         optimizerG.step()
 
         if itr % log_interval == 0:
+            pbar.write('Itr {}, {}'.format(itr, data_loader.report()))
             model.eval()
             c = prior.sample(8)
             samples = torch.cat([model.sample(8, c) for _ in range(8)], dim=0)
@@ -82,34 +83,23 @@ def train(model, posterior, prior, data_loader):
 
 
 def main():
-    torch.manual_seed(args.seed)
-    torch.cuda.manual_seed(args.seed)
-
-    def filter_background(x):
-        x[:, (x < 0.3).any(dim=0)] = 0.0
-        return x
-
-    def dilate(x):
-        x = x.squeeze(0).numpy()
-        x = grey_dilation(x, size=3)
-        x = x[None, :, :]
-        return torch.from_numpy(x)
+    rt.manual_seed(args.seed)
 
     transform = transforms.Compose([
         transforms.Resize(64),
         transforms.CenterCrop(64),
         transforms.ToTensor(),
-        filter_background,
-        lambda x: x.mean(dim=0)[None, :, :],
-        dilate,
-        transforms.Normalize((0.5,), (0.5,)),
+        FilterBackground(),
+        Grayscale(),
+        Dilate(3),
+        Normalize(),
     ])
-    dataset = ImageFolder(args.root, transform=transform)
-    loader = data.DataLoader(dataset, batch_size=args.batch_size, shuffle=True,
-                             pin_memory=True, num_workers=2)
+    dataset = CachedImageFolder(args.root, transform=transform)
+    loader = DevicePrefetcher(data.DataLoader(dataset, batch_size=args.batch_size, shuffle=True,
+                                              pin_memory=True, num_workers=2), rt.device)
 
-    model = BigWGAN((1, 64, 64), z_dim=args.z_dim, c_dim=args.c_dim).cuda()
-    posterior = GaussianPosterior(args.c_dim, 1, 1).cuda()
+    model = rt.module(BigWGAN((1, 64, 64), z_dim=args.z_dim, c_dim=args.c_dim))
+    posterior = rt.module(GaussianPosterior(args.c_dim, 1, 1))
     prior = UniformDistribution(s_dim=args.c_dim)
     train(model, posterior, prior, loader)
 
@@ -126,5 +116,7 @@ if __name__ == '__main__':
     parser.add_argument('--c_dim', type=int, default=10)
     parser.add_argument('--name', type=str, default='infowgan')
 
+    runtime.add_arguments(parser, amp=False)
     args = parser.parse_args()
+    rt = runtime.from_args(args)
     main()
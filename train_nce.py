@@ -10,31 +10,34 @@ from torchvision import transforms
 from torchvision.datasets import ImageFolder
 from torchvision.datasets.folder import default_loader
 
-from dataset import NCEDataset
+from dataset import DevicePrefetcher, NCEDataset, batch_loader, rank_sampler, normalize_images, share_dataset, \
+    allow_packed_error
 from cpc_model import Encoder, Transition, InverseModel
 from cpc_util import *
+import runtime
 
 
 def get_dataloaders():
-    train_dset = NCEDataset(root=join(args.root, 'train_data'), n_neg=args.n_neg)
+    # Under horovod each rank only reads its own shard of the pairs and images.
+    shard_kwargs = dict(rank=hvd.rank(), world_size=hvd.size()) if args.horovod else dict()
+    train_dset = NCEDataset(root=join(args.root, 'train_data'), n_neg=args.n_neg,
+                            uint8=args.uint8, seed=args.seed, **shard_kwargs)
+    # Shuffled from (seed, epoch), so that a checkpoint can resume mid-epoch.
+    train_sampler = rank_sampler(train_dset, seed=args.seed)
+    train_loader = batch_loader(train_dset, args.batch_size, num_workers=4,
+                                pin_memory=True, sampler=train_sampler,
+                                resident=args.resident)
+
+    test_dset = NCEDataset(root=join(args.root, 'test_data'), n_neg=args.n_neg,
+                            uint8=args.uint8, seed=args.seed, **shard_kwargs)
     if args.horovod:
-        train_sampler = data.distributed.DistributedSampler(train_dset, num_replicas=hvd.size(),
-                                                            rank=hvd.rank())
-    else:
-        train_sampler = None
-    train_loader = data.DataLoader(train_dset, batch_size=args.batch_size,
-                                   shuffle=not args.horovod, num_workers=4,
-                                   pin_memory=True, sampler=train_sampler)
-
-    test_dset = NCEDataset(root=join(args.root, 'test_data'), n_neg=args.n_neg)
-    if args.horovod:
-        test_sampler = data.distributed.DistributedSampler(test_dset, num_replicas=hvd.size(),
-                                                           rank=hvd.rank())
+        test_sampler = rank_sampler(test_dset)
     else:
         test_sampler = None
-    test_loader = data.DataLoader(test_dset, batch_size=args.batch_size,
-                                  shuffle=not args.horovod, num_workers=4,
-                                  pin_memory=True, sampler=test_sampler)
+    test_loader = batch_loader(test_dset, args.batch_size,
+                               shuffle=not args.horovod, num_workers=4,
+                               pin_memory=True, sampler=test_sampler,
+                               resident=args.resident)
 
 
     return train_loader, test_loader
@@ -72,20 +75,31 @@ def compute_cpc_loss(obs, obs_pos, obs_neg, encoder, trans, inv, actions, device
     return loss
 
 
-def train(encoder, trans, inv, optimizer, train_loader, epoch, device):
+def train(encoder, trans, inv, optimizer, scaler, train_loader, epoch, device, sampler=None, ckpt_path=None):
+    rt = runtime.get_runtime()
     encoder.train()
     trans.train()
 
     if not args.horovod or hvd.rank() == 0:
         train_losses = []
-        pbar = tqdm(total=len(train_loader.sampler if args.horovod else train_loader.dataset))
-    for batch in train_loader:
-        obs, obs_pos, actions, obs_neg = [b.to(device) for b in batch]
-        loss = compute_cpc_loss(obs, obs_pos, obs_neg, encoder,
-                                trans, inv, actions, device)
+        pbar = tqdm(total=len(sampler if sampler is not None else train_loader.dataset))
+    for step, batch in enumerate(train_loader, 1):
+        obs, obs_pos, actions, obs_neg = batch
+        obs, obs_pos, obs_neg = [rt.tensor(normalize_images(x)) for x in (obs, obs_pos, obs_neg)]
+        with rt.autocast():
+            loss = compute_cpc_loss(obs, obs_pos, obs_neg, encoder,
+                                    trans, inv, actions, device)
         optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+        scaler.scale(loss).backward()
+        if args.horovod:
+            # Unscale the gradients only once horovod has averaged them.
+            optimizer.synchronize()
+            scaler.unscale_(optimizer)
+            with optimizer.skip_synchronize():
+                scaler.step(optimizer)
+        else:
+            scaler.step(optimizer)
+        scaler.update()
 
         if not args.horovod or hvd.rank() == 0:
             train_losses.append(loss.item())
@@ -93,22 +107,29 @@ def train(encoder, trans, inv, optimizer, train_loader, epoch, device):
 
             pbar.set_description('Epoch {}, Train Loss {:.4f}'.format(epoch, loss.item()))
             pbar.update(obs.shape[0])
+            if args.ckpt_interval and step % args.ckpt_interval == 0:
+                save_checkpoint(ckpt_path, dict(encoder=encoder, trans=trans, inv=inv), optimizer, scaler,
+                                epoch, sampler.state_dict(step * args.batch_size))
     if not args.horovod or hvd.rank() == 0:
         pbar.close()
+        print('Epoch {}, {}'.format(epoch, train_loader.report()))
 
 
 def test(encoder, trans, inv, test_loader, epoch, device):
+    rt = runtime.get_runtime()
     encoder.eval()
     trans.eval()
 
     test_loss = 0
     for batch in test_loader:
         with torch.no_grad():
-            obs, obs_pos, actions, obs_neg = [b.to(device) for b in batch]
-            loss = compute_cpc_loss(obs, obs_pos, obs_neg, encoder,
-                                    trans, inv, actions, device)
+            obs, obs_pos, actions, obs_neg = batch
+            obs, obs_pos, obs_neg = [rt.tensor(normalize_images(x)) for x in (obs, obs_pos, obs_neg)]
+            with rt.autocast():
+                loss = compute_cpc_loss(obs, obs_pos, obs_neg, encoder,
+                                        trans, inv, actions, device)
             test_loss += loss * obs.shape[0]
-    test_loss /= len(test_loader.sampler if args.horovod else test_loader.dataset)
+    test_loss /= len(test_loader.sampler.sampler if args.horovod else test_loader.dataset)
     if args.horovod:
         test_loss = metric_average(test_loss, 'avg_loss')
     if not args.horovod or hvd.rank() == 0:
@@ -121,7 +142,8 @@ def test_distance(encoder, trans, train_loader, device):
 
     with torch.no_grad():
         batch = next(iter(train_loader))
-        obs, obs_pos, actions, obs_neg = [b.to(device) for b in batch]
+        obs, obs_pos, actions, obs_neg = batch
+        obs, obs_pos, obs_neg = [normalize_images(x) for x in (obs, obs_pos, obs_neg)]
         bs = obs.shape[0]
 
         z, z_pos = encoder(obs), encoder(obs_pos)
@@ -157,10 +179,11 @@ def test_distance(encoder, trans, train_loader, device):
 def main():
     if args.horovod:
         hvd.init()
-        torch.cuda.set_device(hvd.local_rank())
+        rt = runtime.from_args(args, hvd.local_rank(), hvd.local_size())
+    else:
+        rt = runtime.from_args(args)
     np.random.seed(args.seed)
-    torch.manual_seed(args.seed)
-    torch.cuda.manual_seed(args.seed)
+    rt.manual_seed(args.seed)
 
     folder_name = join('out', args.name)
     if not exists(folder_name):
@@ -169,14 +192,14 @@ def main():
     obs_dim = (1, 64, 64)
     action_dim = 4
 
-    device = torch.device('cuda:{}'.format(hvd.rank())) if args.horovod else torch.device('cuda')
+    device = rt.device
     load_fcn_mse(device)
 
-    encoder = Encoder(args.z_dim, obs_dim[0], squash=args.squash).to(device)
-    trans = Transition(args.z_dim, action_dim, squash=args.squash, trans_type=args.trans_type).to(device)
+    encoder = rt.module(Encoder(args.z_dim, obs_dim[0], squash=args.squash))
+    trans = rt.module(Transition(args.z_dim, action_dim, squash=args.squash, trans_type=args.trans_type))
     parameters = list(encoder.parameters()) + list(trans.parameters())
     if args.inv_model:
-        inv = InverseModel(args.z_dim, action_dim).to(device)
+        inv = rt.module(InverseModel(args.z_dim, action_dim))
         parameters += list(inv.parameters())
     else:
         inv = None
@@ -192,17 +215,37 @@ def main():
             optimizer, named_parameters=named_parameters
         )
 
+    # Scales the loss under --fp16, whose gradients underflow otherwise.
+    scaler = rt.grad_scaler()
+
+    modules = dict(encoder=encoder, trans=trans, inv=inv)
+    ckpt_path = join(folder_name, 'checkpoint.pt')
+    start_epoch, sampler_state = 0, None
+    if args.resume and exists(ckpt_path):
+        start_epoch, sampler_state = load_checkpoint(ckpt_path, modules, optimizer, scaler)
+        print('Resuming from epoch {}{}'.format(start_epoch, '' if sampler_state is None else
+                                                ', item {}'.format(sampler_state['start'])))
+
+    if args.horovod:
         hvd.broadcast_parameters(encoder.state_dict(), root_rank=0)
         hvd.broadcast_parameters(trans.state_dict(), root_rank=0)
         if args.inv_model:
             hvd.broadcast_parameters(inv.state_dict(0, root_rank=0))
         hvd.broadcast_optimizer_state(optimizer, root_rank=0)
 
-    train_loader, test_loader = get_dataloaders()
+    # Batches, negatives and actions are copied to the device by a background
+    # thread while the previous step runs.
+    allow_packed_error(args.packed_max_error)
+    if args.share:
+        for split in ['train_data', 'test_data']:
+            share_dataset(join(args.root, split))
+    train_loader, test_loader = [DevicePrefetcher(loader, device) for loader in get_dataloaders()]
+    train_sampler = train_loader.sampler.sampler
     if not args.horovod or hvd.rank() == 0:
         # Save training images
         batch = next(iter(train_loader))
         obs, obs_next, _, obs_neg = batch
+        obs, obs_next, obs_neg = [normalize_images(x) for x in (obs, obs_next, obs_neg)]
         imgs = torch.stack((obs, obs_next), dim=1).view(-1, *obs.shape[1:])
         save_image(imgs * 0.5 + 0.5, join(folder_name, 'train_seq_img.png'), nrow=8)
 
@@ -211,10 +254,14 @@ def main():
 
     if not args.horovod or hvd.rank() == 0:
         test_distance(encoder, trans, train_loader, device)
-    for epoch in range(args.epochs):
+    for epoch in range(start_epoch, args.epochs):
         if args.horovod:
             MPI.COMM_WORLD.Barrier()
-        train(encoder, trans, inv, optimizer, train_loader, epoch, device)
+        if epoch == start_epoch and sampler_state is not None:
+            train_sampler.load_state_dict(sampler_state)
+        else:
+            train_sampler.set_epoch(epoch)
+        train(encoder, trans, inv, optimizer, scaler, train_loader, epoch, device, train_sampler, ckpt_path)
         test(encoder, trans, inv, test_loader, epoch, device)
 
         if epoch % args.log_interval == 0 and (not args.horovod or hvd.rank() == 0):
@@ -224,6 +271,8 @@ def main():
             torch.save(trans, join(folder_name, 'trans.pt'))
             if args.inv_model:
                 torch.save(inv, join(folder_name, 'inv.pt'))
+        if not args.horovod or hvd.rank() == 0:
+            save_checkpoint(ckpt_path, modules, optimizer, scaler, epoch + 1, None)
 
 
 if __name__ == '__main__':
@@ -244,7 +293,22 @@ if __name__ == '__main__':
     parser.add_argument('--z_dim', type=int, default=8)
     parser.add_argument('--k', type=int, default=1)
 
+    parser.add_argument('--uint8', action='store_true',
+                        help='load raw uint8 images and normalize them on the device')
+    parser.add_argument('--resident', action='store_true',
+                        help='hold the images in memory and gather batches without DataLoader workers')
+    parser.add_argument('--share', action='store_true',
+                        help='map the dataset from a shared-memory copy, made by the first run '
+                             'that needs it, so that concurrent runs share one copy')
+    parser.add_argument('--packed_max_error', type=int, default=0,
+                        help='read a lossy images_packed.npy of pack_images.py if its error '
+                             'is within this many gray levels')
     parser.add_argument('--horovod', action='store_true')
+    runtime.add_arguments(parser)
+    parser.add_argument('--ckpt_interval', type=int, default=0,
+                        help='also checkpoint every this many batches, not only after every epoch')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue from the checkpoint in out/<name> at the batch where it stopped')
     parser.add_argument('--seed', type=int, default=0)
     parser.add_argument('--name', type=str, default='cpc')
     args = parser.parse_args()
@@ -13,17 +13,19 @@ from torchvision import transforms
 from torchvision import datasets
 
 from cpc_model import BetaVAE
+from dataset import CachedImageFolder, DevicePrefetcher
 from cpc_util import get_transform, load_fcn_mse, apply_fcn_mse
+import runtime
 
 
 def get_dataloaders():
     transform = get_transform(args.thanard_dset)
-    train_dset = datasets.ImageFolder(join(args.root, 'train_data'), transform=transform)
+    train_dset = CachedImageFolder(join(args.root, 'train_data'), transform=transform)
     train_loader = data.DataLoader(train_dset, batch_size=args.batch_size,
                                    shuffle=True, pin_memory=True,
                                    num_workers=4)
 
-    test_dset = datasets.ImageFolder(join(args.root, 'test_data'), transform=transform)
+    test_dset = CachedImageFolder(join(args.root, 'test_data'), transform=transform)
     test_loader = data.DataLoader(test_dset, batch_size=args.batch_size,
                                   shuffle=True, pin_memory=True,
                                   num_workers=4)
@@ -51,6 +53,7 @@ def train(model, optimizer, train_loader, epoch, device):
         pbar.set_description('Epoch {}, Recon Loss {:.4f}, KL Loss {:.4f}'.format(epoch, avg_recon_loss, avg_kl_loss))
         pbar.update(x.shape[0])
     pbar.close()
+    print('Epoch {}, {}'.format(epoch, train_loader.report()))
 
 
 def test(model, test_loader, epoch, device):
@@ -119,18 +122,18 @@ def save_interpolation(model, train_loader, test_loader, epoch, folder_name, dev
 
 
 def main():
+    rt = runtime.from_args(args)
     np.random.seed(args.seed)
-    torch.manual_seed(args.seed)
-    torch.cuda.manual_seed(args.seed)
+    rt.manual_seed(args.seed)
 
     folder_name = join('out', args.name)
     if not exists(folder_name):
         os.makedirs(folder_name)
 
-    device = torch.device('cuda')
+    device = rt.device
     if args.thanard_dset:
         load_fcn_mse(device)
-    train_loader, test_loader = get_dataloaders()
+    train_loader, test_loader = [DevicePrefetcher(loader, device) for loader in get_dataloaders()]
 
     x = next(iter(train_loader))[0]
     if args.thanard_dset:
@@ -138,7 +141,7 @@ def main():
     x = x * 0.5 + 0.5
     save_image(x, join(folder_name, 'dset.png'))
 
-    model = BetaVAE(args.z_dim, 1, beta=args.beta).to(device)
+    model = rt.module(BetaVAE(args.z_dim, 1, beta=args.beta))
     optimizer = optim.Adam(model.parameters(), lr=args.lr)
 
     for epoch in range(args.epochs):
@@ -162,6 +165,7 @@ if __name__ == '__main__':
     parser.add_argument('--epochs', type=int, default=100)
 
     parser.add_argument('--thanard_dset', action='store_true')
+    runtime.add_arguments(parser, amp=False)
     parser.add_argument('--seed', type=int, default=0)
     parser.add_argument('--name', type=str, default='recon')
     args = parser.parse_args()
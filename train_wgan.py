@@ -2,16 +2,20 @@ import os
 from os.path import join, exists
 from tqdm import tqdm
 import argparse
-from scipy.ndimage.morphology import grey_dilation
+from collections import OrderedDict
+from functools import partial
 
 import torch
 import torch.optim as optim
 import torch.utils.data as data
 
 from torchvision.utils import save_image
-from torchvision.datasets import ImageFolder
 import torchvision.transforms as transforms
 
+from dataset import CachedImageFolder, DevicePrefetcher
+from rope_transforms import FilterBackground, Grayscale, Dilate, Normalize
+import runtime
+from diagnostics import MetricsWriter
 from model import WGAN, FCN_mse, BigWGAN
 
 def inf_iterator(data_loader):
@@ -21,6 +25,9 @@ def inf_iterator(data_loader):
             yield batch
         epoch += 1
 
+def describe(pbar, values):
+    pbar.set_description('G: {G:.4f}, D: {D:.4f}, Pen: {Pen:.4f}'.format(**values))
+
 def train(model, fcn, data_loader):
     itrs = args.itrs
     log_interval = args.log_interval
@@ -36,11 +43,13 @@ def train(model, fcn, data_loader):
 
     saved = False
     pbar = tqdm(total=itrs)
+    # The losses stay on the device; the writer thread reads them on the
+    # logging iterations.
+    metrics_writer = MetricsWriter()
     model.train()
     for itr in range(itrs):
         for _ in range(n_critic):
             x,  _ = next(data_gen)
-            x  = x.cuda()
             #x = apply_fcn_mse(fcn, x)
             batch_size = x.size(0)
 
@@ -63,15 +72,17 @@ def train(model, fcn, data_loader):
         gen_loss.backward()
         optimizerG.step()
 
-        pbar.set_description('G: {:.4f}, D: {:.4f}, Pen: {:.4f}'.format(gen_loss.item(), disc_loss.item(), grad_penalty.item()))
-
         if itr % log_interval == 0:
+            metrics_writer.put(OrderedDict([('G', gen_loss), ('D', disc_loss), ('Pen', grad_penalty)]),
+                               partial(describe, pbar))
+            pbar.write('Itr {}, {}'.format(itr, data_loader.report()))
             model.eval()
             samples = model.sample(64)
             save_image(samples, join(filepath, 'samples_itr{}.png'.format(itr)))
             model.train()
 
         pbar.update(1)
+    metrics_writer.close()
     pbar.close()
 
 def apply_fcn_mse(fcn, img):
@@ -79,40 +90,29 @@ def apply_fcn_mse(fcn, img):
     return torch.clamp(2 * (o - 0.5), -1 + 1e-3, 1 - 1e-3)
 
 def main():
-    torch.manual_seed(args.seed)
-    torch.cuda.manual_seed(args.seed)
+    rt.manual_seed(args.seed)
 
     #fcn = FCN_mse(2).cuda()
     #fcn.load_state_dict(torch.load('/home/wilson/causal-infogan/data/FCN_mse'))
     #fcn.eval()
     fcn = None
 
-    def filter_background(x):
-        x[:, (x < 0.3).any(dim=0)] = 0.0
-        return x
-
-    def dilate(x):
-        x = x.squeeze(0).numpy()
-        x = grey_dilation(x, size=3)
-        x = x[None, :, :]
-        return torch.from_numpy(x)
-
     transform = transforms.Compose([
         transforms.Resize(64),
         transforms.CenterCrop(64),
         transforms.ToTensor(),
-        filter_background,
-        lambda x: x.mean(dim=0)[None, :, :],
-        dilate,
-        transforms.Normalize((0.5,), (0.5,)),
+        FilterBackground(),
+        Grayscale(),
+        Dilate(3),
+        Normalize(),
     ])
 
-    dataset = ImageFolder(args.root, transform=transform)
-    loader = data.DataLoader(dataset, batch_size=args.batch_size, shuffle=True,
-                             pin_memory=True, num_workers=2)
+    dataset = CachedImageFolder(args.root, transform=transform)
+    loader = DevicePrefetcher(data.DataLoader(dataset, batch_size=args.batch_size, shuffle=True,
+                                              pin_memory=True, num_workers=2), rt.device)
 
    # model = WGAN(32, 1).cuda()
-    model = BigWGAN((1, 64, 64), z_dim=32).cuda()
+    model = rt.module(BigWGAN((1, 64, 64), z_dim=32))
     train(model, fcn, loader)
 
 if __name__ == '__main__':
@@ -124,5 +124,7 @@ if __name__ == '__main__':
     parser.add_argument('--log_interval', type=int, default=500)
     parser.add_argument('--seed', type=int, default=0)
     parser.add_argument('--name', type=str, default='wgan')
+    runtime.add_arguments(parser, amp=False)
     args = parser.parse_args()
+    rt = runtime.from_args(args)
     main()
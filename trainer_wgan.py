@@ -1,7 +1,6 @@
 import numpy as np
 import csv
 import os
-from scipy.ndimage.morphology import grey_dilation
 import torch
 import torch.nn as nn
 import torch.optim as optim
@@ -15,12 +14,16 @@ from torch.utils.data import DataLoader
 from torchvision.utils import save_image
 from tensorboard_logger import configure, log_value
 from collections import OrderedDict
+from functools import partial
 
 from planning import plan_traj_astar, discretize, undiscretize
-from dataset import ImagePairs
-from utils import plot_img, from_numpy_to_var, print_array, write_number_on_images, write_stats_from_var
+from rope_transforms import FilterBackground, Grayscale, Dilate, Normalize
+from dataset import ImagePairs, CachedImageFolder, DevicePrefetcher, batch_loader, rank_sampler, normalize_images
+from utils import plot_img, from_numpy_to_var, print_array, write_number_on_images
 from model import get_causal_classifier
 from logger import Logger
+from runtime import get_runtime
+from diagnostics import Diagnostics, MetricsWriter, write_stats
 
 
 class Trainer:
@@ -33,6 +36,8 @@ class Trainer:
         self.P = P
         self.classifier = kwargs['classifier']
         self.fcn = kwargs.get('fcn', None)
+        self.runtime = get_runtime()
+        self.device = self.runtime.device
 
         # Weights
         self.lr_g = kwargs['lr_g']
@@ -43,12 +48,17 @@ class Trainer:
         # Training hyperparameters
         self.batch_size = 100
         self.n_epochs = kwargs['n_epochs']
+        self.seed = kwargs.get('seed', 0)
+        self.ckpt_interval = kwargs.get('ckpt_interval', 0)
+        self.resume = kwargs.get('resume', False)
         self.c_dim = kwargs['cont_code_dim']
         self.rand_z_dim = kwargs['random_noise_dim']
         self.channel_dim = kwargs['channel_dim']
         self.latent_dim = self.c_dim + self.rand_z_dim
         self.k = kwargs['k']
         self.gray = kwargs['gray']
+        self.uint8 = kwargs.get('uint8', False)
+        self.resident = kwargs.get('resident', False)
 
         # Planning hyperparameters
         self.planner = getattr(self, kwargs['planner'])
@@ -68,6 +78,9 @@ class Trainer:
         self.logger = None
         self.configure_logger()
         self.log_dict = OrderedDict()
+        self.diagnostics = Diagnostics(kwargs.get('diagnostics'), kwargs.get('log_interval', 100))
+        self.declare_diagnostics()
+        self.metrics_writer = MetricsWriter(self.log_dict)
 
         # Evaluation
         self.test_sample_size = 12
@@ -82,7 +95,7 @@ class Trainer:
     def _noise_sample(self, z, bs):
         c = self.P.sample(bs)
         c_next = self.T(c)
-        z.data.normal_(0, 1)
+        z.data.normal_(0, 1, generator=self.runtime.generator('noise'))
         return z, c, c_next
 
     def _eval_noise(self):
@@ -91,13 +104,15 @@ class Trainer:
         '''
         more_codes = self.test_num_codes - (self.c_dim + 1)
         # c = Variable(torch.cuda.FloatTensor([[j<i for j in range(self.disc_c_dim)] for i in range(min(self.test_num_codes, self.disc_c_dim+1))]))
-        c = Variable(torch.cuda.FloatTensor(
-            [[j < i for j in range(self.c_dim)] for i in range(min(self.test_num_codes, self.c_dim + 1))])) * (
+        c = Variable(torch.tensor(
+            [[j < i for j in range(self.c_dim)] for i in range(min(self.test_num_codes, self.c_dim + 1))],
+            dtype=torch.float, device=self.device)) * (
             self.P.unif_range[1] - self.P.unif_range[0]) + self.P.unif_range[0]
         if more_codes > 0:
             c = torch.cat([c, self.P.sample(more_codes)], 0)
         self.eval_c = c
-        z = Variable(torch.FloatTensor(self.test_sample_size, self.rand_z_dim).normal_(0, 1).cuda())
+        z = Variable(torch.randn(self.test_sample_size, self.rand_z_dim, device=self.device,
+                                 generator=self.runtime.generator('eval')))
 
         plot_img(c.t().detach().cpu(),
                  os.path.join(self.out_dir, 'gen', 'eval_code.png'),
@@ -113,7 +128,7 @@ class Trainer:
         return c_next.repeat(1, 1, self.test_sample_size).permute(2, 0, 1).contiguous().view(-1, self.c_dim)
 
     def apply_fcn_mse(self, img):
-        o = self.fcn(Variable(img).cuda()).detach()
+        o = self.fcn(self.runtime.tensor(Variable(img))).detach()
         return torch.clamp(2 * (o - 0.5), -1 + 1e-3, 1 - 1e-3)
         # return torch.clamp(2.6*(o - 0.5), -1 + 1e-3, 1 - 1e-3)
 
@@ -141,20 +156,111 @@ class Trainer:
         '''
         c_ = undiscretize(c_, self.discretization_bins, self.P.unif_range)
         c_next_ = undiscretize(c_next_, self.discretization_bins, self.P.unif_range)
-        z_ = from_numpy_to_var(np.random.randn(c_.shape[0], self.rand_z_dim))
+        z_ = torch.randn(c_.shape[0], self.rand_z_dim, device=self.device, generator=self.runtime.generator('plan'))
         _, next_observation = self.G(z_, from_numpy_to_var(c_), from_numpy_to_var(c_next_))
         return next_observation.data.cpu().numpy()
 
+    def declare_diagnostics(self):
+        """
+        Declare the statistics that train() logs. Each is computed only on
+        the steps that log it, see diagnostics.py.
+        """
+        self.diagnostics.declare('losses', self._log_losses)
+        self.diagnostics.declare('posterior', self._log_posterior)
+        self.diagnostics.declare('transition', self._log_transition)
+        self.diagnostics.check()
+        # They are computed after the generator step, which only runs on
+        # every 5th iteration: other intervals would log rarely or never.
+        for name in self.diagnostics.metrics:
+            interval = self.diagnostics.get_interval(name)
+            assert interval % 5 == 0, \
+                'The WGAN-GP trainer updates G every 5 iterations, so the interval of ' \
+                'diagnostic %s must be a multiple of 5, not %d' % (name, interval)
+
+    def _log_losses(self, step, metrics):
+        for name, value in step['losses'].items():
+            metrics[name] = value.detach().mean()
+        return list(step['losses'])
+
+    def _log_posterior(self, step, metrics):
+        # Q on the real images is only a diagnostic, so it is not part of the
+        # update: it runs on the steps that log it, in eval mode so that it
+        # leaves the BatchNorm statistics alone.
+        training = self.Q.training
+        self.Q.eval()
+        with torch.no_grad(), self.runtime.autocast():
+            Q_c_given_x, Q_c_given_x_var = self.Q.forward(step['real_o'])
+        self.Q.train(training)
+        write_stats(metrics, Q_c_given_x, 'Q_c_given_real_x_mu')
+        write_stats(metrics, Q_c_given_x, 'Q_c_given_real_x_mu', idx=0)
+        write_stats(metrics, Q_c_given_x_var, 'Q_c_given_real_x_variance')
+        write_stats(metrics, Q_c_given_x_var, 'Q_c_given_real_x_variance', idx=0)
+        metrics['0_Q_c_given_rand_x_mean'] = Q_c_given_x[:, 0].mean()
+        metrics['0_Q_c_given_rand_x_std'] = Q_c_given_x[:, 0].std(unbiased=False)
+        metrics['0_Q_c_given_fixed_x_std'] = Q_c_given_x_var[:, 0].mean().sqrt()
+        return ['0_Q_c_given_rand_x_mean', '0_Q_c_given_rand_x_std', '0_Q_c_given_fixed_x_std']
+
+    def _log_transition(self, step, metrics):
+        t_mu, t_variance = step['t_mu'], step['t_variance']
+        t_diff = t_mu - step['c']
+        write_stats(metrics, t_mu, 't_mu')
+        write_stats(metrics, t_mu, 't_mu', idx=0)
+        write_stats(metrics, t_diff, 't_diff')
+        write_stats(metrics, t_diff, 't_diff', idx=0)
+        write_stats(metrics, t_variance, 't_variance')
+        write_stats(metrics, t_variance, 't_variance', idx=0)
+        metrics['t_diff_abs_mean'] = t_diff.abs().mean()
+        metrics['t_std_mean'] = t_variance.sqrt().mean()
+        return ['t_diff_abs_mean', 't_std_mean']
+
+    def save_checkpoint(self, path, optimD, optimG, scaler, epoch, sampler_state):
+        """
+        Save what train() needs to continue at the exact batch where it
+        stopped: the networks, the optimizers and loss scaler, the epoch, the
+        state of the sampler and the noise streams of the runtime. The
+        previous checkpoint is only replaced once the new one is written.
+        """
+        state = dict(modules={name: getattr(self, name).state_dict() for name in 'GDQT'},
+                     optimD=optimD.state_dict(),
+                     optimG=optimG.state_dict(),
+                     scaler=scaler.state_dict(),
+                     epoch=epoch,
+                     sampler=sampler_state,
+                     generators=self.runtime.generator_states())
+        torch.save(state, path + '.tmp')
+        os.rename(path + '.tmp', path)
+
+    def load_checkpoint(self, path, optimD, optimG, scaler):
+        """
+        Load a checkpoint of save_checkpoint. Returns its epoch and sampler state.
+        """
+        state = self.runtime.load(path)
+        for name in 'GDQT':
+            getattr(self, name).load_state_dict(state['modules'][name])
+        optimD.load_state_dict(state['optimD'])
+        optimG.load_state_dict(state['optimG'])
+        scaler.load_state_dict(state['scaler'])
+        self.runtime.load_generator_states(state['generators'])
+        return state['epoch'], state['sampler']
+
+    def _print_metrics(self, epoch, itr, printed, values):
+        print('\n#######################'
+              '\nEpoch/Iter:%d/%d; ' % (epoch, itr) +
+              ''.join('\n%s: %.3f' % (name, values[name]) for name in printed))
+
     def train(self):
         lambda_ = 10
 
         # Set up training.
-        real_o = Variable(torch.FloatTensor(self.batch_size, 3, 64, 64).cuda(), requires_grad=False)
-        real_o_next = Variable(torch.FloatTensor(self.batch_size, 3, 64, 64).cuda(), requires_grad=False)
-        label = Variable(torch.FloatTensor(self.batch_size).cuda(), requires_grad=False)
-        z = Variable(torch.FloatTensor(self.batch_size, self.rand_z_dim).cuda(), requires_grad=False)
+        label = Variable(torch.empty(self.batch_size, device=self.device), requires_grad=False)
+        z = Variable(torch.empty(self.batch_size, self.rand_z_dim, device=self.device), requires_grad=False)
 
-        criterionD = nn.BCELoss().cuda()
+        criterionD = nn.BCELoss()
+        # Forward passes run under autocast when mixed precision is on; the
+        # losses and the gradient penalty are taken in float32 outside of it.
+        # The scaler only scales with fp16.
+        autocast = self.runtime.autocast
+        scaler = self.runtime.grad_scaler()
 
         optimD = optim.Adam([{'params': self.D.parameters()}], lr=self.lr_d,
                             betas=(0.5, 0.999))
@@ -166,21 +272,11 @@ class Trainer:
         # Load rope dataset and apply transformations
         rope_path = os.path.realpath(self.data_dir)
 
-        def filter_background(x):
-            x[:,(x<0.3).any(dim=0)]=0.0
-            return x
-
-        def dilate(x):
-            x = x.squeeze(0).numpy()
-            x = grey_dilation(x, size=3)
-            x = x[None, :, :]
-            return torch.from_numpy(x)
-
         trans = [
             transforms.Resize(64),
             transforms.CenterCrop(64),
             transforms.ToTensor(),
-            filter_background,
+            FilterBackground(),
             # transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))
         ]
 
@@ -190,30 +286,39 @@ class Trainer:
             # trans.append(transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)))
             if self.gray:
                 # Apply grayscale transformation.
-                trans.append(lambda x: x.mean(dim=0)[None, :, :])
-                trans.append(dilate)
-                trans.append(transforms.Normalize((0.5,), (0.5,)))
+                trans.append(Grayscale())
+                trans.append(Dilate(3))
+                trans.append(Normalize())
 
         trans_comp = transforms.Compose(trans)
         # Image 1 and image 2 are k steps apart.
         dataset = ImagePairs(root=rope_path,
                              transform=trans_comp,
-                             n_frames_apart=self.k)
-        dataloader = torch.utils.data.DataLoader(dataset,
-                                                 batch_size=self.batch_size,
-                                                 shuffle=True,
-                                                 num_workers=2,
-                                                 drop_last=True)
+                             n_frames_apart=self.k,
+                             seed=self.seed,
+                             uint8=self.uint8)
+        # Shuffled from (seed, epoch), so that a checkpoint can resume mid-epoch.
+        sampler = rank_sampler(dataset, seed=self.seed)
+        # Batches are copied to the device by a background thread while the
+        # previous step runs.
+        dataloader = DevicePrefetcher(batch_loader(dataset,
+                                                   self.batch_size,
+                                                   sampler=sampler,
+                                                   num_workers=2,
+                                                   drop_last=True,
+                                                   resident=self.resident,
+                                                   pin_memory=self.resident),
+                                      self.device)
         from torchvision.utils import save_image
-        imgs = next(iter(dataloader))[0][0]
+        imgs = normalize_images(next(iter(dataloader))[0][0])
         save_image(imgs * 0.5 + 0.5, 'train_img.png')
         ############################################
         # Load eval plan dataset
         planning_data_dir = self.planning_data_dir
-        dataset_start = dset.ImageFolder(root=os.path.join(planning_data_dir, 'start'),
+        dataset_start = CachedImageFolder(root=os.path.join(planning_data_dir, 'start'),
+                                          transform=trans_comp)
+        dataset_goal = CachedImageFolder(root=os.path.join(planning_data_dir, 'goal'),
                                          transform=trans_comp)
-        dataset_goal = dset.ImageFolder(root=os.path.join(planning_data_dir, 'goal'),
-                                        transform=trans_comp)
         data_start_loader = torch.utils.data.DataLoader(dataset_start,
                                                         batch_size=1,
                                                         shuffle=False,
@@ -225,23 +330,36 @@ class Trainer:
                                                        num_workers=1,
                                                        drop_last=True)
         ############################################
-        for epoch in range(self.n_epochs + 1):
+        ckpt_path = os.path.join(self.out_dir, 'checkpoint.pt')
+        start_epoch, sampler_state = 0, None
+        if self.resume and os.path.exists(ckpt_path):
+            start_epoch, sampler_state = self.load_checkpoint(ckpt_path, optimD, optimG, scaler)
+            print('Resuming from epoch {}{}'.format(start_epoch, '' if sampler_state is None else
+                                                    ', item {}'.format(sampler_state['start'])))
+        for epoch in range(start_epoch, self.n_epochs + 1):
+            if epoch == start_epoch and sampler_state is not None:
+                sampler.load_state_dict(sampler_state)
+            else:
+                sampler.set_epoch(epoch)
+            first_iter = sampler.start // self.batch_size
             self.G.train()
             self.D.train()
             self.Q.train()
             self.T.train()
-            for num_iters, batch_data in enumerate(dataloader, 0):
+            for num_iters, batch_data in enumerate(dataloader, first_iter):
+                if self.ckpt_interval and num_iters > first_iter and num_iters % self.ckpt_interval == 0:
+                    # The batches before this one are done: a resume starts at it.
+                    self.save_checkpoint(ckpt_path, optimD, optimG, scaler, epoch,
+                                         sampler.state_dict((num_iters - first_iter) * self.batch_size))
                 # Real data
-                o, _ = batch_data[0]
-                o_next, _ = batch_data[1]
+                # Normalized on the GPU when the loader emits raw uint8 images.
+                o = self.runtime.tensor(normalize_images(batch_data[0]))
+                o_next = self.runtime.tensor(normalize_images(batch_data[1]))
                 bs = o.size(0)
 
-                real_o.data.resize_(o.size())
-                real_o_next.data.resize_(o_next.size())
                 label.data.resize_(bs)
 
-                real_o.data.copy_(o)
-                real_o_next.data.copy_(o_next)
+                real_o, real_o_next = o, o_next
                 if self.fcn:
                     real_o = self.apply_fcn_mse(o)
                     real_o_next = self.apply_fcn_mse(o_next)
@@ -259,124 +377,100 @@ class Trainer:
                 real_input = torch.cat([real_o, real_o_next], dim=1)
                 # Fake data
                 z, c, c_next = self._noise_sample(z, bs)
-                fake_o, fake_o_next = self.G(z, c, c_next)
-                fake_input = torch.cat([fake_o, fake_o_next], dim=1)
+                with autocast():
+                    fake_o, fake_o_next = self.G(z, c, c_next)
+                fake_input = torch.cat([fake_o, fake_o_next], dim=1).float()
 
                 # Gradient penalty
-                eps = torch.rand(bs).cuda().view(bs, 1, 1, 1)
+                eps = torch.rand(bs, device=self.device, generator=self.runtime.generator('penalty')).view(bs, 1, 1, 1)
                 o_hat_input = eps * real_input + (1 - eps) * fake_input
 
-                critic_real = self.D(real_input)
-                critic_fake = self.D(fake_input)
+                with autocast():
+                    critic_real = self.D(real_input).float()
+                    critic_fake = self.D(fake_input).float()
+                    critic_hat = self.D(o_hat_input).float()
                 D_loss = (critic_fake - critic_real).mean()
 
-                critic_hat = self.D(o_hat_input)
-                grads = autograd.grad(critic_hat, o_hat_input,
+                # The input gradients are taken from the scaled critic, as
+                # fp16 would underflow otherwise, and unscaled in float32
+                # before the norm. The scale is read as a device tensor
+                # (get_scale() would sync). The epsilon keeps the gradient of
+                # the norm finite where the input gradients vanish.
+                grads = autograd.grad(scaler.scale(critic_hat), o_hat_input,
                                       torch.ones_like(critic_hat), retain_graph=True,
                                       create_graph=True, only_inputs=True)[0]
+                grads = grads.float() / scaler.scale(torch.ones((), device=self.device))
                 grads = grads.view(grads.size(0), -1)
-                grad_norms = torch.sqrt((grads ** 2).sum(-1))
+                grad_norms = torch.sqrt((grads ** 2).sum(-1) + 1e-12)
                 grad_penalty = lambda_ * (grad_norms - 1) ** 2
                 grad_penalty = grad_penalty.mean()
 
-                (D_loss + grad_penalty).backward()
-                optimD.step()
+                scaler.scale(D_loss + grad_penalty).backward()
+                scaler.step(optimD)
 
                 if num_iters % 5 != 0:
+                    scaler.update()
                     continue
                 ############################################
                 # G loss (Update G)
                 optimG.zero_grad()
 
                 z, c, c_next = self._noise_sample(z, bs)
-                fake_o, fake_o_next = self.G(z, c, c_next)
-                fake_input = torch.cat([fake_o, fake_o_next], dim=1)
-
-                critic_fake_2 = self.D(fake_input)
-                G_loss = -critic_fake_2.mean()
-
-                # Q loss (Update G, T, Q)
-                ent_loss = -self.P.log_prob(c).mean(0)
-                crossent_loss = -self.Q.log_prob(fake_o, c).mean(0)
-                crossent_loss_next = -self.Q.log_prob(fake_o_next, c_next).mean(0)
-                # trans_prob = self.T.get_prob(Variable(torch.eye(self.dis_c_dim).cuda()))
-                ent_loss_next = -self.T.log_prob(c, None, c_next).mean(0)
-                mi_loss = crossent_loss - ent_loss
-                mi_loss_next = crossent_loss_next - ent_loss_next
-                Q_loss = mi_loss + mi_loss_next
-
-                # T loss (Update T)
-                Q_c_given_x, Q_c_given_x_var = (i.detach() for i in self.Q.forward(real_o))
-                t_mu, t_variance = self.T.get_mu_and_var(c)
-                t_diff = t_mu - c
-                # Keep the variance small.
-                # TODO: add loss on t_diff
-                T_loss = (t_variance ** 2).sum(1).mean(0)
-
-                (G_loss +
-                 self.infow * Q_loss +
-                 self.transw * T_loss).backward()
-                optimG.step()
+                with autocast():
+                    fake_o, fake_o_next = self.G(z, c, c_next)
+                    fake_input = torch.cat([fake_o, fake_o_next], dim=1)
+
+                    critic_fake_2 = self.D(fake_input).float()
+                    G_loss = -critic_fake_2.mean()
+
+                    # Q loss (Update G, T, Q)
+                    ent_loss = -self.P.log_prob(c).mean(0)
+                    crossent_loss = -self.Q.log_prob(fake_o, c).mean(0)
+                    crossent_loss_next = -self.Q.log_prob(fake_o_next, c_next).mean(0)
+                    # trans_prob = self.T.get_prob(Variable(torch.eye(self.dis_c_dim).cuda()))
+                    ent_loss_next = -self.T.log_prob(c, None, c_next).mean(0)
+                    mi_loss = crossent_loss - ent_loss
+                    mi_loss_next = crossent_loss_next - ent_loss_next
+                    Q_loss = mi_loss + mi_loss_next
+
+                    # T loss (Update T)
+                    t_mu, t_variance = self.T.get_mu_and_var(c)
+                    # Keep the variance small.
+                    # TODO: add loss on t_diff
+                    T_loss = (t_variance ** 2).sum(1).mean(0)
+
+                scaler.scale(G_loss +
+                             self.infow * Q_loss +
+                             self.transw * T_loss).backward()
+                scaler.step(optimG)
+                # One update of the loss scale per iteration, after both steps.
+                scaler.update()
                 #############################################
                 # Logging (iteration)
-                if num_iters % 100 == 0:
-                    self.log_dict['Dloss'] = D_loss.item()
-                    self.log_dict['Gloss'] = G_loss.item()
-                    self.log_dict['Qloss'] = Q_loss.item()
-                    self.log_dict['Tloss'] = T_loss.item()
-                    self.log_dict['Grad_Penalty'] = grad_penalty.item()
-                    self.log_dict['mi_loss'] = mi_loss.item()
-                    self.log_dict['mi_loss_next'] = mi_loss_next.item()
-                    self.log_dict['ent_loss'] = ent_loss.item()
-                    self.log_dict['ent_loss_next'] = ent_loss_next.item()
-                    self.log_dict['crossent_loss'] = crossent_loss.item()
-                    self.log_dict['crossent_loss_next'] = crossent_loss_next.item()
-                    self.log_dict['D(real)'] = critic_real.data.mean()
-                    self.log_dict['D(fake)_before'] = critic_fake.data.mean()
-                    self.log_dict['D(fake)_after'] = critic_fake_2.data.mean()
-
-                    write_stats_from_var(self.log_dict, Q_c_given_x, 'Q_c_given_real_x_mu')
-                    write_stats_from_var(self.log_dict, Q_c_given_x, 'Q_c_given_real_x_mu', idx=0)
-                    write_stats_from_var(self.log_dict, Q_c_given_x_var, 'Q_c_given_real_x_variance')
-                    write_stats_from_var(self.log_dict, Q_c_given_x_var, 'Q_c_given_real_x_variance', idx=0)
-
-                    write_stats_from_var(self.log_dict, t_mu, 't_mu')
-                    write_stats_from_var(self.log_dict, t_mu, 't_mu', idx=0)
-                    write_stats_from_var(self.log_dict, t_diff, 't_diff')
-                    write_stats_from_var(self.log_dict, t_diff, 't_diff', idx=0)
-                    write_stats_from_var(self.log_dict, t_variance, 't_variance')
-                    write_stats_from_var(self.log_dict, t_variance, 't_variance', idx=0)
-
-                    print('\n#######################'
-                          '\nEpoch/Iter:%d/%d; '
-                          '\nDloss: %.3f; '
-                          '\nGloss: %.3f; '
-                          '\nQloss: %.3f, %.3f; '
-                          '\nT_loss: %.3f; '
-                          '\nEnt: %.3f, %.3f; '
-                          '\nCross Ent: %.3f, %.3f; '
-                          '\nD(x): %.3f; '
-                          '\nD(G(z)): b %.3f, a %.3f;'
-                          '\n0_Q_c_given_rand_x_mean: %.3f'
-                          '\n0_Q_c_given_rand_x_std: %.3f'
-                          '\n0_Q_c_given_fixed_x_std: %.3f'
-                          '\nt_diff_abs_mean: %.3f'
-                          '\nt_std_mean: %.3f'
-                          % (epoch, num_iters,
-                             D_loss.item(),
-                             G_loss.item(),
-                             mi_loss.item(), mi_loss_next.item(),
-                             T_loss.item(),
-                             ent_loss.item(), ent_loss_next.item(),
-                             crossent_loss.item(), crossent_loss_next.item(),
-                             critic_real.data.mean(),
-                             critic_fake.data.mean(), critic_fake_2.data.mean(),
-                             Q_c_given_x[:, 0].cpu().numpy().mean(),
-                             Q_c_given_x[:, 0].cpu().numpy().std(),
-                             np.sqrt(Q_c_given_x_var[:, 0].cpu().numpy().mean()),
-                             t_diff.data.abs().mean(),
-                             t_variance.data.sqrt().mean(),
-                             ))
+                if self.diagnostics.due(num_iters):
+                    step = dict(real_o=real_o, c=c, t_mu=t_mu.detach(), t_variance=t_variance.detach())
+                    step['losses'] = OrderedDict([
+                        ('Dloss', D_loss),
+                        ('Gloss', G_loss),
+                        ('Qloss', Q_loss),
+                        ('Tloss', T_loss),
+                        ('Grad_Penalty', grad_penalty),
+                        ('mi_loss', mi_loss),
+                        ('mi_loss_next', mi_loss_next),
+                        ('ent_loss', ent_loss),
+                        ('ent_loss_next', ent_loss_next),
+                        ('crossent_loss', crossent_loss),
+                        ('crossent_loss_next', crossent_loss_next),
+                        ('D(real)', critic_real),
+                        ('D(fake)_before', critic_fake),
+                        ('D(fake)_after', critic_fake_2)])
+                    metrics = OrderedDict()
+                    printed = self.diagnostics.log(num_iters, metrics, step)
+                    # Read and printed on the writer thread, the step goes on.
+                    self.metrics_writer.put(metrics, partial(self._print_metrics, epoch, num_iters, printed))
+            self.metrics_writer.flush()
+            print('Epoch %d: %s' % (epoch, dataloader.report()))
+            self.log_dict['step_ms'] = 1000 * dataloader.elapsed / max(dataloader.n_batches, 1)
             #############################################
             # Start evaluation from here.
             self.G.eval()
@@ -439,6 +533,7 @@ class Trainer:
                     if epoch == 1:
                         writer.writerow(["epoch"] + list(self.log_dict.keys()))
                     writer.writerow(["%.3f" % _tmp for _tmp in [epoch] + list(self.log_dict.values())])
+            self.save_checkpoint(ckpt_path, optimD, optimG, scaler, epoch + 1, None)
             #############################################
             # Do planning?
             if self.plan_length <= 0 or epoch not in self.planning_epoch:
@@ -486,10 +581,10 @@ class Trainer:
             if self.fcn:
                 start_obs = self.apply_fcn_mse(img[0])
             else:
-                start_obs = Variable(img[0]).cuda()
+                start_obs = self.runtime.tensor(Variable(img[0]))
             pt_start = os.path.join(self.out_dir, 'plans', 'c_min_start_%s.pt' % metric)
             if os.path.exists(pt_start):
-                z_start, c_start, _, est_start_obs = torch.load(pt_start)
+                z_start, c_start, _, est_start_obs = self.runtime.load(pt_start)
             else:
                 z_start, c_start, _, est_start_obs = self.closest_code(start_obs,
                                                                        256,
@@ -508,10 +603,10 @@ class Trainer:
             if self.fcn:
                 goal_obs = self.apply_fcn_mse(img[0])
             else:
-                goal_obs = Variable(img[0]).cuda()
+                goal_obs = self.runtime.tensor(Variable(img[0]))
             pt_goal = os.path.join(self.out_dir, 'plans', 'c_min_goal_%s_%d_epoch_%d.pt' % (metric, i, epoch))
             if os.path.exists(pt_goal):
-                z_goal, _, c_goal, est_goal_obs = torch.load(pt_goal)
+                z_goal, _, c_goal, est_goal_obs = self.runtime.load(pt_goal)
             else:
 
                 z_goal, _, c_goal, est_goal_obs = self.closest_code(goal_obs,
@@ -597,7 +692,7 @@ class Trainer:
             # Compute c_start and c_goal
             pt_path = os.path.join(self.out_dir, 'plans', 'c_min_%s_%d_epoch_%d.pt' % (metric, i, epoch))
             if os.path.exists(pt_path):
-                c_start, c_goal, est_start_obs, est_goal_obs = torch.load(pt_path)
+                c_start, c_goal, est_start_obs, est_goal_obs = self.runtime.load(pt_path)
             else:
                 _, c_start, _, est_start_obs = self.closest_code(start_obs,
                                                                  400,
@@ -683,6 +778,7 @@ class Trainer:
         :param regress_bs: int, regression batch size when 0 do just sampling.
         :return: the best noise and codes
         """
+        plan_rng = self.runtime.generator('plan')
         if metric == 'L2':
             f = lambda x, y: ((x - y) ** 2).view(n_trials, -1).sum(1)
         elif metric == 'classifier':
@@ -693,8 +789,8 @@ class Trainer:
             f = lambda x, y: - self.D(torch.cat([x, y], dim=1)).view(-1)
 
         if regress_bs:
-            z_var = Variable(0.1 * torch.randn(n_trials, self.rand_z_dim).cuda(), requires_grad=True)
-            c_var = Variable(0.1 * torch.randn(n_trials, self.c_dim).cuda(), requires_grad=True)
+            z_var = Variable(0.1 * torch.randn(n_trials, self.rand_z_dim, device=self.device, generator=plan_rng), requires_grad=True)
+            c_var = Variable(0.1 * torch.randn(n_trials, self.c_dim, device=self.device, generator=plan_rng), requires_grad=True)
             # c_var = Variable(self.Q.forward_soft(self.FE(obs.repeat(n_trials, 1, 1, 1))).data, requires_grad=True)
             optimizer = optim.Adam([c_var, z_var], lr=1e-2)
             n_iters = 1000
@@ -726,7 +822,7 @@ class Trainer:
             else:
                 c = c_var.detach()
         else:
-            _z = Variable(torch.randn(n_trials, self.rand_z_dim)).cuda()
+            _z = Variable(torch.randn(n_trials, self.rand_z_dim, device=self.device, generator=plan_rng))
             c = self.Q.forward_soft(self.FE(obs)).repeat(n_trials, 1)
 
         # Select best c and c_next from different initializations.
@@ -756,9 +852,10 @@ class Trainer:
         :param c_goal: bs x c_dim
         :return: rollout: horizon x bs x channel_dim x img_W x img_H
         """
+        plan_rng = self.runtime.generator('plan')
         with torch.no_grad():
             rollout = []
-            _z = Variable(torch.randn(c_start.size()[0], self.rand_z_dim)).cuda()
+            _z = Variable(torch.randn(c_start.size()[0], self.rand_z_dim, device=self.device, generator=plan_rng))
             for t in range(self.plan_length):
                 c = c_start + (c_goal - c_start) * t / self.plan_length
                 c_next = c_start + (c_goal - c_start) * (t + 1) / self.plan_length
@@ -783,6 +880,7 @@ class Trainer:
         :param c_goal: bs x c_dim
         :return: rollout: horizon x bs x channel_dim x img_W x img_H
         """
+        plan_rng = self.runtime.generator('plan')
         with torch.no_grad():
             rollout = []
             # _z = Variable(torch.randn(c_start.size()[0], self.rand_z_dim)).cuda()
@@ -802,7 +900,7 @@ class Trainer:
                 state_next = undiscretize(traj[t + 1].state, self.discretization_bins, self.P.unif_range)
                 c = from_numpy_to_var(state).repeat(bs, 1)
                 c_next = from_numpy_to_var(state_next).repeat(bs, 1)
-                _z = Variable(torch.randn(c.size()[0], self.rand_z_dim)).cuda()
+                _z = Variable(torch.randn(c.size()[0], self.rand_z_dim, device=self.device, generator=plan_rng))
 
                 _cur_img, _next_img = self.G(_z, c, c_next)
                 if t == 0:
@@ -7,21 +7,15 @@ import matplotlib.pyplot as plt
 
 from torch.autograd.variable import Variable
 
+from runtime import get_runtime
+
 
 def from_numpy_to_var(npx, dtype='float32'):
-    var = Variable(torch.from_numpy(npx.astype(dtype)))
-    if torch.cuda.is_available():
-        return var.cuda()
-    else:
-        return var
+    return get_runtime().tensor(Variable(torch.from_numpy(npx.astype(dtype))))
 
 
 def from_tensor_to_var(tensor):
-    var = Variable(tensor)
-    if torch.cuda.is_available():
-        return var.cuda()
-    else:
-        return var
+    return get_runtime().tensor(Variable(tensor))
 
 
 def normalize_row(a):
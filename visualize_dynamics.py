@@ -5,44 +5,33 @@ import numpy as np
 from os.path import join, exists
 import glob
 import random
-from scipy.ndimage.morphology import grey_dilation
 
 import torch
 import torch.utils.data as data
 from torchvision.utils import save_image
 from torchvision import transforms
 
-from dataset import ImageDataset
+from rope_transforms import FilterBackground, Grayscale, Dilate, Normalize
+from dataset import ImageDataset, batch_loader
 from cpc_util import *
+import runtime
 from rlpyt.envs.dm_control_env import DMControlEnv
 
 
 def get_dataloaders():
     dset = ImageDataset(root=args.root, include_state=True, transform=transforms.ToTensor())
-    data_loader = data.DataLoader(dset, batch_size=128,
-                                  shuffle=True)
+    data_loader = batch_loader(dset, 128, shuffle=True)
     return dset, data_loader
 
 
-def filter_background(x):
-    x[:, (x < 0.3).any(dim=0)] = 0.0
-    return x
-
-def dilate(x):
-    x = x.squeeze(0).numpy()
-    x = grey_dilation(x, size=3)
-    x = x[None, :, :]
-    return torch.from_numpy(x)
-
-
 # Assumes input is a [0, 255] numpy array of 64 x 64 x 3
 # Processes to [-1, 1] FloatTensor of 1 x 64 x 64
 def process_obs(o):
     transform = transforms.Compose([
-        filter_background,
-        lambda x: x.mean(dim=0)[None, :, :],
-        dilate,
-        transforms.Normalize((0.5,), (0.5,)),
+        FilterBackground(),
+        Grayscale(),
+        Dilate(3),
+        Normalize(),
     ])
     o = torch.FloatTensor(o / 255.).permute(2, 0, 1).contiguous()
     return transform(o)
@@ -200,8 +189,7 @@ def visualize_fwd(encoder, fwd_model, dset, env, folder_name, n=10):
 
 def main():
     np.random.seed(args.seed)
-    torch.manual_seed(args.seed)
-    torch.cuda.manual_seed(args.seed)
+    rt.manual_seed(args.seed)
     random.seed(args.seed)
 
     dset, data_loader = get_dataloaders()
@@ -211,16 +199,16 @@ def main():
 
     obs = next(iter(data_loader))[0].to(device)
     if args.type == 'nce':
-        encoder = torch.load(join(folder_name, 'encoder.pt'), map_location=device)
+        encoder = rt.module(rt.load(join(folder_name, 'encoder.pt')))
     elif args.type == 'vae':
-        encoder = torch.load(join(folder_name, 'vae.pt'), map_location=device)
+        encoder = rt.module(rt.load(join(folder_name, 'vae.pt')))
         with torch.no_grad():
             obs_recon = encoder.decode(encoder.encode(obs))
         save_image(obs_recon * 0.5 + 0.5, join(folder_name, 'test_vae_visdyn.png'))
     else:
         raise Exception('Invalid type', args.type)
-    fwd_model = torch.load(join(folder_name, 'fwd_model.pt'), map_location=device)
-    inv_model = torch.load(join(folder_name, 'inv_model.pt'), map_location=device)
+    fwd_model = rt.module(rt.load(join(folder_name, 'fwd_model.pt')))
+    inv_model = rt.module(rt.load(join(folder_name, 'inv_model.pt')))
     encoder.eval()
     fwd_model.eval()
     inv_model.eval()
@@ -247,11 +235,13 @@ if __name__ == '__main__':
     parser.add_argument('--interp_type', type=str, default='slerp')
     parser.add_argument('--n_actions', type=int, default=10)
     parser.add_argument('--type', type=str, default='nce')
+    runtime.add_arguments(parser, amp=False)
     parser.add_argument('--seed', type=int, default=0)
     parser.add_argument('--name', type=str, required=True)
     args = parser.parse_args()
 
     assert args.type in ['nce', 'vae']
 
-    device = torch.device('cuda')
+    rt = runtime.from_args(args)
+    device = rt.device
     main()
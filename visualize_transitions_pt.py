@@ -5,7 +5,7 @@ import cv2
 import glob
 from os.path import join
 import random
-from dataset import NCEVineDataset
+from dataset import NCEVineDataset, batch_loader
 import torch.utils.data as data
 
 n = 32
@@ -13,7 +13,7 @@ n_neg = 12
 root = sys.argv[1]
 
 dset = NCEVineDataset(root, n_neg)
-data_loader = data.DataLoader(dset, batch_size=n, shuffle=True)
+data_loader = batch_loader(dset, n, shuffle=True)
 
 obs, obs_pos, actions, obs_neg = next(iter(data_loader))
 obs, obs_pos, obs_neg = obs * 0.5 + 0.5, obs_pos * 0.5 + 0.5, obs_neg * 0.5 + 0.5